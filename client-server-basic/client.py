@@ -8,7 +8,11 @@ import logging
 import datetime
 import secrets
 import random
-from tornado.websocket import websocket_connect
+import sys
+from pathlib import Path
+# The shared websocket tooling lives at the repo root
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.compression import websocket_connect
 
 '''
 https://www.tornadoweb.org/en/stable/websocket.html#tornado.websocket.WebSocketClientConnection
@@ -16,15 +20,17 @@ https://www.tornadoweb.org/en/stable/websocket.html#tornado.websocket.WebSocketC
 
 class SpoolClient:
 
-    def __init__(self, name, url):
+    def __init__(self, name, url, compression=None):
         self.name = name
         self.url = url
+        self.compression = compression
         self.conn = None
 
     async def connect(self):
         if self.conn is not None:
             raise Exception("Already connected")
-        self.conn = await websocket_connect(self.url,on_message_callback=self.on_message)
+        self.conn = await websocket_connect(self.url,compression=self.compression,
+            on_message_callback=self.on_message)
 
     def close(self):
         if self.conn is not None:
@@ -8,16 +8,27 @@ import signal
 import logging
 import tornado.web
 import tornado.websocket
+import sys
+from pathlib import Path
+# The shared websocket tooling lives at the repo root
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.broadcast import Broadcaster
+from wscommon.compression import CompressionPolicyMixin
+from wscommon.metrics import Metrics, MetricsHandler, MetricsMixin, connection_metrics
+from wscommon.registry import ConnectionRegistry
 
-class ChannelWebSocket(tornado.websocket.WebSocketHandler):
+class ChannelWebSocket(MetricsMixin, CompressionPolicyMixin, tornado.websocket.WebSocketHandler):
 
     def open(self):
         self.idx = self.application.register_ws_client(self)
         print(f'WebSocket {self.idx} on_open')
         self.write_message("HELLO FROM THE SERVER!")
 
+    def get_compression_policy(self):
+        return self.application.compression
+
     def on_message(self, message):
-        self.application.announce(self,message)
+        self.application.announce(self,self.count_received(message))
 
     def on_close(self):
         self.application.unregister_ws_client(self.idx)
@@ -26,13 +37,26 @@ class ChannelWebSocket(tornado.websocket.WebSocketHandler):
 
 class MyApp(tornado.web.Application):
 
-    def __init__(self):
+    def __init__(self, compression=None):
+        # A `wscommon.compression.CompressionPolicy` for the channel, None for off
+        self.compression = compression
+
         # Websocket tracking
-        self.ws_client_idx = -1
-        self.ws_clients = {}
+        self.ws_clients = ConnectionRegistry()
+        # Counters, served at /metrics; open, so totals only
+        self.metrics = Metrics('channel')
+        self.loop_lag = self.metrics.loop_lag()
+        self.metrics.collect(connection_metrics(self.ws_clients,'ws',per_connection=False))
+        self.metrics.collect(self._channel_metrics)
+        # Frames are encoded once per announce; a client more than 1MB
+        # behind misses messages until it catches up
+        self.broadcaster = Broadcaster(max_outstanding=1<<20,policy='drop',
+            fanout=self.metrics.histogram('fanout_seconds',
+                'Time to write an announce to its clients').labels())
 
         _handlers = [
-            (r"^/api/ws/channel/?$",ChannelWebSocket)
+            (r"^/api/ws/channel/?$",ChannelWebSocket),
+            (r"^/metrics/?$",MetricsHandler)
         ]
         _settings = {}
 
@@ -40,33 +64,35 @@ class MyApp(tornado.web.Application):
 
     async def on_shutdown(self):
         logging.info('app::on_shutdown >')
-        for handler in self.ws_clients.values():
+        for handler in self.ws_clients.handlers():
             handler.close()
+        self.loop_lag.stop()
         logging.info('< app::on_shutdown')
 
+    def _channel_metrics(self):
+        ''' Families for `self.metrics`, read when scraped '''
+        broadcast = self.broadcaster.status()
+        return [
+            ('outstanding_bytes','gauge','Bytes written to clients and not yet sent',
+                [({},broadcast['outstanding'])]),
+            ('dropped_total','counter','Messages not sent to a client too far behind',
+                [({},broadcast['dropped'])]),
+        ]
+
     def announce(self, sender, message):
-        sender.write_message(f"ECHO: {message}")
-        for wc in self.ws_clients.values():
-            if wc == sender:
-                continue
-            wc.write_message(message)
+        self.broadcaster.send(sender,f"ECHO: {message}")
+        self.broadcaster.broadcast(self.ws_clients.handlers(),message,exclude=sender)
 
     #-- Websocket Tracking ------------------------------------------------#
 
-    def new_ws_client_key(self):
-        ''' Could update to be anything '''
-        self.ws_client_idx += 1
-        return self.ws_client_idx
-
     def register_ws_client(self, handler):
-        idx = self.new_ws_client_key()
-        self.ws_clients[idx] = handler
+        idx = self.ws_clients.add(handler,remote=handler.request.remote_ip).id
         logging.info('register %s wsclient', idx)
         return idx
 
     def unregister_ws_client(self, idx):
         logging.info('unregister %s wsclient', idx)
-        self.ws_clients.pop(idx)
+        self.ws_clients.remove(idx)
 
 
 
@@ -8,7 +8,16 @@ import logging
 import datetime
 import secrets
 import random
-from tornado.websocket import websocket_connect
+import sys
+from pathlib import Path
+# The shared websocket tooling lives at the repo root
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.compression import websocket_connect
+from wscommon.heartbeat import Heartbeat, rtt_ms
+from wscommon.outbox import Outbox
+from wscommon.reconnect import ReconnectingClient
+from wscommon.rpc import RpcClientMixin, RpcError
+from wscommon.topics import TopicClientMixin
 from tornado.httpclient import HTTPRequest, HTTPClientError
 
 '''
@@ -20,12 +29,14 @@ https://www.tornadoweb.org/en/stable/httpclient.html#tornado.httpclient.HTTPRequ
 
 '''
 
-class SpoolClient:
+class SpoolClient(TopicClientMixin, RpcClientMixin, ReconnectingClient):
 
-    def __init__(self, name, url):
+    def __init__(self, name, url, compression=None):
+        # What is written while reconnecting is kept, and resent until acked
+        # A server that stops answering pings is reconnected to within 15s
+        super().__init__(url,compression=compression,outbox=Outbox(),acks=True,
+            heartbeat=Heartbeat(interval=10,timeout=5))
         self.name = name
-        self.url = url
-        self.conn = None
 
         # Connection management
         self.locally_closed = False
@@ -45,17 +56,19 @@ class SpoolClient:
                 # Make our connection
                 request = HTTPRequest(url=self.url,request_timeout=5)
                 self.conn = await websocket_connect(
-                    url=request, on_message_callback=self.on_message )
+                    url=request, compression=self.compression, on_message_callback=self.on_message )
 
                 # Await to keep open: triggered by `on_close`
                 self.locally_closed = False
                 self.conn_retrigger = asyncio.Event()
                 print("Connected")
+                self._flush()
                 await self.conn_retrigger.wait()
 
                 # Reengage reconnection attemps
                 print("Connection is lost")
                 remaining_connection_attempts = 5
+                self.backoff.reset()
 
             except HTTPClientError as err:
                 print("err!",err)
@@ -70,7 +83,7 @@ class SpoolClient:
                 remaining_connection_attempts -= 1
                 if remaining_connection_attempts > 0:
                     print("waiting to try connecting again")
-                    await asyncio.sleep(1)
+                    await asyncio.sleep(self.backoff.next())
                 else:
                     raise Exception("Could not connect")
         print('done connect')
@@ -82,15 +95,16 @@ class SpoolClient:
     def close(self):
         if self.conn is not None:
             print("closing")
-            self.locally_closed = True
-            self.conn.close()
-            self.conn = None
+        self.locally_closed = True
+        super().close()
+        self.conn = None
 
     def on_closed(self):
         if self.locally_closed:
             print("on_closed: local close")
         else:
             print("on_closed: Try to reconnect")
+            self.rpc_connection_lost()
             self.conn.close() # Needed?
             self.conn = None
             self.conn_retrigger.set()
@@ -98,54 +112,38 @@ class SpoolClient:
     def on_message(self, message):
         if message is None:
             self.on_closed()
-        else:
+        elif self.rpc_receive(message) is not None:
             print("  ==>",message)
 
     #-- Await System -----------------------------------------------------------------------------#
 
     async def connect2(self):
         # Should be called only once
+        # Reconnects with jittered backoff until `close`, see `wscommon.reconnect`
+        await self.start()
+        print("completed")
 
-        while True:
-            try:
-                print("Attempt a connection")
-                request = HTTPRequest(url=self.url,request_timeout=5)
-                self.conn = await websocket_connect(url=request)
-                print("connected")
-                while True:
-                    msg = await self.conn.read_message()
-                    if msg is None:
-                        break
-                    self.on_message2(msg)
-                print("closed")
-
-            except HTTPClientError as err:
-                print("err!",err)
-                self.conn = None
-            except ConnectionRefusedError as err:
-                print('refused!!!!',err)
-                self.conn = None
-            finally:
-                self.conn = None
-                print("finally")
+    def on_open(self):
+        print("connected")
+        self.resubscribe()
 
-            print("Wait to try connecting again")
-            await asyncio.sleep(1)
+    def on_publication(self, topic, data):
+        print(f"  ==> {topic}:",data)
 
-        print("completed")
+    def on_close(self):
+        print("closed")
+        self.rpc_connection_lost()
 
-    def on_message2(self, message):
-        print("  ==>",message)
+    def on_connect_error(self, err):
+        print("err!",err)
 
 
     #-- Write ------------------------------------------------------------------------------------#
 
     def write_something(self):
-        if self.conn is None:
-            return
         msg = f"{self.name} {datetime.datetime.now()}"
         print("<==",msg)
-        self.conn.write_message(msg)
+        self.write_message(msg)
 
 
 async def main():
@@ -168,8 +166,14 @@ async def main():
     # Define a periodic message
     # Note this can hang
     async def send_something():
+        await client.subscribe('spool.*')
         while True:
             client.write_something()
+            client.publish(f'spool.{name}',str(datetime.datetime.now()))
+            try:
+                print("clients:",await client.call('clients',timeout=2),"rtt ms:",rtt_ms(client))
+            except RpcError as err:
+                print("call failed:",err)
             sleep_for = 2+4*random.random()
             await asyncio.sleep(sleep_for)
     asyncio.create_task(send_something(),name="Send Something")
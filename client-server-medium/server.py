@@ -6,32 +6,76 @@ import asyncio
 import datetime
 import signal
 import logging
+import time
 import tornado.web
 import tornado.websocket
+import sys
+from pathlib import Path
+# The shared websocket tooling lives at the repo root
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.broadcast import Broadcaster
+from wscommon.compression import CompressionPolicyMixin
+from wscommon.metrics import Metrics, MetricsHandler, MetricsMixin, connection_metrics
+from wscommon.registry import ConnectionRegistry
+from wscommon.heartbeat import Heartbeat, HeartbeatMixin, rtt_ms
+from wscommon.resume import ResumableMixin, ResumeSessions
+from wscommon.rpc import RpcMixin, rpc_method
+from wscommon.topics import TopicIndex, TopicsMixin, encode_publication
 import random
 
-class ChannelWebSocket(tornado.websocket.WebSocketHandler):
+class ChannelWebSocket(MetricsMixin, RpcMixin, TopicsMixin, ResumableMixin, HeartbeatMixin, CompressionPolicyMixin,
+        tornado.websocket.WebSocketHandler):
 
     '''
     https://www.tornadoweb.org/en/stable/websocket.html
     '''
 
     async def prepare(self):
-        if random.random() > 0.9:
+        t0 = time.perf_counter()
+        allowed = random.random() <= 0.9
+        if allowed:
+            await asyncio.sleep(1)
+        self.application.auth_time.labels('ok' if allowed else 'forbidden').observe(time.perf_counter()-t0)
+        if not allowed:
             raise tornado.web.HTTPError(403)
-        await asyncio.sleep(1)
 
     def open(self):
         print("hold up")
         # await asyncio.sleep(2)
         print("ok go")
         self.idx = self.application.register_ws_client(self)
+        self.start_heartbeat()
         print(f'WebSocket {self.idx} on_open')
         self.write_message("HELLO FROM THE SERVER!")
 
+    def get_compression_policy(self):
+        return self.application.compression
+
     def on_message(self, message):
+        message = self.rpc_receive(self.resume_receive(self.count_received(message)))
+        if message is None:
+            return
         self.application.announce(self,message)
 
+    @rpc_method('echo')
+    def rpc_echo(self, params):
+        return params
+
+    @rpc_method('clients')
+    def rpc_clients(self, params):
+        return len(self.application.ws_clients)
+
+    @rpc_method('liveness')
+    def rpc_liveness(self, params):
+        status = self.application.ws_heartbeat.status()
+        status['rtt_ms'] = { c.id: rtt_ms(c.handler) for c in self.application.ws_clients }
+        return status
+
+    @rpc_method('connections')
+    def rpc_connections(self, params):
+        registry = self.application.ws_clients
+        return dict(registry.status(),memory=registry.memory())
+
     def on_close(self):
         self.application.unregister_ws_client(self.idx)
         print(f'WebSocket {self.idx} closed {self}')
@@ -39,13 +83,34 @@ class ChannelWebSocket(tornado.websocket.WebSocketHandler):
 
 class MyApp(tornado.web.Application):
 
-    def __init__(self):
-        # Websocket tracking
-        self.ws_client_idx = -1
-        self.ws_clients = {}
+    def __init__(self, compression=None):
+        # A `wscommon.compression.CompressionPolicy` for the channel, None for off
+        self.compression = compression
+
+        # Websocket tracking; see `wscommon.registry` and, for `publish`,
+        # `wscommon.topics`
+        self.topics = TopicIndex()
+        self.ws_clients = ConnectionRegistry(topics=self.topics)
+        # Counters, served at /metrics
+        self.metrics = Metrics('channel')
+        self.auth_time = self.metrics.histogram('auth_seconds',
+            'Time to let a client in or turn it away, by result',labels=('result',))
+        self.loop_lag = self.metrics.loop_lag()
+        self.metrics.collect(connection_metrics(self.ws_clients,'ws'))
+        self.metrics.collect(self._channel_metrics)
+        # Clients that reconnect within a minute pick up where they left off
+        self.resume_sessions = ResumeSessions(ttl=60)
+        # Clients that stop answering pings are dropped within 15s
+        self.ws_heartbeat = Heartbeat(interval=10,timeout=5)
+        # Frames are encoded once per announce; a client more than 1MB
+        # behind misses messages until it catches up
+        self.broadcaster = Broadcaster(max_outstanding=1<<20,policy='drop',
+            fanout=self.metrics.histogram('fanout_seconds',
+                'Time to write an announce or publish to its clients').labels())
 
         _handlers = [
-            (r"^/api/ws/channel/?$",ChannelWebSocket)
+            (r"^/api/ws/channel/?$",ChannelWebSocket),
+            (r"^/metrics/?$",MetricsHandler)
         ]
         _settings = {}
 
@@ -53,16 +118,32 @@ class MyApp(tornado.web.Application):
 
     async def on_shutdown(self):
         logging.info('app::on_shutdown >')
-        for handler in self.ws_clients.values():
+        for handler in self.ws_clients.handlers():
             handler.close()
+        self.ws_heartbeat.wheel.stop()
+        self.loop_lag.stop()
         logging.info('< app::on_shutdown')
 
+    def _channel_metrics(self):
+        ''' Families for `self.metrics`, read when scraped '''
+        broadcast = self.broadcaster.status()
+        return [
+            ('outstanding_bytes','gauge','Bytes written to clients and not yet sent',
+                [({},broadcast['outstanding'])]),
+            ('dropped_total','counter','Messages not sent to a client too far behind',
+                [({},broadcast['dropped'])]),
+            ('resume_sessions','gauge','Client sessions kept to resume',[({},len(self.resume_sessions))]),
+            ('heartbeat_watched','gauge','Clients pinged for liveness',[({},self.ws_heartbeat.watched)]),
+            ('heartbeat_dead_total','counter','Clients dropped for going quiet',[({},self.ws_heartbeat.dead)]),
+        ]
+
     def announce(self, sender, message):
-        sender.write_message(f"ECHO: {message}")
-        for wc in self.ws_clients.values():
-            if wc == sender:
-                continue
-            wc.write_message(message)
+        self.broadcaster.send(sender,f"ECHO: {message}")
+        self.broadcaster.broadcast(self.ws_clients.handlers(),message,exclude=sender)
+
+    def publish(self, topic, data):
+        ''' Returns how many subscribers it was written to '''
+        return self.broadcaster.broadcast(self.ws_clients.subscribers(topic),encode_publication(topic,data))
 
     async def eject_cycle(self):
         while True:
@@ -71,20 +152,14 @@ class MyApp(tornado.web.Application):
 
     #-- Websocket Tracking ------------------------------------------------#
 
-    def new_ws_client_key(self):
-        ''' Could update to be anything '''
-        self.ws_client_idx += 1
-        return self.ws_client_idx
-
     def register_ws_client(self, handler):
-        idx = self.new_ws_client_key()
-        self.ws_clients[idx] = handler
+        idx = self.ws_clients.add(handler,remote=handler.request.remote_ip).id
         logging.info('register %s wsclient', idx)
         return idx
 
     def unregister_ws_client(self, idx):
         logging.info('unregister %s wsclient', idx)
-        self.ws_clients.pop(idx)
+        self.ws_clients.remove(idx)
 
 
 
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Node link throughput with and without batching.
+
+Three nodes in a line, A -> B -> C, all in this process. A originates
+envelopes at a fixed rate, B relays them and C counts them. For each
+rate, three setups:
+
+* off:     one websocket frame per envelope
+* tick:    `batch_window_us=0`, frames written in one loop iteration batched
+* 500us:   `batch_window_us=500`
+
+Reported: the rate C received, websocket frames per envelope on the A->B
+link, process CPU per envelope (all three nodes), and latency A to C.
+
+    python bench_batching.py --rates 1000 10000 100000
+'''
+
+# Python
+import asyncio
+import contextlib
+import io
+import logging
+import time
+# Local
+from mesh.node import MeshNodeServer
+from bench_routing import percentile, links_up
+
+
+SETUPS = [ ('off',None), ('tick',0), ('500us',500) ]
+
+async def run(rate, window_us, seconds, size, base_port):
+    servers = [ MeshNodeServer("localhost",base_port+i,batch_window_us=window_us) for i in range(3) ]
+    for server in servers:
+        server.start()
+    links = [(0,1),(1,2)]
+    for a,b in links:
+        servers[a].connect_to(base_port+b)
+    while not links_up(servers,links):
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+    a,b,c = servers
+
+    latencies = []
+    accept = c.router.accept
+    def timed_accept(env):
+        latencies.append(time.perf_counter()-float(bytes(env.payload[:17])))
+        return accept(env)
+    c.router.accept = timed_accept
+    padding = 'x'*max(0,size-18)
+
+    for server in servers:
+        server.router.reset_stats()
+    sent = 0
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter()-t0
+        if elapsed >= seconds:
+            break
+        due = int(rate*elapsed)-sent
+        for _ in range(due):
+            a.send_to_nodes(a.router.originate(f"{time.perf_counter():17.6f} {padding}"))
+        sent += max(0,due)
+        await asyncio.sleep(0.001)
+    # Let the tail drain, up to a second
+    for _ in range(100):
+        if c.router.stats['delivered'] >= sent:
+            break
+        await asyncio.sleep(0.01)
+    cpu = time.process_time()-cpu0
+    delivered = c.router.stats['delivered']
+
+    if window_us is None:
+        frames = a.router.stats['sent']
+    else:
+        frames = sum( batcher.frames_out for batcher in a.link_batchers.values() )
+    for server in servers:
+        await server.on_shutdown()
+    await asyncio.sleep(0.3)
+    return dict(
+        rate=delivered/seconds,
+        frames=frames/max(1,sent),
+        cpu=1e6*cpu/max(1,delivered),
+        p50=1000*percentile(latencies,50) if latencies else 0,
+        p99=1000*percentile(latencies,99) if latencies else 0,
+        lost=sent-delivered)
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rates', type=int, nargs='+', default=[1000,10000,100000])
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--port', type=int, default=9700)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    print(f"{'offered':>8} {'batching':<7} {'received':>9} {'frames/msg':>10} {'cpu/msg':>9} {'p50':>9} {'p99':>9}")
+    port = args.port
+    for rate in args.rates:
+        for name,window_us in SETUPS:
+            with contextlib.redirect_stdout(io.StringIO()):
+                r = await run(rate,window_us,args.seconds,args.size,port)
+            port += 10
+            print(f"{rate:>8} {name:<7} {r['rate']:8.0f}/s {r['frames']:10.3f} {r['cpu']:7.1f}us"
+                  f" {r['p50']:7.2f}ms {r['p99']:7.2f}ms" + (f"  ({r['lost']} not delivered)" if r['lost'] else ""))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
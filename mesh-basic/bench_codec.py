@@ -0,0 +1,59 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+The binary envelope against JSON text envelopes.
+
+For a few payload sizes, per codec:
+
+* encode: a new envelope, as the origin node does
+* decode: a received frame back into an `Envelope`
+* relay:  what an intermediate node does, decode then encode the next hop
+* wire:   bytes on a node link, websocket frame header included
+
+    python bench_codec.py
+'''
+
+# Python
+import timeit
+# Local
+from mesh.codec import BINARY, JSON
+from mesh.routing import Envelope
+
+
+def ws_frame_size(size):
+    return size+(2 if size < 126 else 4 if size <= 0xFFFF else 10)
+
+def bench(codec, payload, number):
+    env = Envelope("localhost:8701",(1<<40)+12345,32,0,payload)
+    data = codec.encode(env)
+
+    def relay():
+        codec.encode(codec.decode(data).next_hop())
+
+    results = {}
+    for name,fn in (('encode',lambda: codec.encode(env)),
+            ('decode',lambda: codec.decode(data)),('relay',relay)):
+        results[name] = 1e6*timeit.timeit(fn,number=number)/number
+    results['wire'] = ws_frame_size(len(data))
+    return results
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'payload':>8} {'codec':<7} {'encode':>9} {'decode':>9} {'relay':>9} {'relay/s':>10} {'wire':>8}")
+    for size in (64,1024,16*1024,256*1024):
+        payload = ('0123456789abcdef'*(size//16+1))[:size]
+        number = max(100,args.number*64//max(64,size))
+        for codec in (JSON,BINARY):
+            r = bench(codec,payload,number)
+            print(f"{size:>8} {codec.name:<7} {r['encode']:8.2f}us {r['decode']:8.2f}us"
+                  f" {r['relay']:8.2f}us {1e6/r['relay']:10.0f} {r['wire']:7}B")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Reshaping a running mesh through the control API (`mesh.control`).
+
+`--nodes` nodes run in this process with no links, each with `--leaves`
+leaves standing in (see bench_presence.py), so presence routes have to
+be kept up as links change. They are then linked
+as a ring, then as a ring plus random chords (as in bench_routing.py,
+about `--degree` links each), then as another such graph, each step
+posted over HTTP:
+
+* sequential:  one `connect` or `disconnect` action per request, each
+               awaited before the next, as a script driving `connect_to`
+               would
+* apply:       one `apply` per node with its whole set of neighbours
+               ("both_ends", so each link is dialed once), at most
+               `--parallelism` requests in flight
+
+Reported per step: wall time until every link of the new graph is up and
+no other is, and the per-request times the API returned.
+
+    python bench_control.py --nodes 100 --degree 4
+'''
+
+# Python
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import random
+import time
+# Tornado
+from tornado.httpclient import AsyncHTTPClient
+# Local
+from mesh.node import MeshNodeServer
+from bench_routing import make_links, links_up, percentile
+from bench_presence import FakeLeaf
+
+
+async def post(port, body):
+    response = await AsyncHTTPClient().fetch(f"http://localhost:{port}/api/http/control/action",
+        method='POST',body=json.dumps(body),request_timeout=60)
+    return json.loads(response.body)
+
+def neighbours(count, links):
+    result = [ set() for _ in range(count) ]
+    for a,b in links:
+        result[a].add(b)
+        result[b].add(a)
+    return result
+
+def matches(servers, links):
+    ''' Every link of `links` is up, and no other '''
+    wanted = { frozenset(l) for l in links }
+    base = servers[0].port
+    for i,server in enumerate(servers):
+        have = { int(addr.rpartition(':')[2])-base for addr in server.live_node_addrs }
+        if have != { b for l in wanted if i in l for b in l if b != i }:
+            return False
+    return links_up(servers,links)
+
+async def sequential(servers, old, new, base_port):
+    ''' One action per request, in turn; returns the request times '''
+    times = []
+    old,new = { frozenset(l) for l in old },{ frozenset(l) for l in new }
+    steps = [ ('disconnect',l) for l in old-new ]+[ ('connect',l) for l in new-old ]
+    for action,link in steps:
+        a,b = sorted(link)
+        t0 = time.perf_counter()
+        result = await post(base_port+a,dict(action=action,port=base_port+b))
+        times.append(time.perf_counter()-t0)
+        assert result['success'],result
+    return times
+
+async def apply(servers, new, base_port, parallelism):
+    ''' An `apply` per node, `parallelism` at a time; returns the request times '''
+    times = []
+    slots = asyncio.Semaphore(parallelism)
+    wanted = neighbours(len(servers),new)
+
+    async def one(i):
+        async with slots:
+            t0 = time.perf_counter()
+            result = await post(base_port+i,dict(action='apply',both_ends=True,
+                links=[ base_port+n for n in sorted(wanted[i]) ]))
+            times.append(time.perf_counter()-t0)
+            assert result['success'],result
+
+    await asyncio.gather(*( one(i) for i in range(len(servers)) ))
+    return times
+
+async def run(mode, args, base_port, rng):
+    servers = [ MeshNodeServer("localhost",base_port+i) for i in range(args.nodes) ]
+    for server in servers:
+        server.start()
+        for n in range(args.leaves):
+            server.register_leaf_client(FakeLeaf(),f"{server.node_id}/{n}")
+    ring = make_links(args.nodes,2,rng)
+    graphs = [ ('ring',ring),('ring+chords',make_links(args.nodes,args.degree,rng)),
+        ('other chords',make_links(args.nodes,args.degree,rng)) ]
+
+    results = []
+    current = set()
+    for name,links in graphs:
+        t0 = time.perf_counter()
+        if mode == 'sequential':
+            times = await sequential(servers,current,links,base_port)
+        else:
+            times = await apply(servers,links,base_port,args.parallelism)
+        while not matches(servers,links):
+            await asyncio.sleep(0.01)
+        wall = time.perf_counter()-t0
+        results.append(f"  {mode:<10} to {name:<12} ({len(links):>3} links)"
+            f" | {wall:6.2f}s | {len(times):>3} requests, p50 {1000*percentile(times,50):7.1f}ms"
+            f" p99 {1000*percentile(times,99):7.1f}ms")
+        current = links
+
+    for server in servers:
+        await server.on_shutdown()
+    await asyncio.sleep(0.5)
+    return results
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--leaves', type=int, default=100, help='per node')
+    parser.add_argument('--parallelism', type=int, default=32, help='apply requests in flight')
+    parser.add_argument('--port', type=int, default=9600)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    AsyncHTTPClient.configure(None,max_clients=args.parallelism)
+    print(f"{args.nodes} nodes:")
+    for idx,mode in enumerate(('sequential','apply')):
+        # Same graphs for both
+        rng = random.Random(1)
+        # The nodes print as links come and go
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = await run(mode,args,args.port+200*idx,rng)
+        print("\n".join(results))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
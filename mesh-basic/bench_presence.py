@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Messages for one leaf, and what it costs to know where every leaf is.
+
+`--nodes` nodes are linked as in bench_routing.py. For each count in
+`--leaves`, that many leaf ids are registered, spread over the nodes
+(through `register_leaf_client`, with stand-ins for the sockets), then
+`--churn` of them disconnect and connect again under new ids. Reported,
+for the presence control messages of all nodes (`mesh.presence`):
+
+* join:     bytes sent until every node knows every leaf, and how long
+* churn:    bytes sent for the churn, against sending the node's whole
+            set instead of each change (same messages, each the size of
+            a snapshot)
+* refresh:  bytes for one round of the periodic keep-alive
+
+Then one real websocket leaf per node, with its own id, takes turns with
+the others sending `send_to` a random other leaf, and then plain
+messages that every leaf gets. Reported: send to arrival latency and
+node links crossed per message.
+
+    python bench_presence.py --nodes 10 --leaves 1000 10000 100000
+'''
+
+# Python
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import random
+import time
+# Tornado
+from tornado.websocket import websocket_connect
+# Local
+from mesh.node import MeshNodeServer
+from bench_routing import make_links, links_up, percentile
+
+
+class FakeRequest:
+
+    remote_ip = '127.0.0.1'
+
+
+class FakeLeaf:
+
+    ''' Stands in for a leaf socket; nothing is sent to these '''
+
+    request = FakeRequest()
+    ws_connection = None
+
+    def close(self):
+        pass
+
+
+def presence_bytes(servers):
+    return sum( s.presence.stats['sent_bytes'] for s in servers )
+
+def presence_sends(servers):
+    return sum( s.presence.stats['sent'] for s in servers )
+
+async def settle(servers, expected, limit=120):
+    ''' Wait for every node to know `expected` other leaves; seconds taken '''
+    t0 = time.perf_counter()
+    while time.perf_counter()-t0 < limit:
+        if all( len(s.presence.owners) == expected-len(s.leaves) for s in servers ):
+            break
+        await asyncio.sleep(0.05)
+    return time.perf_counter()-t0
+
+async def control_plane(servers, count, args, rng):
+    nodes = len(servers)
+    bytes0 = presence_bytes(servers)
+    leaves = []
+    for n in range(count):
+        server = servers[n%nodes]
+        leaves.append((server,server.register_leaf_client(FakeLeaf(),f"user-{n:06d}").id))
+    join_time = await settle(servers,count)
+    join_bytes = presence_bytes(servers)-bytes0
+
+    bytes0,sends0 = presence_bytes(servers),presence_sends(servers)
+    seqs0 = [ s.presence.seq for s in servers ]
+    churn = max(1,round(args.churn*count))
+    for n in range(churn):
+        idx = rng.randrange(len(leaves))
+        server,leaf_idx = leaves[idx]
+        server.unregister_leaf_client(leaf_idx)
+        leaves[idx] = (server,server.register_leaf_client(FakeLeaf(),f"user-{count+n:06d}").id)
+        if n%args.churn_batch == 0:
+            await asyncio.sleep(0.01)
+    await asyncio.sleep(3*servers[0].presence.delay)
+    await settle(servers,count)
+    churn_bytes = presence_bytes(servers)-bytes0
+    sends = presence_sends(servers)-sends0
+    announced = [ s.presence.seq-seq for s,seq in zip(servers,seqs0) ]
+    snapshots = [ len(json.dumps(s.presence._snapshot(s.node_id),separators=(',',':'))) for s in servers ]
+    per_announce = sends/sum(announced) if sum(announced) else 0
+    full_bytes = sum( a*size*per_announce for a,size in zip(announced,snapshots) )
+
+    bytes0 = presence_bytes(servers)
+    for server in servers:
+        server.presence._on_refresh()
+    await asyncio.sleep(0.5)
+    refresh_bytes = presence_bytes(servers)-bytes0
+
+    return (f"  {count:>6} leaves | join {join_bytes/1e6:7.2f}MB in {join_time:5.2f}s"
+        f" | churn {churn} deltas {churn_bytes/1e3:8.1f}KB vs full sets {full_bytes/1e6:8.2f}MB"
+        f" | refresh {refresh_bytes/1e3:5.1f}KB"), leaves
+
+async def unicast(servers, args, base_port, rng):
+    count = len(servers)
+    arrivals = {} # message => [(leaf, time)]
+    sockets = []
+    for i in range(count):
+        def on_message(msg, i=i):
+            if msg is None:
+                return
+            if msg.startswith('{"jsonrpc"'):
+                msg = json.loads(msg)
+                if msg.get('method') != 'direct':
+                    return
+                msg = msg['params']['data']
+            if msg.startswith('m'):
+                arrivals.setdefault(msg,[]).append((i,time.time()))
+        sockets.append(await websocket_connect(f"ws://localhost:{base_port+i}/api/ws/leaf/?leaf_id=bench-{i}",
+            on_message_callback=on_message))
+    await settle(servers,sum( len(s.leaves) for s in servers ))
+
+    results = []
+    for mode in ('send_to','broadcast'):
+        for server in servers:
+            server.router.reset_stats()
+        arrivals.clear()
+        sent = {}
+        for n in range(args.messages):
+            sender = n%count
+            name = f"m{n}"
+            if mode == 'send_to':
+                to = rng.choice([ i for i in range(count) if i != sender ])
+                sent[name] = (sender,to,time.time())
+                sockets[sender].write_message(json.dumps(dict(jsonrpc='2.0',method='send_to',
+                    params=dict(to=f"bench-{to}",data=name))))
+            else:
+                sent[name] = (sender,None,time.time())
+                sockets[sender].write_message(name)
+            await asyncio.sleep(0.002)
+        await asyncio.sleep(1)
+
+        latencies = []
+        stray = missing = 0
+        for name,(sender,to,t0) in sent.items():
+            got = [ (i,t) for i,t in arrivals.get(name,()) if i != sender ]
+            if to is not None:
+                stray += sum( 1 for i,t in got if i != to )
+                missing += not any( i == to for i,t in got )
+            latencies += [ t-t0 for i,t in got if to is None or i == to ]
+        node_sends = sum( s.router.stats['sent'] for s in servers )
+        line = (f"  {mode:<9} | latency p50 {1000*percentile(latencies,50):6.2f}ms"
+            f" p99 {1000*percentile(latencies,99):6.2f}ms | hops/msg {node_sends/args.messages:6.1f}")
+        if mode == 'send_to':
+            line += f" | missing {missing}, {stray} stray"
+        results.append(line)
+
+    for socket in sockets:
+        socket.close()
+    return results
+
+async def run(count, args, base_port, rng):
+    servers = [ MeshNodeServer("localhost",base_port+i) for i in range(args.nodes) ]
+    for server in servers:
+        server.start()
+    links = make_links(args.nodes,args.degree,rng)
+    for a,b in links:
+        servers[a].connect_to(base_port+b)
+    while not links_up(servers,links):
+        await asyncio.sleep(0.05)
+
+    result,leaves = await control_plane(servers,count,args,rng)
+    results = [result]+await unicast(servers,args,base_port,rng)
+
+    for server in servers:
+        await server.on_shutdown()
+    await asyncio.sleep(0.5)
+    return results
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--leaves', type=int, nargs='+', default=[1000,10000,100000])
+    parser.add_argument('--churn', type=float, default=0.01, help='share of the leaves replaced')
+    parser.add_argument('--churn-batch', type=int, default=10, help='replaced per loop iteration')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--port', type=int, default=9500)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    rng = random.Random(1)
+    print(f"{args.nodes} nodes, about {args.degree} links each, {100*args.churn:g}% churn:")
+    for idx,count in enumerate(args.leaves):
+        # The nodes print as links come and go
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = await run(count,args,args.port+100*idx,rng)
+        print("\n".join(results))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Delivery latency and duplicate rate of mesh routing.
+
+For each size, that many `MeshNodeServer`s run in this process, linked in
+a ring plus random chords (about `--degree` links per node), with one leaf
+on each. Leaves take turns sending, and every other leaf records when
+each message arrives. Reported:
+
+* delivered: deliveries per leaf per message (1.00 = exactly once)
+* latency:   send to arrival, over all leaves
+* hops:      node links crossed per message (node to node sends)
+* dup rate:  share of envelopes received by nodes that were duplicates
+
+    python bench_routing.py --nodes 3 10 50
+    python bench_routing.py --nodes 3 10 50 --both-ends
+'''
+
+# Python
+import asyncio
+import contextlib
+import io
+import logging
+import random
+import time
+# Tornado
+from tornado.websocket import websocket_connect
+# Local
+from mesh.node import MeshNodeServer
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1,int(len(values)*pct/100))]
+
+def make_links(count, degree, rng):
+    ''' A ring plus random chords, never linking a pair twice '''
+    links = { (i,(i+1)%count) for i in range(count) } if count > 2 else {(0,1)}
+    pairs = { frozenset(l) for l in links }
+    wanted = max(0,count*degree//2-len(links))
+    attempts = 0
+    while wanted > 0 and attempts < 100*count:
+        attempts += 1
+        a,b = rng.sample(range(count),2)
+        if frozenset((a,b)) in pairs:
+            continue
+        pairs.add(frozenset((a,b)))
+        links.add((a,b))
+        wanted -= 1
+    return links
+
+def links_up(servers, links):
+    ''' Every node has finished the handshake on one link per neighbour '''
+    degree = [0]*len(servers)
+    for a,b in { frozenset(l) for l in links }:
+        degree[a] += 1
+        degree[b] += 1
+    return all( len(s.live_node_addrs) == d and len(s.node_connections_by_addr) == d
+        for s,d in zip(servers,degree) )
+
+async def run_mesh(count, degree, messages, base_port, rng, both_ends=False):
+    servers = [ MeshNodeServer("localhost",base_port+i) for i in range(count) ]
+    for server in servers:
+        server.start()
+    links = make_links(count,degree,rng)
+    for a,b in links:
+        servers[a].connect_to(base_port+b)
+        if both_ends:
+            servers[b].connect_to(base_port+a)
+    while not links_up(servers,links):
+        await asyncio.sleep(0.05)
+
+    arrivals = {} # message => [arrival times]
+    leaves = []
+    for i in range(count):
+        def on_message(msg, i=i):
+            if msg is None or not msg.startswith('m'):
+                return
+            arrivals.setdefault(msg.split(' ')[0],[]).append((i,time.time()))
+        leaves.append(await websocket_connect(f"ws://localhost:{base_port+i}/api/ws/leaf/",
+            on_message_callback=on_message))
+    await asyncio.sleep(0.2)
+
+    sent = {}
+    for n in range(messages):
+        sender = n%count
+        name = f"m{n}"
+        sent[name] = (sender,time.time())
+        leaves[sender].write_message(f"{name} {sent[name][1]}")
+        await asyncio.sleep(0.002)
+    await asyncio.sleep(1)
+
+    latencies = []
+    deliveries = 0
+    for name,(sender,t0) in sent.items():
+        for i,t in arrivals.get(name,()):
+            if i != sender:
+                deliveries += 1
+                latencies.append(t-t0)
+    node_sends = sum( s.router.stats['sent'] for s in servers )
+    received = sum( s.router.stats['received'] for s in servers )
+    duplicates = sum( s.router.stats['duplicates'] for s in servers )
+
+    result = (f"  {count:>3} nodes {len(links):>4} links"
+          f" | delivered {deliveries/(messages*(count-1)):.2f}"
+          f" | latency p50 {1000*percentile(latencies,50):6.2f}ms p99 {1000*percentile(latencies,99):6.2f}ms"
+          f" | hops/msg {node_sends/messages:6.1f}"
+          f" | dup rate {duplicates/received if received else 0:.2f}")
+
+    for leaf in leaves:
+        leaf.close()
+    for server in servers:
+        await server.on_shutdown()
+    await asyncio.sleep(0.5)
+    return result
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[3,10,50])
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--both-ends', action='store_true',
+        help='both nodes of each link dial the other; the handshake keeps one link')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    rng = random.Random(1)
+    for idx,count in enumerate(args.nodes):
+        # The nodes print as links come and go
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = await run_mesh(count,args.degree,args.messages,args.port+100*idx,rng,args.both_ends)
+        print(result)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Cost and reach of each forwarding strategy on the same mesh.
+
+One mesh per size (ring plus random chords, see `bench_routing.py`), with
+a leaf on every node. Each strategy in turn is set on every node, given
+time to settle, and then leaves take turns sending. Reported:
+
+* sent/delivered: node to node sends per message delivered to a node
+* KB/msg:         bytes on node links per message
+* reach:          share of (message, node) pairs delivered
+* converge:       time from send until the last node's leaf has it
+
+    python bench_strategies.py --nodes 50 200
+'''
+
+# Python
+import asyncio
+import contextlib
+import io
+import logging
+import random
+import time
+# Tornado
+from tornado.websocket import websocket_connect
+# Local
+from mesh.node import MeshNodeServer
+from mesh.strategies import make_strategy
+from bench_routing import percentile, make_links, links_up
+
+
+STRATEGIES = [
+    ('flood',{}),
+    ('tree',{}),
+    ('gossip',dict(fanout=2)),
+    ('gossip',dict(fanout=3))
+]
+
+async def run_mesh(count, degree, messages, base_port, rng, out):
+    servers = [ MeshNodeServer("localhost",base_port+i) for i in range(count) ]
+    for server in servers:
+        server.start()
+    links = make_links(count,degree,rng)
+    for a,b in links:
+        servers[a].connect_to(base_port+b)
+    while not links_up(servers,links):
+        await asyncio.sleep(0.05)
+
+    arrivals = {} # message => [(leaf, arrival time)]
+    leaves = []
+    for i in range(count):
+        def on_message(msg, i=i):
+            if msg is None or not msg.startswith('m'):
+                return
+            arrivals.setdefault(msg.split(' ')[0],[]).append((i,time.time()))
+        leaves.append(await websocket_connect(f"ws://localhost:{base_port+i}/api/ws/leaf/",
+            on_message_callback=on_message))
+
+    print(f"{count} nodes, {len(links)} links:",file=out)
+    for name,options in STRATEGIES:
+        for server in servers:
+            server.set_strategy(make_strategy(name,**options))
+        await asyncio.sleep(3)
+        for server in servers:
+            server.router.reset_stats()
+        arrivals.clear()
+
+        sent = {}
+        for n in range(messages):
+            sender = rng.randrange(count)
+            msg = f"m{n}"
+            sent[msg] = (sender,time.time())
+            leaves[sender].write_message(f"{msg} x")
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(2)
+
+        reached = 0
+        converge = []
+        for msg,(sender,t0) in sent.items():
+            times = [ t for i,t in arrivals.get(msg,()) if i != sender ]
+            reached += len(times)
+            if len(times) == count-1:
+                converge.append(max(times)-t0)
+        node_sends = sum( s.router.stats['sent'] for s in servers )
+        node_bytes = sum( s.router.stats['bytes_sent'] for s in servers )
+        delivered = sum( s.router.stats['delivered'] for s in servers )
+        label = name+''.join(f' {k}={v}' for k,v in options.items())
+        converge_text = (f"p50 {1000*percentile(converge,50):6.1f}ms p99 {1000*percentile(converge,99):6.1f}ms"
+            if converge else "no message reached every node")
+        print(f"  {label:<16} sent/delivered {node_sends/max(1,delivered):5.2f}"
+              f" | KB/msg {node_bytes/messages/1024:6.2f}"
+              f" | reach {reached/(messages*(count-1)):6.1%}"
+              f" | converge {converge_text}",file=out)
+
+    for leaf in leaves:
+        leaf.close()
+    for server in servers:
+        await server.on_shutdown()
+    await asyncio.sleep(0.5)
+
+async def main():
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[50,200])
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--port', type=int, default=9400)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    rng = random.Random(1)
+    for idx,count in enumerate(args.nodes):
+        # The nodes print as links come and go
+        with contextlib.redirect_stdout(io.StringIO()):
+            await run_mesh(count,args.degree,args.messages,args.port+300*idx,rng,sys.stderr)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
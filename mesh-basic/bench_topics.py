@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Node link traffic for topic publications vs whole-mesh messages.
+
+`--nodes` nodes are linked as in bench_routing.py, with one leaf each. The
+leaves on `--subscribed` of the nodes subscribe to one of `--rooms` topics
+("room.<n>"), then every leaf takes turns publishing to random rooms.
+Compared with the same number of plain messages, which every node
+forwards and every leaf gets. Reported:
+
+* hops/msg:    node links crossed per message
+* recipients:  leaves written to per message
+* delivered:   subscribers reached per publication they should get
+                (1.00 = every one, exactly once), and deliveries to
+                leaves that did not subscribe
+
+    python bench_topics.py --nodes 10 50 --subscribed 0.1
+'''
+
+# Python
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import random
+# Tornado
+from tornado.websocket import websocket_connect
+# Local
+from mesh.node import MeshNodeServer
+from bench_routing import make_links, links_up
+
+
+def call(method, params, call_id=None):
+    msg = dict(jsonrpc='2.0',method=method,params=params)
+    if call_id is not None:
+        msg['id'] = call_id
+    return json.dumps(msg)
+
+async def run_mesh(count, args, base_port, rng):
+    servers = [ MeshNodeServer("localhost",base_port+i) for i in range(count) ]
+    for server in servers:
+        server.start()
+    links = make_links(count,args.degree,rng)
+    for a,b in links:
+        servers[a].connect_to(base_port+b)
+    while not links_up(servers,links):
+        await asyncio.sleep(0.05)
+
+    received = [ [] for _ in range(count) ]
+    leaves = []
+    for i in range(count):
+        def on_message(msg, i=i):
+            if msg is None or not msg.startswith('{"jsonrpc"'):
+                if msg is not None and msg.startswith('m'):
+                    received[i].append(msg)
+                return
+            msg = json.loads(msg)
+            if msg.get('method') == 'message':
+                received[i].append(msg['params']['data'])
+        leaves.append(await websocket_connect(f"ws://localhost:{base_port+i}/api/ws/leaf/",
+            on_message_callback=on_message))
+
+    rooms = {} # leaf => room
+    for i in rng.sample(range(count),max(1,round(args.subscribed*count))):
+        rooms[i] = rng.randrange(args.rooms)
+        leaves[i].write_message(call('subscribe',f"room.{rooms[i]}",call_id=1))
+    # Let the interest spread
+    await asyncio.sleep(0.5)
+
+    results = []
+    for mode in ('plain','topic'):
+        for server in servers:
+            server.router.reset_stats()
+        for r in received:
+            r.clear()
+        sent = {}
+        for n in range(args.messages):
+            sender = n%count
+            name = f"m{n}"
+            if mode == 'plain':
+                leaves[sender].write_message(name)
+            else:
+                room = rng.randrange(args.rooms)
+                sent[name] = room
+                leaves[sender].write_message(call('publish',dict(topic=f"room.{room}",data=name)))
+            await asyncio.sleep(0.002)
+        await asyncio.sleep(1)
+
+        node_sends = sum( s.router.stats['sent'] for s in servers )
+        recipients = sum( len(r) for r in received )
+        line = (f"  {count:>3} nodes {mode:<5} | hops/msg {node_sends/args.messages:6.1f}"
+            f" | recipients/msg {recipients/args.messages:6.2f}")
+        if mode == 'topic':
+            expected = sum( 1 for room in sent.values() for r in rooms.values() if r == room )
+            got = sum( 1 for i,names in enumerate(received) for name in names
+                if i in rooms and sent[name] == rooms[i] )
+            stray = sum( 1 for i,names in enumerate(received) for name in names
+                if i not in rooms or sent[name] != rooms[i] )
+            line += f" | delivered {got/expected if expected else 1:.2f}, {stray} stray"
+        results.append(line)
+
+    for leaf in leaves:
+        leaf.close()
+    for server in servers:
+        await server.on_shutdown()
+    await asyncio.sleep(0.5)
+    return results
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10,50])
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--subscribed', type=float, default=0.1,
+        help='share of the nodes with a subscribed leaf')
+    parser.add_argument('--rooms', type=int, default=2)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--port', type=int, default=9400)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    rng = random.Random(1)
+    print(f"subscribers on {100*args.subscribed:.0f}% of the nodes, {args.rooms} rooms:")
+    for idx,count in enumerate(args.nodes):
+        # The nodes print as links come and go
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = await run_mesh(count,args,args.port+100*idx,rng)
+        print("\n".join(results))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
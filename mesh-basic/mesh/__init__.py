@@ -0,0 +1,10 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import sys
+from pathlib import Path
+
+# The shared websocket tooling (`wscommon`) lives at the repo root
+_REPO_ROOT = str(Path(__file__).resolve().parents[2])
+if _REPO_ROOT not in sys.path:
+    sys.path.insert(0,_REPO_ROOT)
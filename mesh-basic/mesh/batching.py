@@ -0,0 +1,66 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+
+
+'''
+Coalescing of the frames written to one node link.
+
+Without it every envelope is its own websocket frame and socket write.
+A `LinkBatcher` holds frames written during the same loop iteration (or,
+with `window_us`, for that many microseconds) and sends them as one batch
+frame, unpacked on the other end by `mesh.codec.iter_frames`. A batch is
+sent early once it reaches `max_bytes` or `max_frames`, so the added
+latency and memory stay bounded. A lone frame is sent as is.
+'''
+
+
+class LinkBatcher:
+
+    def __init__(self, send, codec, window_us=0, max_bytes=64*1024, max_frames=512):
+        self.send = send  # send(data) writes one binary message on the link
+        self.codec = codec
+        self.window_us = window_us
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.pending = []
+        self.pending_bytes = 0
+        self.handle = None
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def write(self, frame):
+        self.pending.append(frame)
+        self.pending_bytes += len(frame)
+        self.frames_in += 1
+        if self.pending_bytes >= self.max_bytes or len(self.pending) >= self.max_frames:
+            self.flush()
+        elif self.handle is None:
+            loop = asyncio.get_running_loop()
+            if self.window_us:
+                self.handle = loop.call_later(self.window_us/1e6,self.flush)
+            else:
+                self.handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        self.frames_out += 1
+        if len(pending) == 1:
+            self.send(pending[0])
+        else:
+            self.send(self.codec.encode_batch(pending))
+
+    def discard(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.pending = []
+        self.pending_bytes = 0
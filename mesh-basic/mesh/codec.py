@@ -0,0 +1,204 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import base64
+import json
+import struct
+# Local
+from .routing import Control, Envelope
+
+
+'''
+Wire formats for node to node messages.
+
+`BinaryCodec` (the default) sends binary websocket frames:
+
+    version   u8    1
+    type      u8    0 envelope, 1 control, 2 batch
+    hdr_len   u16   bytes before the payload
+    flags     u8    0x01 payload is binary, 0x02 has a topic, 0x04 is for one leaf
+    ttl       u8
+    hops      u8
+    origin_n  u8    length of origin
+    msg_id    u64
+    origin    origin_n bytes, utf-8
+    topic_n   u8    with flag 0x02: length of topic
+    topic     topic_n bytes, utf-8
+    to_n      u8    with flag 0x04: length of the leaf id
+    to        to_n bytes, utf-8
+    ...       (room for later header fields, skipped by hdr_len)
+    payload   the rest; a control's payload is its JSON body
+
+A node forwarding an envelope only rewrites ttl and hops: the rest of the
+received frame is passed through without decoding or copying the payload.
+The payload reaches local leaves as a memoryview of the received frame.
+
+A batch carries several frames in one websocket message, each as a u32
+length and the frame, after a header with no origin and the count as
+msg_id. `iter_frames` yields the frames of a batch, or a lone frame as is.
+
+A frame that is short or does not add up raises ValueError from
+`decode_message`, as malformed JSON does; a batch that does not is
+passed on whole by `iter_frames` for `decode_message` to refuse.
+
+`JsonCodec` is the earlier text format, kept for peers that only speak it
+and for comparison. `decode_message` takes either, by frame type.
+'''
+
+VERSION = 1
+TYPE_ENVELOPE = 0
+TYPE_CONTROL = 1
+TYPE_BATCH = 2
+FLAG_BINARY = 0x01
+FLAG_TOPIC = 0x02
+FLAG_TO = 0x04
+
+_FIXED = struct.Struct('!BBHBBBBQ')
+_TTL_HOPS = struct.Struct('!BB')
+_TTL_OFFSET = 5
+_LENGTH = struct.Struct('!I')
+
+
+class BinaryCodec:
+
+    name = 'binary'
+    binary = True
+
+    def encode(self, env):
+        raw = env.raw
+        if raw is not None and raw[0] == VERSION:
+            # Forwarding: new ttl and hops, everything else as received
+            return b''.join((raw[:_TTL_OFFSET],_TTL_HOPS.pack(env.ttl,env.hops),
+                memoryview(raw)[_TTL_OFFSET+2:]))
+        payload = env.payload
+        if isinstance(payload,str):
+            payload = payload.encode('utf-8')
+        flags = FLAG_BINARY if env.binary else 0
+        extra = b''
+        if env.topic is not None:
+            topic = env.topic.encode('utf-8')
+            flags |= FLAG_TOPIC
+            extra = bytes((len(topic),))+topic
+        if env.to is not None:
+            to = env.to.encode('utf-8')
+            flags |= FLAG_TO
+            extra += bytes((len(to),))+to
+        return self._pack(TYPE_ENVELOPE,flags,env.ttl,env.hops,env.origin,env.id,payload,extra)
+
+    def encode_control(self, kind, body):
+        payload = json.dumps({'c':kind,'b':body}).encode('utf-8')
+        return self._pack(TYPE_CONTROL,0,0,0,'',0,payload)
+
+    def _pack(self, type_, flags, ttl, hops, origin, msg_id, payload, extra=b''):
+        origin = origin.encode('utf-8')
+        hdr_len = _FIXED.size+len(origin)+len(extra)
+        return b''.join((_FIXED.pack(VERSION,type_,hdr_len,flags,ttl,hops,len(origin),msg_id),
+            origin,extra,payload))
+
+    def decode(self, data):
+        try:
+            version,type_,hdr_len,flags,ttl,hops,origin_n,msg_id = _FIXED.unpack_from(data)
+        except struct.error:
+            raise ValueError(f'Short frame ({len(data)} bytes)')
+        if version != VERSION:
+            raise ValueError(f'Unsupported envelope version {version}')
+        if type_ not in (TYPE_ENVELOPE,TYPE_CONTROL):
+            raise ValueError(f'Unexpected frame type {type_}')
+        if hdr_len > len(data):
+            raise ValueError(f'Header of {hdr_len} bytes in a {len(data)} byte frame')
+        payload = memoryview(data)[hdr_len:]
+        if type_ == TYPE_CONTROL:
+            d = json.loads(bytes(payload))
+            return Control(d['c'],d['b'])
+        offset = _FIXED.size+origin_n
+        origin = str(data[_FIXED.size:offset],'utf-8')
+        binary = bool(flags & FLAG_BINARY)
+        topic = to = None
+        if flags & FLAG_TOPIC:
+            topic,offset = _field(data,offset,hdr_len)
+        if flags & FLAG_TO:
+            to,offset = _field(data,offset,hdr_len)
+        if offset > hdr_len:
+            raise ValueError(f'Header fields overrun its {hdr_len} bytes')
+        return Envelope(origin,msg_id,ttl,hops,payload,binary,raw=data,topic=topic,to=to)
+
+
+    def encode_batch(self, frames):
+        parts = [_FIXED.pack(VERSION,TYPE_BATCH,_FIXED.size,0,0,0,0,len(frames))]
+        for frame in frames:
+            parts.append(_LENGTH.pack(len(frame)))
+            parts.append(frame)
+        return b''.join(parts)
+
+
+def _field(data, offset, hdr_len):
+    ''' A u8 length and that many utf-8 bytes, within the header; and the offset after it '''
+    if offset >= hdr_len:
+        raise ValueError(f'Header fields overrun its {hdr_len} bytes')
+    end = offset+1+data[offset]
+    return str(data[offset+1:end],'utf-8'),end
+
+def iter_frames(data):
+    if isinstance(data,str) or len(data) < _FIXED.size or data[1] != TYPE_BATCH:
+        yield data
+        return
+    view = memoryview(data)
+    offset = start = view[2]<<8|view[3]
+    end = len(view)
+    # Check the lengths add up before yielding any
+    while offset < end:
+        if offset+_LENGTH.size > end:
+            break
+        (size,) = _LENGTH.unpack_from(view,offset)
+        offset += _LENGTH.size+size
+    if offset != end:
+        yield data
+        return
+    offset = start
+    while offset < end:
+        (size,) = _LENGTH.unpack_from(view,offset)
+        offset += _LENGTH.size
+        yield view[offset:offset+size]
+        offset += size
+
+
+class JsonCodec:
+
+    name = 'json'
+    binary = False
+
+    def encode(self, env):
+        payload = env.payload
+        d = {'o':env.origin,'i':env.id,'t':env.ttl,'h':env.hops}
+        if env.topic is not None:
+            d['k'] = env.topic
+        if env.to is not None:
+            d['r'] = env.to
+        if env.binary:
+            d['b'] = base64.b64encode(payload).decode('ascii')
+        else:
+            d['p'] = payload if isinstance(payload,str) else bytes(payload).decode('utf-8')
+        return json.dumps(d)
+
+    def encode_control(self, kind, body):
+        return json.dumps({'c':kind,'b':body})
+
+    def decode(self, data):
+        d = json.loads(data)
+        if 'c' in d:
+            return Control(d['c'],d['b'])
+        if 'b' in d:
+            return Envelope(d['o'],d['i'],d['t'],d['h'],base64.b64decode(d['b']),True,
+                topic=d.get('k'),to=d.get('r'))
+        return Envelope(d['o'],d['i'],d['t'],d['h'],d['p'],topic=d.get('k'),to=d.get('r'))
+
+
+BINARY = BinaryCodec()
+JSON = JsonCodec()
+CODECS = { c.name: c for c in (BINARY,JSON) }
+
+def decode_message(data):
+    ''' An `Envelope` or a `Control`, from what a node link received '''
+    if isinstance(data,str):
+        return JSON.decode(data)
+    return BINARY.decode(data)
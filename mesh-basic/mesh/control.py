@@ -0,0 +1,177 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+import time
+# Local
+from .handshake import keeps_outgoing
+from .strategies import make_strategy
+
+
+'''
+Actions on a running node, posted as JSON to `/api/http/control/action`.
+
+One action, or a list of them run concurrently:
+
+    {"action": "connect", "node": "localhost:8702"}
+    {"actions": [{"action": "connect", "port": 8702}, ...], "parallelism": 16, "timeout": 10}
+
+* connect:       dial a node ("node": "host:port", or "port" and "host")
+                 and wait until the link is up
+* disconnect:    drop the link to a node, whichever side dialed it
+* apply:         make "links" (a list of nodes) the node's neighbours,
+                 connecting what is missing and, once those links are
+                 up (or the action times out), disconnecting the rest.
+                 With "both_ends": true, the other end of each link gets
+                 the same request, so only one end dials.
+* drain:         refuse new leaves and close the ones connected, so they
+                 reconnect elsewhere; with "links": true, drop the node
+                 links too. `undrain` takes leaves again.
+* set_strategy:  switch forwarding strategy, {"name": "gossip",
+                 "options": {"fanout": 4}}; see `mesh.strategies`
+* status:        the node's status, as `dump_status`
+
+At most `parallelism` actions of a request run at a time, each for at
+most `timeout` seconds. The response has a result per action, in order,
+with how long it took:
+
+    {"success": true, "ms": 12.3, "results": [{"action": "connect", "success": true, "ms": 12.1, "result": {...}}]}
+
+A node both ends are told to `connect` is dialed by both; the handshake
+keeps one link. A connect that times out leaves the node dialing, as the
+peer may yet come up; `disconnect` stops it.
+'''
+
+ACTIONS = {}
+
+
+class ControlError(Exception):
+    pass
+
+
+def control_action(name):
+    def decorate(fn):
+        ACTIONS[name] = fn
+        return fn
+    return decorate
+
+def parse_target(params):
+    ''' (host, port, node id) from {"node": "host:port"} or {"port": ..., "host": ...} '''
+    target = params.get('node')
+    if target is not None:
+        host,_,port = str(target).rpartition(':')
+    else:
+        host,port = params.get('host','localhost'),params.get('port')
+    try:
+        port = int(port)
+    except (TypeError,ValueError):
+        raise ControlError('a node is "node": "host:port", or "port" and "host"')
+    if not host:
+        raise ControlError(f'no host in {target!r}')
+    return host,port,f"{host}:{port}"
+
+async def run_actions(node, actions, parallelism=16, timeout=10.0):
+    ''' The results of `actions`, at most `parallelism` at a time '''
+    slots = asyncio.Semaphore(parallelism)
+
+    async def run(params):
+        async with slots:
+            t0 = time.perf_counter()
+            name = params.get('action') if isinstance(params,dict) else None
+            result = dict(action=name,success=False)
+            try:
+                fn = ACTIONS.get(name)
+                if fn is None:
+                    raise ControlError(f'Unknown action: {name}')
+                result['result'] = await asyncio.wait_for(fn(node,params),timeout)
+                result['success'] = True
+            except asyncio.TimeoutError:
+                result['error'] = f'timed out after {timeout}s'
+            except ControlError as err:
+                result['error'] = str(err)
+            result['ms'] = round(1000*(time.perf_counter()-t0),3)
+            return result
+
+    return await asyncio.gather(*( run(params) for params in actions ))
+
+
+#-- Actions ----------------------------------------#
+
+@control_action('connect')
+async def connect(node, params):
+    host,port,addr = parse_target(params)
+    if addr == node.node_id:
+        raise ControlError('a node does not link to itself')
+    node.connect_to(port,host)
+    await node.wait_for_link(addr)
+    return dict(node=addr)
+
+@control_action('disconnect')
+async def disconnect(node, params):
+    host,port,addr = parse_target(params)
+    linked = addr in node.outgoing or addr in node.node_connections_by_addr
+    if linked:
+        node.disconnect_from(addr)
+    return dict(node=addr,changed=linked)
+
+@control_action('apply')
+async def apply(node, params):
+    links = params.get('links')
+    if not isinstance(links,list):
+        raise ControlError('"links" is a list of nodes')
+    wanted = {}
+    for target in links:
+        if isinstance(target,int):
+            target = dict(port=target)
+        host,port,addr = parse_target(target if isinstance(target,dict) else dict(node=target))
+        if addr != node.node_id:
+            wanted[addr] = (host,port)
+    current = set(node.outgoing)|set(node.node_connections_by_addr)
+    dropped = sorted(current-set(wanted))
+    added = sorted( addr for addr in wanted if addr not in node.live_node_addrs )
+    for addr in added:
+        host,port = wanted[addr]
+        # The end the handshake would keep dials
+        if not params.get('both_ends') or keeps_outgoing(node.node_id,addr):
+            node.connect_to(port,host)
+    try:
+        # New links first, so routes can move over before the old ones go
+        await asyncio.gather(*( node.wait_for_link(addr) for addr in added ))
+    finally:
+        for addr in dropped:
+            node.disconnect_from(addr)
+    return dict(connected=added,disconnected=dropped,links=sorted(node.live_node_addrs))
+
+@control_action('drain')
+async def drain(node, params):
+    node.draining = True
+    leaves = len(node.leaves)
+    for handler in node.leaves.handlers():
+        handler.close(1001,'draining')
+    while len(node.leaves):
+        await asyncio.sleep(0.01)
+    links = sorted(node.live_node_addrs) if params.get('links') else []
+    for addr in links:
+        node.disconnect_from(addr)
+    return dict(leaves=leaves,disconnected=links)
+
+@control_action('undrain')
+async def undrain(node, params):
+    node.draining = False
+    return dict(draining=False)
+
+@control_action('set_strategy')
+async def set_strategy(node, params):
+    options = params.get('options') or {}
+    if not isinstance(options,dict):
+        raise ControlError('"options" is an object')
+    try:
+        strategy = make_strategy(params.get('name'),**options)
+    except (ValueError,TypeError) as err:
+        raise ControlError(str(err))
+    node.set_strategy(strategy)
+    return strategy.status()
+
+@control_action('status')
+async def status(node, params):
+    return node.dump_status()
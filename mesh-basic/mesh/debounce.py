@@ -0,0 +1,48 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Tornado
+from tornado.ioloop import IOLoop
+
+
+'''
+Doing something once for a burst of reasons to do it.
+
+A `Debounce` calls its function `delay` seconds after the last `touch`,
+so a burst of touches makes one call however long it goes on, up to
+`max_wait` after the first. The routing tables use it to answer the
+many links of a reshaped mesh going down with one resend.
+'''
+
+
+class Debounce:
+
+    def __init__(self, fn, delay, max_wait=None):
+        self.fn = fn
+        self.delay = delay
+        self.max_wait = 10*delay if max_wait is None else max_wait
+        self.calls = 0
+        self._first = None
+        self._handle = None
+
+    def touch(self):
+        loop = IOLoop.current()
+        now = loop.time()
+        if self._handle is None:
+            self._first = now
+        else:
+            loop.remove_timeout(self._handle)
+        self._handle = loop.call_at(min(now+self.delay,self._first+self.max_wait),self._fire)
+
+    def cancel(self):
+        if self._handle is not None:
+            IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+
+    @property
+    def pending(self):
+        return self._handle is not None
+
+    def _fire(self):
+        self._handle = None
+        self.calls += 1
+        self.fn()
@@ -0,0 +1,50 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+
+'''
+What two nodes agree on when a link between them opens.
+
+Each side sends a `hello` control message, as JSON text so any peer can
+read it, with its node id and capabilities:
+
+* codecs:      wire formats it reads, preferred first
+* batch:       whether it unpacks batch frames
+* compression: whether its node links use permessage-deflate
+* topics:      whether it routes publications by interest (`mesh.interest`)
+* presence:    whether it routes messages for one leaf (`mesh.presence`)
+
+A link carries mesh traffic only once the peer's hello has arrived. If
+both nodes dialed each other, both keep the link dialed by the lower node
+id and close the other, so each pair of nodes shares one link.
+
+`bye` tells the peer that this side is disconnecting on purpose, so it
+does not dial back.
+'''
+
+HELLO = 'hello'
+BYE = 'bye'
+
+
+def capabilities(codecs, compression):
+    return dict(codecs=list(codecs),batch=True,compression=compression,topics=True,presence=True)
+
+def negotiate(ours, theirs):
+    '''
+    The terms this side writes a link with: the first of our codecs the
+    peer reads, batches if it is binary and the peer unpacks them. The two
+    sides can end up writing different codecs when their preferences
+    differ; that is fine, as `decode_message` reads either by frame type.
+    '''
+    codec = 'json'
+    for name in ours['codecs']:
+        if name in theirs.get('codecs',()):
+            codec = name
+            break
+    return dict(
+        codec=codec,
+        batch=codec == 'binary' and bool(theirs.get('batch')),
+        compression=ours['compression'] and bool(theirs.get('compression')))
+
+def keeps_outgoing(node_id, peer_id):
+    ''' When both ends dialed, whether `node_id` keeps the link it dialed '''
+    return node_id < peer_id
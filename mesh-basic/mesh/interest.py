@@ -0,0 +1,260 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import time
+# Tornado
+from tornado.ioloop import IOLoop, PeriodicCallback
+# Local
+from wscommon.topics import TopicIndex
+from .debounce import Debounce
+
+
+'''
+Which topics each node's leaves want, and which link leads to them.
+
+Every node floods its leaves' subscription patterns (`wscommon.topics`)
+through the mesh as an `interest` control message:
+
+    {"entries": [{"node": "localhost:8701", "version": 1650000000123, "patterns": ["chat.#"]}]}
+
+A node keeps the newest version of each other node's entry, passes on
+the ones that are news to it, and notes the link each came in on first.
+That link is on the quickest path back to the node that sent it, so a
+publication is only forwarded on the links leading to nodes with a
+matching pattern. One that no other node wants never leaves its node.
+Entries count the links they cross (`hops`), and a node also notes the
+links the same version comes in on from neighbours nearer to its node.
+
+Entries are sent again when the patterns change (a short `delay`
+coalesces bursts), in full to a neighbour whose link comes up, and every
+`refresh` seconds. Entries not refreshed in three times that expire.
+
+A link going down moves the routes that went over it to such a link:
+being nearer, that neighbour's own route cannot run back through here.
+Entries left with no route, whose nodes other nodes may also have lost
+routes to, need a resync. Either end then floods a resync request naming
+those nodes, `{"resync": {"node": ..., "id": ..., "nodes": [...]}}`, on
+which they send their entry again, so the routes are found afresh over
+the links that are left. Both wait until there has been no call for them
+for `resync_delay` (see `mesh.debounce`), so the links of a reshaped
+mesh going down make one request and one resend each. Until then, what
+matches a node without a route is forwarded on every link. Peers that
+did not offer `topics` in the handshake are sent every publication.
+'''
+
+INTEREST = 'interest'
+
+
+def _check(body):
+    ''' Raise ValueError unless `body` is a well formed interest message '''
+    def strings(value):
+        return isinstance(value,list) and all( isinstance(v,str) for v in value )
+    if not isinstance(body,dict):
+        raise ValueError(f'Malformed interest message: {body!r}')
+    resync = body.get('resync')
+    if resync is not None:
+        if not (isinstance(resync,dict) and isinstance(resync.get('node'),str)
+                and type(resync.get('id')) is int and strings(resync.get('nodes',[]))):
+            raise ValueError(f'Malformed interest resync: {resync!r}')
+        return
+    entries = body.get('entries',[])
+    if not isinstance(entries,list):
+        raise ValueError(f'Malformed interest entries: {entries!r}')
+    for item in entries:
+        if not (isinstance(item,dict) and isinstance(item.get('node'),str)
+                and type(item.get('version')) is int and type(item.get('hops',0)) is int
+                and strings(item.get('patterns'))):
+            raise ValueError(f'Malformed interest entry: {item!r}')
+
+
+class InterestEntry:
+
+    __slots__ = ('version','patterns','via','hops','alternates','expires')
+
+    def __init__(self, version, patterns, via, expires):
+        self.version = version
+        self.patterns = patterns
+        self.via = via
+        self.hops = 0 # links crossed to get here, less one
+        self.alternates = set() # links from nodes nearer to it than this one
+        self.expires = expires
+
+
+class InterestTable:
+
+    def __init__(self, refresh=30.0, delay=0.05, resync_delay=0.5):
+        self.refresh = refresh
+        self.delay = delay
+        self.resync_delay = resync_delay
+        self.entries = {} # node id => InterestEntry
+        self.index = TopicIndex() # node id => its patterns
+        self.version = 0
+        self.resync_id = 0
+        self.resyncs = {} # node id => last resync id seen from it
+        self.stats = dict(adverts_sent=0,adverts_received=0,entries_updated=0,expired=0,
+            rerouted=0,routed=0,flooded=0,unwanted=0)
+        self._lost = set() # node ids whose route went with a link
+        self._pending = None
+        self._resync_request = Debounce(self._resync,resync_delay)
+        self._resync_answer = Debounce(self.changed,resync_delay)
+
+    def attach(self, node):
+        self.node = node
+        self.timer = PeriodicCallback(self._on_refresh,1000*self.refresh)
+        self.timer.start()
+
+    def detach(self):
+        self.timer.stop()
+        if self._pending is not None:
+            IOLoop.current().remove_timeout(self._pending)
+            self._pending = None
+        self._resync_request.cancel()
+        self._resync_answer.cancel()
+
+    #-- Our own patterns ----------------------------------------#
+
+    def changed(self):
+        ''' Our leaves' patterns changed; send them after `delay` '''
+        if self._pending is None:
+            self._pending = IOLoop.current().call_later(self.delay,self._advertise)
+
+    def _own_entry(self):
+        return dict(node=self.node.node_id,version=self.version,
+            patterns=sorted(self.node.topics.patterns()))
+
+    def _advertise(self):
+        self._pending = None
+        # Milliseconds, so a restarted node still counts up from before
+        self.version = max(self.version+1,int(1000*time.time()))
+        self._send(self.node.live_node_addrs,[self._own_entry()])
+
+    def _send(self, addrs, entries):
+        body = dict(entries=entries)
+        for addr in list(addrs):
+            self.node.send_control(addr,INTEREST,body)
+            self.stats['adverts_sent'] += 1
+
+    #-- Links ----------------------------------------#
+
+    def on_link_up(self, addr):
+        entries = [ dict(node=node_id,version=e.version,patterns=sorted(e.patterns),hops=e.hops+1)
+            for node_id,e in self.entries.items() ]
+        if self.version:
+            entries.append(self._own_entry())
+        if entries:
+            self._send([addr],entries)
+
+    def on_link_down(self, addr):
+        for node_id,entry in self.entries.items():
+            entry.alternates.discard(addr)
+            # Nodes without patterns need no route
+            if entry.via == addr and entry.patterns:
+                if entry.alternates:
+                    entry.via = entry.alternates.pop()
+                    self.stats['rerouted'] += 1
+                else:
+                    self._lost.add(node_id)
+        if self._lost:
+            # One request for the links that go down meanwhile
+            self._resync_request.touch()
+
+    def _resync(self):
+        live = self.node.live_node_addrs
+        # Some may have found another route meanwhile
+        lost = sorted( n for n in self._lost if n in self.entries and self.entries[n].via not in live )
+        self._lost.clear()
+        if lost:
+            self.resync_id = max(self.resync_id+1,int(1000*time.time()))
+            self.resyncs[self.node.node_id] = self.resync_id
+            self._send_resync(dict(node=self.node.node_id,id=self.resync_id,nodes=lost),None)
+
+    def _send_resync(self, resync, from_addr):
+        for addr in list(self.node.live_node_addrs):
+            if addr != from_addr:
+                self.node.send_control(addr,INTEREST,dict(resync=resync))
+        # Only the nodes that lost a route need to send again; all, from a peer that does not say
+        if self.node.node_id in resync.get('nodes',(self.node.node_id,)):
+            self._resync_answer.touch()
+
+    def on_control(self, addr, body):
+        # All checked before any is applied: stored, a bad version or id
+        # would break every later comparison with it
+        _check(body)
+        resync = body.get('resync')
+        if resync is not None:
+            if resync['id'] > self.resyncs.get(resync['node'],0):
+                self.resyncs[resync['node']] = resync['id']
+                self._send_resync(resync,addr)
+            return
+        self.stats['adverts_received'] += 1
+        me = self.node.node_id
+        news = []
+        expires = time.monotonic()+3*self.refresh
+        for item in body.get('entries',()):
+            node_id = item['node']
+            if node_id == me:
+                continue
+            entry = self.entries.get(node_id)
+            hops = item.get('hops',0)
+            if entry is not None and entry.version >= item['version']:
+                # A node nearer to it than this one has no route through
+                # here, so it can take over from `via` without making a loop
+                if entry.version == item['version'] and addr != entry.via and hops <= entry.hops:
+                    entry.alternates.add(addr)
+                continue
+            patterns = set(item['patterns'])
+            if entry is None:
+                entry = self.entries[node_id] = InterestEntry(item['version'],set(),addr,expires)
+            self._set_patterns(node_id,entry,patterns)
+            entry.version = item['version']
+            entry.via = addr
+            entry.hops = hops
+            entry.alternates = set()
+            entry.expires = expires
+            self.stats['entries_updated'] += 1
+            news.append(dict(item,hops=hops+1))
+        if news:
+            self._send([ a for a in self.node.live_node_addrs if a != addr ],news)
+
+    def _set_patterns(self, node_id, entry, patterns):
+        for pattern in entry.patterns-patterns:
+            self.index.unsubscribe(pattern,node_id)
+        for pattern in patterns-entry.patterns:
+            try:
+                self.index.subscribe(pattern,node_id)
+            except ValueError:
+                pass
+        entry.patterns = patterns
+
+    def _on_refresh(self):
+        now = time.monotonic()
+        for node_id in [ n for n,e in self.entries.items() if e.expires < now ]:
+            self.index.unsubscribe_all(node_id)
+            del self.entries[node_id]
+            self.stats['expired'] += 1
+        self._advertise()
+
+    #-- Forwarding ----------------------------------------#
+
+    def targets(self, topic, from_addr):
+        ''' The links to pass a publication on `topic` on to '''
+        live = self.node.live_node_addrs
+        links = self.node.node_connections_by_addr
+        addrs = { a for a in live if a != from_addr and not links[a].caps.get('topics') }
+        for node_id in self.index.match(topic):
+            via = self.entries[node_id].via
+            if via not in live:
+                # The route went with a link; everywhere, until a refresh finds another
+                self.stats['flooded'] += 1
+                return [ a for a in live if a != from_addr ]
+            if via != from_addr:
+                addrs.add(via)
+        if addrs:
+            self.stats['routed'] += 1
+        else:
+            self.stats['unwanted'] += 1
+        return list(addrs)
+
+    def status(self):
+        return dict(version=self.version,nodes=len(self.entries),
+            patterns=sorted(self.index.patterns()),**self.stats)
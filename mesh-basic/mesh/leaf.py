@@ -1,49 +1,62 @@
 # Copyright 2022 Jeffrey LeBlanc
 
 # Python
-import asyncio
-import signal
-import logging
-import datetime
-import secrets
-import uuid
-# Tornado
-import tornado.web
-from tornado.websocket import websocket_connect
-from tornado.httpclient import HTTPRequest, HTTPClientError
-
-
-class MeshLeafClient:
-
-    def __init__(self, name, url):
+from urllib.parse import quote
+# Local
+from wscommon.outbox import Outbox
+from wscommon.reconnect import ReconnectingClient
+from wscommon.rpc import RpcClientMixin
+from wscommon.topics import TopicClientMixin
+
+
+class MeshLeafClient(TopicClientMixin, RpcClientMixin, ReconnectingClient):
+
+    '''
+    Besides messages for the other leaves, `await leaf.call(method, params)`
+    calls the node, e.g. `call('status')`, and `await leaf.subscribe('chat.#')`
+    and `leaf.publish('chat.room1', data)` use the mesh's topics. With a
+    `leaf_id`, other leaves anywhere in the mesh can `send_to` this one.
+    '''
+
+    def __init__(self, name, url, compression=None, backoff=None, limiter=None, outbox=None, acks=True,
+            heartbeat=None, leaf_id=None):
+        if leaf_id is not None:
+            url += ('&' if '?' in url else '?')+'leaf_id='+quote(leaf_id,safe='')
+        # Messages sent while reconnecting are held and, with acks, resent until the node has them
+        super().__init__(url,compression=compression,backoff=backoff,limiter=limiter,
+            outbox=Outbox() if outbox is None else outbox,acks=acks,heartbeat=heartbeat)
         self.name = name
-        self.url = url
-        self.conn = None
-
-    async def start(self):
-        while True:
-            try:
-                request = HTTPRequest(url=self.url,request_timeout=5)
-                self.conn = await websocket_connect(url=request)
-                print(f"leaf {self.name} connected")
-                while True:
-                    msg = await self.conn.read_message()
-                    if msg is None: break
-                    self.on_message(msg)
-            except HTTPClientError as err:
-                self.conn = None
-            except ConnectionRefusedError as err:
-                self.conn = None
-            finally:
-                self.conn = None
-
-            await asyncio.sleep(1)
+        self.leaf_id = leaf_id
+
+    def on_open(self):
+        print(f"leaf {self.name} connected")
+        self.resubscribe()
 
     def on_message(self, msg):
+        msg = self.rpc_receive(msg)
+        if msg is None:
+            return
         print(f"leaf[{self.name}] recv:",msg)
 
+    def on_publication(self, topic, data):
+        print(f"leaf[{self.name}] {topic}:",data)
+
+    async def send_to(self, leaf_id, data, timeout=10.0):
+        ''' Send `data` to the leaf `leaf_id`; the nodes it went to, none if it is not connected '''
+        return await self.call('send_to',{'to': leaf_id,'data': data},timeout=timeout)
+
+    def on_rpc_notification(self, method, params):
+        if method == 'direct':
+            self.on_direct(params['from'],params['data'])
+        else:
+            super().on_rpc_notification(method,params)
+
+    def on_direct(self, sender, data):
+        print(f"leaf[{self.name}] from {sender}:",data)
+
+    def on_close(self):
+        self.rpc_connection_lost()
+
     def send_msg(self, msg):
-        if self.conn is None: return
         print(f"leaf[{self.name}] send:",msg)
-        self.conn.write_message(msg)
-
+        self.write_message(msg)
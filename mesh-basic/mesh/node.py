@@ -2,140 +2,341 @@
 
 # Python
 import asyncio
+import hmac
+import json
 import signal
 import logging
 import datetime
 import secrets
-import uuid
+import time
 # Tornado
 import tornado.web
-from tornado.websocket import websocket_connect
-from tornado.httpclient import HTTPRequest, HTTPClientError
+from tornado.web import HTTPError
+from tornado.websocket import WebSocketClosedError
+# Local
+from wscommon.broadcast import Broadcaster
+from wscommon.compression import CompressionPolicyMixin, LINK_POLICY
+from wscommon.heartbeat import Heartbeat, HeartbeatMixin, rtt_ms
+from wscommon.metrics import Metrics, MetricsHandler, MetricsMixin, connection_metrics, stats_metrics
+from wscommon.registry import ConnectionRegistry, buffered
+from wscommon.outbox import Outbox
+from wscommon.reconnect import Backoff, ConnectLimiter, ReconnectingClient
+from wscommon.resume import ResumableMixin, ResumeSessions
+from wscommon.rpc import RpcError, INVALID_PARAMS, RpcMixin, rpc_method, encode
+from wscommon.topics import TopicIndex, TopicsMixin, encode_publication
+from .batching import LinkBatcher
+from .control import run_actions
+from .codec import BINARY, JSON, CODECS, decode_message, iter_frames
+from .handshake import HELLO, BYE, capabilities, negotiate, keeps_outgoing
+from .interest import INTEREST, InterestTable
+from .presence import PRESENCE, PresenceTable
+from .routing import Control, MeshRouter
+from .strategies import FloodStrategy, make_strategy
+
+
+# The notification a leaf gets for a `send_to` another leaf made
+DIRECT = 'direct'
 
 
 #-- Leaf Connection Handlers ----------------------------------------#
 
-class MeshLeafConnectionHandler(tornado.websocket.WebSocketHandler):
+class MeshLeafConnectionHandler(MetricsMixin, RpcMixin, TopicsMixin, ResumableMixin, HeartbeatMixin,
+        CompressionPolicyMixin, tornado.websocket.WebSocketHandler):
 
     def prepare(self):
-        pass
+        if self.application.draining:
+            raise HTTPError(503,"draining")
+        # Other leaves reach this one by its id; see `mesh.presence`
+        self.leaf_id = self.get_argument("leaf_id",None)
+        if self.leaf_id is not None and not 0 < len(self.leaf_id.encode('utf-8')) <= 255:
+            raise HTTPError(400,"leaf_id is 1 to 255 bytes")
+
+    def get_compression_policy(self):
+        return self.application.leaf_compression
 
     def open(self):
-        self.wc_uuid = self.application.register_leaf_client(self)
+        leaf = self.application.register_leaf_client(self,self.leaf_id)
+        self.leaf_idx = leaf.id
+        self.leaf_id = leaf.name
+        self.start_heartbeat()
         self.write_message("welcome")
 
     def on_message(self, message):
         # print("MeshLeafConnectionHandler:on_message",message)
+        message = self.rpc_receive(self.resume_receive(self.count_received(message)))
+        if message is None:
+            return
         self.application.on_leaf_client_msg(self,message)
 
+    @rpc_method('echo')
+    def rpc_echo(self, params):
+        return params
+
+    @rpc_method('status')
+    def rpc_status(self, params):
+        return self.application.dump_status()
+
+    @rpc_method('send_to')
+    def rpc_send_to(self, params):
+        '''
+        {"to": leaf id, "data": ...}, delivered as a `direct` notification.
+        Returns the nodes it went to, none if no such leaf is connected.
+        '''
+        if not isinstance(params,dict) or not isinstance(params.get('to'),str):
+            raise RpcError(INVALID_PARAMS,'send_to takes {"to": leaf id, "data": ...}')
+        self.application.send_to(params['to'],
+            encode(method=DIRECT,params={'from': self.leaf_id,'data': params.get('data')}))
+        return self.application.whereis(params['to'])
+
+    @rpc_method('whereis')
+    def rpc_whereis(self, params):
+        ''' The nodes a leaf id is connected to '''
+        if not isinstance(params,str):
+            raise RpcError(INVALID_PARAMS,'whereis takes a leaf id')
+        return self.application.whereis(params)
+
     def on_close(self):
-        self.application.unregister_leaf_client(self.wc_uuid)
-        print(f'WebSocket Leaf {self.wc_uuid} closed {self}')
+        self.application.unregister_leaf_client(self.leaf_idx)
+        print(f'WebSocket Leaf {self.leaf_idx} closed {self}')
 
 
 #-- Node Connection Handlers ----------------------------------------#
 
-class MeshNodeConnectionClient:
+class MeshNodeConnectionClient(ReconnectingClient):
 
-    def __init__(self, master, name, url):
+    def __init__(self, master, name, url, addr=None):
+        # No acks: the router drops whatever arrives twice, and flooding
+        # usually brings it in over another link anyway. The peer ignores
+        # anything before the hello, so the queue waits for the handshake
+        super().__init__(url,compression=master.node_compression,
+            backoff=Backoff(base=0.5,cap=10),limiter=master.dial_limiter,
+            outbox=Outbox(max_messages=10000,max_bytes=8<<20),heartbeat=master.ws_heartbeat,
+            hold_outbox=True)
         self.master = master
         self.name = name
-        self.url = url
-        self.conn = None
+        self.addr = addr
+        self.link = None
 
-    async def start(self):
-        while True:
-            try:
-                request = HTTPRequest(url=self.url,request_timeout=5)
-                self.conn = await websocket_connect(url=request)
-                print(self.name,"connected to",self.url)
-                while True:
-                    msg = await self.conn.read_message()
-                    if msg is None:
-                        break
-                    # If we introduce a bug in the following call, it blocks
-                    self.on_incoming_message(msg)
-            except HTTPClientError as err:
-                logging.error("Client error %s",err)
-                self.conn = None
-            except ConnectionRefusedError as err:
-                logging.error("Client error %s",err)
-                self.conn = None
-            finally:
-                self.conn = None
-
-            await asyncio.sleep(1)
-        logging.info("not connected anymore")
+    def on_open(self):
+        print(self.name,"connected to",self.url)
+        self.master.on_node_transport_open(self.link)
+
+    def on_message(self, msg):
+        # If we introduce a bug in the following call, it blocks
+        self.on_incoming_message(msg)
+
+    def on_close(self):
+        self.master.on_node_transport_closed(self.link)
+
+    def on_connect_error(self, err):
+        logging.error("Client error %s",err)
 
     def on_incoming_message(self, msg):
-        self.master.on_ws_client_msg(self.name,msg)
+        self.link.messages_in += 1
+        self.link.bytes_in += len(msg)
+        for frame in iter_frames(msg):
+            self.master.on_node_msg(self.link,frame)
+
+def init_link(link, outgoing):
+    ''' Link state, filled in by the handshake '''
+    link.outgoing = outgoing
+    link.peer_id = None
+    link.caps = {}
+    link.codec = JSON
+    link.batch = False
+    link.opened = None # when the transport opened, for the handshake time
+    link.messages_in = link.bytes_in = link.messages_out = link.bytes_out = 0
 
-    def write_message(self, msg):
-        if self.conn is None: return
-        self.conn.write_message(msg)
 
 class MeshNodeConnectionOutgoing:
 
-    def __init__(self, conn, conn_task):
+    def __init__(self, conn, conn_task, target=None):
         self.conn = conn
         self.conn_task = conn_task
+        self.target = target
+        init_link(self,True)
+        conn.link = self
 
-    def write_message(self, message):
-        self.conn.write_message(message)
+    def write_message(self, message, binary=False):
+        self.conn.write_message(message,binary=binary)
 
+    def close(self):
+        self.conn.close()
 
-class MeshNodeConnectionHandler(tornado.websocket.WebSocketHandler):
+
+class MeshNodeConnectionHandler(HeartbeatMixin, CompressionPolicyMixin, tornado.websocket.WebSocketHandler):
 
     def prepare(self):
+        # Only informative, the peer's id comes with its hello
         self.addr = self.get_argument("from_addr",None)
         logging.info("From: %s",self.addr)
+        init_link(self,False)
+
+    def get_compression_policy(self):
+        return self.application.node_compression
 
     def open(self):
-        self.application.register_node_client(self.addr,self)
+        self.start_heartbeat()
+        self.application.on_node_transport_open(self)
 
     def on_message(self, message):
-        self.application.on_node_client_msg(self,message)
+        self.messages_in += 1
+        self.bytes_in += len(message)
+        for frame in iter_frames(message):
+            self.application.on_node_msg(self,frame)
 
     def on_close(self):
-        self.application.unregister_node_client(self.addr)
+        self.application.on_node_transport_closed(self)
         logging.info(f'Node Client {self.addr} closed {self}')
 
 #-- Control Plane Handlers ----------------------------------------#
 
 class ControlActionHandler(tornado.web.RequestHandler):
 
-    def post(self):
-        pass
+    ''' See `mesh.control` '''
+
+    def prepare(self):
+        token = self.application.control_token
+        if token is not None:
+            t0 = time.perf_counter()
+            given = self.request.headers.get("Authorization","")
+            allowed = hmac.compare_digest(given.encode('utf-8'),f"Bearer {token}".encode('utf-8'))
+            self.application.control_auth.labels('ok' if allowed else 'forbidden').observe(time.perf_counter()-t0)
+            if not allowed:
+                self.set_status(403)
+                self.finish(dict(success=False,error='Bad or missing control token'))
+
+    async def post(self):
+        try:
+            body = json.loads(self.request.body or b'null')
+        except ValueError:
+            body = None
+        if not isinstance(body,dict):
+            self.set_status(400)
+            self.write(dict(success=False,error='Expected a JSON object'))
+            return
+        actions = body.get('actions',[body])
+        parallelism = body.get('parallelism',16)
+        timeout = body.get('timeout',10.0)
+        if (not isinstance(actions,list) or not isinstance(parallelism,int) or parallelism < 1
+                or not isinstance(timeout,(int,float)) or timeout <= 0):
+            self.set_status(400)
+            self.write(dict(success=False,error='"actions" is a list, "parallelism" and "timeout" positive'))
+            return
+        t0 = time.perf_counter()
+        results = await run_actions(self.application,actions,parallelism,timeout)
+        self.write(dict(success=all( r['success'] for r in results ),
+            ms=round(1000*(time.perf_counter()-t0),3),results=results))
 
 
 #-- Mesh Node Server ----------------------------------------#
 
 class MeshNodeServer(tornado.web.Application):
 
-    def __init__(self, hostname, port):
+    def __init__(self, hostname, port, batch_window_us=None, batch_max_bytes=64*1024,
+            node_compression=LINK_POLICY, leaf_compression=None, codecs=('binary','json'),
+            heartbeat_interval=20.0, heartbeat_timeout=10.0, interest_refresh=30.0,
+            presence_refresh=30.0, control_token=None, metrics_token=None):
+        '''
+        `batch_window_us` turns on coalescing of node link writes: 0 batches
+        what is written in the same loop iteration, more waits that long.
+        `node_compression` and `leaf_compression` are the
+        `wscommon.compression.CompressionPolicy` of each kind of link, None
+        for uncompressed. Node links compress what is over 1KB by default,
+        leaves (local and CPU bound) do not. `codecs` are the node link
+        wire formats offered in the handshake, preferred first. Leaves and
+        node links are pinged every `heartbeat_interval` seconds and dropped
+        if they do not answer within `heartbeat_timeout` (None for no pings).
+        Nodes resend their leaves' topic subscriptions every
+        `interest_refresh` seconds (see `mesh.interest`), and tell each
+        other their leaves are still there every `presence_refresh` (see
+        `mesh.presence`). With a `control_token`, control actions (see
+        `mesh.control`) need an "Authorization: Bearer <token>" header.
+        `/metrics` serves counters for Prometheus (see `wscommon.metrics`).
+        With a `metrics_token` it needs that as a bearer token, and then
+        also has series for each leaf and link, which name them.
+        '''
         # Attributes
         self.hostname = hostname
         self.port = port
+        self.node_id = f"{hostname}:{port}"
+        self.control_token = control_token
+        self.draining = False # refusing leaves, see `mesh.control`
+
+        # Counters, served at /metrics
+        self.metrics = Metrics('mesh')
+        self.metrics_token = metrics_token
+        self.metrics_per_connection = metrics_token is not None
+        self.loop_lag = None
+        self.control_auth = self.metrics.histogram('control_auth_seconds',
+            'Time to check a control request token, by result',labels=('result',))
+        self.handshake_time = self.metrics.histogram('link_handshake_seconds',
+            'Time from a node link opening to the peer\'s hello').labels()
+        self.node_fanout = self.metrics.histogram('node_fanout_seconds',
+            'Time to encode a message and write it to the node links it goes to').labels()
 
         # Connection tracking
-        self.leaf_clients_by_uuid = {}
-        self.node_connections_by_addr = {}
+        self.resume_sessions = ResumeSessions(ttl=60)
+        self.ws_heartbeat = None if heartbeat_interval is None else Heartbeat(heartbeat_interval,heartbeat_timeout)
+        self.node_connections_by_addr = {} # peer node id => link, once it said hello
+        self.outgoing = {} # node id => MeshNodeConnectionOutgoing dialing it
+        self.broadcaster = Broadcaster(max_outstanding=1<<20,policy='drop',
+            fanout=self.metrics.histogram('leaf_fanout_seconds',
+                'Time to write a message to the local leaves it goes to').labels())
+        self.interest = InterestTable(refresh=interest_refresh)
+        self.topics = TopicIndex(on_change=self.interest.changed) # pattern => leaves
+        self.leaves = ConnectionRegistry(topics=self.topics) # by id, and by leaf id as `name`
+        self.presence = PresenceTable(refresh=presence_refresh)
+        self.router = MeshRouter(self.node_id)
+        self.live_node_addrs = set()
+        self._link_waiters = {} # (node id, up) => futures
+        self.capabilities = capabilities(codecs,node_compression is not None)
+        self.strategy = None
+        self.node_compression = node_compression
+        self.leaf_compression = leaf_compression
+        self.batch_window_us = batch_window_us
+        self.batch_max_bytes = batch_max_bytes
+        self.link_batchers = {}
+        # Shared by the node's dialers, so they do not all retry at once
+        self.dial_limiter = ConnectLimiter(rate=20)
 
         # Handlers
         _handlers = [
             (r"^/api/ws/leaf/?$",MeshLeafConnectionHandler),
             (r"^/api/ws/node/?$",MeshNodeConnectionHandler),
-            (r"^/api/http/control/action/?$",ControlActionHandler)
+            (r"^/api/http/control/action/?$",ControlActionHandler),
+            (r"^/metrics/?$",MetricsHandler)
         ]
 
+        self.metrics.collect(connection_metrics(self.leaves,'leaf',self.metrics_per_connection))
+        self.metrics.collect(self._link_metrics)
+        self.metrics.collect(stats_metrics('router',self.router.stats,'Mesh messages'))
+        self.metrics.collect(stats_metrics('interest',self.interest.stats,'Topic interest table'))
+        self.metrics.collect(stats_metrics('presence',self.presence.stats,'Leaf presence table'))
+
         super().__init__(_handlers)
 
     def start(self):
+        self.set_strategy(FloodStrategy())
+        self.interest.attach(self)
+        self.presence.attach(self)
+        self.loop_lag = self.metrics.loop_lag()
         self.listen(self.port)
 
     async def on_shutdown(self):
-        for handler in self.ws_clients.values():
+        self.strategy.detach()
+        self.interest.detach()
+        self.presence.detach()
+        if self.loop_lag is not None:
+            self.loop_lag.stop()
+        for handler in self.leaves.handlers():
             handler.close()
+        for cn in list(self.outgoing.values()):
+            cn.close()
+        for cn in list(self.node_connections_by_addr.values()):
+            cn.close()
+        if self.ws_heartbeat is not None:
+            self.ws_heartbeat.wheel.stop()
 
     def debug(self, *args):
         print(f"{self.port} =>",*args)
@@ -143,85 +344,391 @@ class MeshNodeServer(tornado.web.Application):
     #-- Status ------------------------------------------------#
 
     def dump_status(self):
-        status = dict(self=str(self.port), leaf=[], node={})
-        for leaf in self.leaf_clients_by_uuid.values():
-            status["leaf"].append("client")
-        for addr,conn in self.node_connections_by_addr.items():
-            status["node"][str(addr)] = str(type(conn))
+        status = dict(self=str(self.port), leaf=[], node={}, routing=self.router.status(),
+            strategy=self.strategy.status(), draining=self.draining)
+        for leaf in self.leaves:
+            status["leaf"].append(dict(id=leaf.id,leaf_id=leaf.name,remote=leaf.remote,
+                rtt_ms=rtt_ms(leaf.handler)))
+        status["leaf_memory"] = self.leaves.memory()
+        for addr,link in self.node_connections_by_addr.items():
+            status["node"][addr] = dict(direction='out' if link.outgoing else 'in',
+                codec=link.codec.name,batch=link.batch,caps=link.caps,
+                rtt_ms=rtt_ms(link.conn if link.outgoing else link))
+            if link.outgoing:
+                status["node"][addr]["outbox"] = link.conn.outbox.status()
+        status["topics"] = self.topics.status()
+        status["interest"] = self.interest.status()
+        status["presence"] = self.presence.status()
+        status["resume_sessions"] = len(self.resume_sessions)
+        if self.ws_heartbeat is not None:
+            status["heartbeat"] = self.ws_heartbeat.status()
+        status["dialing"] = sorted( addr for addr in self.outgoing
+            if addr not in self.node_connections_by_addr )
+        status["batching"] = { addr: dict(frames_in=b.frames_in,frames_out=b.frames_out)
+            for addr,b in self.link_batchers.items() }
+        status["leaf_traffic"] = self.leaves.traffic()
+        status["broadcaster"] = self.broadcaster.status()
         return status
 
+    def _link_metrics(self):
+        ''' Node link families for `self.metrics`, read when scraped '''
+        links = list(self.node_connections_by_addr.items())
+        traffic = [ (dict(peer=addr),link) for addr,link in links ]
+        outboxes = [ (dict(peer=addr),link.conn.outbox) for addr,link in links if link.outgoing ]
+        families = [
+            ('links','gauge','Node links up',[({},len(links))]),
+            ('dialing','gauge','Nodes being dialed with no link up yet',
+                [({},sum( addr not in self.node_connections_by_addr for addr in self.outgoing ))]),
+            ('leaf_outstanding_bytes','gauge','Bytes written to leaves and not yet sent',
+                [({},self.broadcaster.status()['outstanding'])]),
+            ('leaf_dropped_total','counter','Messages not sent to a leaf too far behind',
+                [({},self.broadcaster.dropped)]),
+            ('resume_sessions','gauge','Leaf sessions kept to resume',[({},len(self.resume_sessions))]),
+            ('presence_pending_changes','gauge','Leaf ids changed here and not yet announced',
+                [({},len(self.presence._adds)+len(self.presence._removes))]),
+        ]
+        if self.metrics_per_connection:
+            for field,help in (('messages_in','Websocket messages received'),('bytes_in','Bytes received'),
+                    ('messages_out','Websocket messages sent'),('bytes_out','Bytes sent')):
+                families.append((f'link_{field}_total','counter',f'{help} on a node link',
+                    [ (labels,getattr(link,field)) for labels,link in traffic ]))
+            families.append(('link_write_buffer_bytes','gauge','Bytes written to a node link and not yet sent',
+                [ (labels,buffered(link.conn.conn if link.outgoing else link)) for labels,link in traffic ]))
+            families.append(('link_outbox_messages','gauge','Messages queued for a dialed node link',
+                [ (labels,len(outbox)) for labels,outbox in outboxes ]))
+            families.append(('link_outbox_bytes','gauge','Bytes queued for a dialed node link',
+                [ (labels,outbox.nbytes) for labels,outbox in outboxes ]))
+            families.append(('link_outbox_dropped_total','counter','Messages a full outbox dropped',
+                [ (labels,outbox.dropped) for labels,outbox in outboxes ]))
+            families.append(('link_batch_pending_bytes','gauge','Bytes waiting to go out in a batch',
+                [ (dict(peer=addr),b.pending_bytes) for addr,b in self.link_batchers.items() ]))
+        return families
+
     #-- Leaf Tracking ------------------------------------------------#
 
-    def register_leaf_client(self, handler):
-        wc_uuid = uuid.uuid4()
-        self.leaf_clients_by_uuid[wc_uuid] = handler
-        return wc_uuid
+    def register_leaf_client(self, handler, leaf_id=None):
+        '''
+        Track a leaf connection, under `leaf_id` or one made up here.
+        Returns its `wscommon.registry.Connection`.
+        '''
+        leaf = self.leaves.add(handler,remote=handler.request.remote_ip,name=leaf_id)
+        if leaf_id is None:
+            self.leaves.update(leaf.id,name=f"{self.node_id}#{leaf.id}")
+        if len(self.leaves.by('name',leaf.name)) == 1:
+            self.presence.leaf_up(leaf.name)
+        return leaf
 
     def on_leaf_client_msg(self, sender, message):
         # Respond to the sender
-        sender.write_message(f"ECHO: {message}")
+        self.broadcaster.send(sender,f"ECHO: {message}")
 
-        # Write to the other local leaf clients
-        for wc in self.leaf_clients_by_uuid.values():
-            if wc == sender: continue
-            wc.write_message(message)
+        # Write to the other local leaf clients, encoding the frame once
+        self.broadcaster.broadcast(self.leaves.handlers(),message,exclude=sender)
 
         # Push to the other connected nodes
-        for cn in self.node_connections_by_addr.values():
-            if isinstance(cn,MeshNodeConnectionOutgoing):
-                cn.write_message(message)
-            if isinstance(cn,MeshNodeConnectionHandler):
-                cn.write_message(message)
+        self.send_to_nodes(self.router.originate(message))
 
-    def unregister_leaf_client(self, wc_uuid):
-        logging.info('unregister %s wsclient', wc_uuid)
-        self.leaf_clients_by_uuid.pop(wc_uuid,None)
+    def publish(self, topic, data):
+        '''
+        Send `data` to the leaves subscribed to `topic`, here and on the
+        nodes that want it. Returns how many local leaves it was written to.
+        '''
+        message = encode_publication(topic,data)
+        sent = self.broadcaster.broadcast(self.leaves.subscribers(topic),message)
+        self.send_to_nodes(self.router.originate(message,topic=topic))
+        return sent
 
-    #-- Node Connector API ------------------------------------------------#
+    def send_to(self, leaf_id, message):
+        '''
+        Send `message` to the leaves connected as `leaf_id`, here or on
+        the nodes that have one. Returns how many local leaves it was
+        written to.
+        '''
+        sent = self.broadcaster.broadcast([ leaf.handler for leaf in self.leaves.by('name',leaf_id) ],message)
+        if self.presence.owners_of(leaf_id):
+            self.send_to_nodes(self.router.originate(message,to=leaf_id))
+        return sent
+
+    def whereis(self, leaf_id):
+        nodes = list(self.presence.owners_of(leaf_id))
+        if self.leaves.by('name',leaf_id):
+            nodes.append(self.node_id)
+        return sorted(nodes)
+
+    def unregister_leaf_client(self, leaf_idx):
+        logging.info('unregister %s wsclient', leaf_idx)
+        leaf = self.leaves.remove(leaf_idx)
+        if leaf is not None and not self.leaves.by('name',leaf.name):
+            self.presence.leaf_down(leaf.name)
 
-    '''
-    connection could be two part:
-    * http call where we get a key and decide who initiates
-    * then ws with the key as part of the protocol
-    '''
+    #-- Node Connector API ------------------------------------------------#
 
-    def connect_to(self, port):
+    def connect_to(self, port, host='localhost'):
         '''
         Call to connect to another node.
         Generates a `MeshNodeConnectionClient` locally and should
-        spawn a `MeshNodeConnectionHandler` on other end
+        spawn a `MeshNodeConnectionHandler` on other end. The link is used
+        once both sides said hello; see `mesh.handshake`.
+        '''
+        target = f"{host}:{port}"
+        self.debug("connecting to node:",target)
+        if target == self.node_id:
+            return
+        if target in self.outgoing or target in self.node_connections_by_addr:
+            print(f"{self.port} already has {target}")
+            return
+        name = f"node:{target}"
+        url = f"ws://{host}:{port}/api/ws/node/?from_addr={self.node_id}"
+        connector = MeshNodeConnectionClient(self,name,url,addr=target)
+        connector_task = asyncio.create_task(connector.start(),name="client")
+        self.outgoing[target] = MeshNodeConnectionOutgoing(
+            conn= connector, conn_task= connector_task, target= target
+        )
+
+    def disconnect_from(self, port, host='localhost'):
+        '''
+        Drop the link to another node, whichever side dialed it. The peer
+        is told, so it does not dial back.
         '''
-        self.debug("connecting to node:",port)
-        name = f"node:{port}"
-        if name in self.node_connections_by_addr:
-            print(f"{self.port} already has {name}")
+        target = port if isinstance(port,str) and ':' in port else f"{host}:{port}"
+        self.debug("disconnecting from node:",target)
+        batcher = self.link_batchers.get(target)
+        if batcher is not None:
+            # Ahead of the bye, rather than discarded with the link
+            batcher.flush()
+        dialer = self.outgoing.pop(target,None)
+        link = self.node_connections_by_addr.pop(target,None)
+        if link is not None:
+            self._send_raw(link,JSON.encode_control(BYE,dict(node=self.node_id)))
+            self.on_node_link_down(target)
+            link.close()
+        if dialer is not None and dialer is not link:
+            dialer.close()
+
+    def on_node_transport_open(self, link):
+        link.opened = time.perf_counter()
+        # Always JSON text, before either side knows what the other reads
+        self._send_raw(link,JSON.encode_control(HELLO,dict(node=self.node_id,caps=self.capabilities)))
+
+    def on_node_transport_closed(self, link):
+        peer_id = link.peer_id
+        link.peer_id = None
+        if peer_id is not None and self.node_connections_by_addr.get(peer_id) is link:
+            del self.node_connections_by_addr[peer_id]
+            self.debug("disconnected from node:",peer_id)
+            self.on_node_link_down(peer_id)
+
+    def on_hello(self, link, body):
+        if link.peer_id is not None:
+            return
+        peer_id = body.get('node') if isinstance(body,dict) else None
+        caps = body.get('caps',{}) if isinstance(body,dict) else None
+        if not (isinstance(peer_id,str) and isinstance(caps,dict)
+                and isinstance(caps.get('codecs',[]),list)):
+            # Nothing can be negotiated with it, and redialing gets the same
+            logging.warning("bad hello from node link %s: %r",link.addr,body)
+            self._drop_link(link)
+            return
+        if peer_id == self.node_id:
+            return
+        link.peer_id = peer_id
+        if link.opened is not None:
+            self.handshake_time.observe(time.perf_counter()-link.opened)
+        link.caps = caps
+        terms = negotiate(self.capabilities,link.caps)
+        link.codec = CODECS[terms['codec']]
+        link.batch = terms['batch'] and self.batch_window_us is not None
+
+        existing = self.node_connections_by_addr.get(peer_id)
+        if existing is not None:
+            # Both ends dialed; both sides pick the same link to keep
+            if link.outgoing != keeps_outgoing(self.node_id,peer_id):
+                self._drop_link(link)
+                return
+            del self.node_connections_by_addr[peer_id]
+            self.on_node_link_down(peer_id)
+            self._drop_link(existing)
+        self.node_connections_by_addr[peer_id] = link
+        self.debug("connected to node:",peer_id,"codec:",link.codec.name)
+        if link.outgoing:
+            # Queued while the link was down; ahead of what link up sends
+            link.conn.release_outbox()
+        self.on_node_link_up(peer_id)
+
+    def on_bye(self, link):
+        peer_id = link.peer_id
+        dialer = self.outgoing.pop(peer_id,None)
+        if dialer is not None:
+            dialer.close()
+        if self.node_connections_by_addr.get(peer_id) is link:
+            del self.node_connections_by_addr[peer_id]
+            self.on_node_link_down(peer_id)
+        link.close()
+
+    def _drop_link(self, link):
+        ''' Close a redundant link, and stop redialing it if it is ours '''
+        link.peer_id = None
+        if link.outgoing and self.outgoing.get(link.target) is link:
+            del self.outgoing[link.target]
+        link.close()
+
+    def wait_for_link(self, addr, up=True):
+        ''' A future done once the link to node `addr` is up (or down) '''
+        future = asyncio.get_running_loop().create_future()
+        if (addr in self.live_node_addrs) == up:
+            future.set_result(None)
+            return future
+        key = (addr,up)
+        self._link_waiters.setdefault(key,[]).append(future)
+        def forget(future):
+            # Given up on, e.g. a control action timed out
+            waiters = self._link_waiters.get(key)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._link_waiters[key]
+        future.add_done_callback(forget)
+        return future
+
+    def _wake_link_waiters(self, addr, up):
+        for future in self._link_waiters.pop((addr,up),()):
+            if not future.done():
+                future.set_result(None)
+
+    def on_node_link_up(self, addr):
+        self.live_node_addrs.add(addr)
+        self._wake_link_waiters(addr,True)
+        self.strategy.on_link_up(addr)
+        self.interest.on_link_up(addr)
+        self.presence.on_link_up(addr)
+
+    def on_node_link_down(self, addr):
+        self.live_node_addrs.discard(addr)
+        batcher = self.link_batchers.pop(addr,None)
+        if batcher is not None:
+            batcher.discard()
+        self.strategy.on_link_down(addr)
+        self.interest.on_link_down(addr)
+        self.presence.on_link_down(addr)
+        self._wake_link_waiters(addr,False)
+
+    #-- Routing ------------------------------------------------#
+
+    def set_strategy(self, strategy):
+        ''' Switch how messages are forwarded, e.g. `make_strategy('gossip',fanout=4)` '''
+        if isinstance(strategy,str):
+            strategy = make_strategy(strategy)
+        if self.strategy is not None:
+            self.strategy.detach()
+        self.strategy = strategy
+        strategy.attach(self)
+
+    def on_node_msg(self, link, message):
+        from_addr = link.peer_id
+        try:
+            msg = decode_message(message)
+        except (ValueError,KeyError,TypeError) as err:
+            logging.warning("bad message from node %s: %s",from_addr or link.addr,err)
+            return
+        if isinstance(msg,Control):
+            # A peer's malformed control body costs it that one message,
+            # never the link or the node
+            try:
+                if msg.kind == HELLO:
+                    self.on_hello(link,msg.body)
+                elif from_addr is None:
+                    pass
+                elif msg.kind == BYE:
+                    self.on_bye(link)
+                elif msg.kind == INTEREST:
+                    self.interest.on_control(from_addr,msg.body)
+                elif msg.kind == PRESENCE:
+                    self.presence.on_control(from_addr,msg.body)
+                elif msg.kind == self.strategy.name:
+                    self.strategy.on_control(from_addr,msg.body)
+            except (ValueError,KeyError,TypeError,AttributeError) as err:
+                logging.warning("bad %s control from node %s: %r",msg.kind,from_addr or link.addr,err)
+            return
+        if from_addr is None:
+            # Nothing but the hello before the hello
+            return
+        if not self.router.accept(msg):
+            return
+        if msg.to is not None:
+            leaves = [ leaf.handler for leaf in self.leaves.by('name',msg.to) ]
+        elif msg.topic is not None:
+            leaves = self.leaves.subscribers(msg.topic)
+        else:
+            leaves = self.leaves.handlers()
+        self.broadcaster.broadcast(leaves,msg.payload,binary=msg.binary)
+        env = self.router.forward(msg)
+        if env is not None:
+            self.send_to_nodes(env,from_addr=from_addr)
+
+    def send_to_nodes(self, env, from_addr=None):
+        t0 = time.perf_counter()
+        # Encoded once per codec in use on the links
+        encoded = {}
+        sent = nbytes = 0
+        # Publications go where they are wanted and messages for one leaf
+        # to its node, whatever the strategy
+        if env.to is not None:
+            targets = self.presence.targets(env.to,from_addr)
+        elif env.topic is not None:
+            targets = self.interest.targets(env.topic,from_addr)
         else:
-            url = f"ws://localhost:{port}/api/ws/node/?from_addr={self.port}"
-            connector = MeshNodeConnectionClient(self,name,url)
-            connector_task = asyncio.create_task(connector.start(),name="client")
-            self.node_connections_by_addr[str(port)] = MeshNodeConnectionOutgoing(
-                conn= connector, conn_task= connector_task
-            )
-
-    def disconnect_from(self, port):
-        pass
-
-    def register_node_client(self, addr, handler):
-        self.node_connections_by_addr[addr] = handler
-        self.debug("connected to node:",addr)
-
-    def unregister_node_client(self, addr):
-        logging.info('unregister %s wsclient', addr)
-        self.node_connections_by_addr.pop(addr,None)
-
-    def on_node_client_msg(self, sender, message):
-        # print("on_node_client_msg",sender,message)
-        for wc in self.leaf_clients_by_uuid.values():
-            wc.write_message(message)
-
-    def on_ws_client_msg(self, sender, message):
-        # print("on_ws_client_msg",sender,message)
-        for wc in self.leaf_clients_by_uuid.values():
-            wc.write_message(message)
+            targets = self.strategy.targets(env,from_addr)
+        for addr in targets:
+            link = self.node_connections_by_addr.get(addr)
+            if link is None:
+                continue
+            data = encoded.get(link.codec.name)
+            if data is None:
+                data = encoded[link.codec.name] = link.codec.encode(env)
+            if self.write_link(addr,data):
+                sent += 1
+                nbytes += len(data)
+        self.router.count_sent(sent,nbytes)
+        self.node_fanout.observe(time.perf_counter()-t0)
+
+    def send_control(self, addr, kind, body):
+        '''
+        A message for the node at the other end of one link only. Returns
+        its size, 0 if the link is gone.
+        '''
+        link = self.node_connections_by_addr.get(addr)
+        if link is None:
+            return 0
+        data = link.codec.encode_control(kind,body)
+        return len(data) if self.write_link(addr,data) else 0
+
+    def write_link(self, addr, data):
+        link = self.node_connections_by_addr.get(addr)
+        if link is None:
+            return False
+        if not link.batch:
+            return self._send_raw(link,data)
+        batcher = self.link_batchers.get(addr)
+        if batcher is None:
+            batcher = self.link_batchers[addr] = LinkBatcher(
+                lambda data,addr=addr: self._send_link(addr,data),BINARY,
+                window_us=self.batch_window_us,max_bytes=self.batch_max_bytes)
+        batcher.write(data)
+        return True
+
+    def _send_link(self, addr, data):
+        cn = self.node_connections_by_addr.get(addr)
+        if cn is None:
+            return False
+        return self._send_raw(cn,data)
+
+    def _send_raw(self, cn, data):
+        try:
+            cn.write_message(data,binary=not isinstance(data,str))
+        except WebSocketClosedError:
+            return False
+        cn.messages_out += 1
+        cn.bytes_out += len(data)
+        return True
 
 
@@ -0,0 +1,426 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import time
+# Tornado
+from tornado.ioloop import IOLoop, PeriodicCallback
+# Local
+from .debounce import Debounce
+
+
+'''
+Which node each leaf is connected to, and which link leads there.
+
+Leaves connect with an id of their choosing (`?leaf_id=...`, or one the
+node makes up). Every node keeps the set of leaf ids on every other node,
+so a message for one leaf (`MeshNodeServer.send_to`) goes straight to
+the node that has it instead of everywhere.
+
+The sets are sent as changes, never whole, as a `presence` control
+message numbered per node:
+
+    {"node": "localhost:8701", "epoch": 1650000000123, "seq": 42, "add": ["alice"], "remove": ["bob"]}
+
+`epoch` is when the node started, so a restarted node's numbers are not
+taken for old ones. Changes made within `delay` go out together, at most
+`max_batch` ids to a message. Every node applies the next one in
+sequence from each node and passes it on to its other links, noting the
+link it came in on first: that is on the quickest path back to that node.
+Changes count the links they cross (`hops`), and a node also notes the
+links the same change comes in on from neighbours nearer to its node.
+
+A node that finds it missed one (the seq skipped ahead, or a new epoch)
+asks the link it came from for the whole set, `{"want": [node, ...]}`,
+and gets `{"node": ..., "epoch": ..., "seq": ..., "hops": 2, "full": [...]}`;
+any node can answer for any other. Two nodes whose link comes up send
+each other `{"digest": {node: [epoch, seq, hops], ...}}` and ask for
+what is newer; a node that learns of a newer set from a snapshot sends
+its other links a digest of it, so the news spreads as changes do.
+
+Every `refresh` seconds a node sends an empty change, which keeps its
+entry from expiring (after three times that) and its route current. A
+link going down moves the routes over it to a nearer neighbour's link as
+in `mesh.interest`, and for those left with none floods a resync
+request, on which the nodes it names send a change, empty if need be.
+Both wait for a pause of `resync_delay` (see `mesh.debounce`), so the
+links of a reshaped mesh going down make one request and one change
+each; until then, a leaf whose route went with the link is reached by
+sending on every link.
+'''
+
+PRESENCE = 'presence'
+
+
+def _check(body):
+    ''' Raise ValueError unless `body` is a well formed presence message '''
+    def strings(value):
+        return isinstance(value,list) and all( isinstance(v,str) for v in value )
+    def number(value, optional=False):
+        return type(value) is int or (optional and value is None)
+    def numbered(body):
+        return isinstance(body.get('node'),str) and number(body.get('epoch')) and number(body.get('seq'))
+    if not isinstance(body,dict):
+        ok = False
+    elif 'full' in body:
+        ok = numbered(body) and strings(body['full']) and number(body.get('hops'),True)
+    elif 'seq' in body:
+        ok = (numbered(body) and number(body.get('hops',0))
+            and strings(body.get('add',[])) and strings(body.get('remove',[])))
+    elif 'want' in body:
+        ok = strings(body['want'])
+    elif 'digest' in body:
+        digest = body['digest']
+        ok = isinstance(digest,dict) and all( isinstance(v,list) and len(v) in (2,3)
+            and number(v[0]) and number(v[1]) and number(v[2] if len(v) == 3 else None,True)
+            for v in digest.values() )
+    elif 'resync' in body:
+        resync = body['resync']
+        ok = (isinstance(resync,dict) and isinstance(resync.get('node'),str)
+            and number(resync.get('id')) and strings(resync.get('nodes',[])))
+    else:
+        ok = True
+    if not ok:
+        raise ValueError(f'Malformed presence message: {body!r}')
+
+
+class NodePresence:
+
+    __slots__ = ('epoch','seq','leaves','via','hops','alternates','expires')
+
+    def __init__(self, epoch, seq, via, expires):
+        self.epoch = epoch
+        self.seq = seq
+        self.leaves = set()
+        self.via = via
+        self.hops = None # links crossed to get here, less one; None if not known
+        self.alternates = set() # links from nodes nearer to it than this one
+        self.expires = expires
+
+
+class PresenceTable:
+
+    def __init__(self, refresh=30.0, delay=0.05, max_batch=1000, resync_delay=0.5):
+        self.refresh = refresh
+        self.delay = delay
+        self.resync_delay = resync_delay
+        self.max_batch = max_batch
+        self.epoch = int(1000*time.time())
+        self.seq = 0
+        self.nodes = {} # node id => NodePresence
+        self.owners = {} # leaf id => node id, or a set of them if on more than one
+        self.resync_id = 0
+        self.resyncs = {} # node id => last resync id seen from it
+        self.stats = dict(sent=0,sent_bytes=0,received=0,applied=0,snapshots_sent=0,
+            snapshots_received=0,gaps=0,expired=0,rerouted=0,routed=0,flooded=0,unknown=0)
+        self._adds = set()
+        self._removes = set()
+        self._wanted = {} # node id => when we last asked for it
+        self._lost = set() # node ids whose route went with a link
+        self._news = set() # node ids with a newer set from a snapshot
+        self._pending = None
+        self._news_digest = Debounce(self._send_news,delay,max_wait=delay)
+        self._resync_request = Debounce(self._resync,resync_delay)
+        self._resync_answer = Debounce(self._schedule,resync_delay)
+
+    def attach(self, node):
+        self.node = node
+        self.timer = PeriodicCallback(self._on_refresh,1000*self.refresh)
+        self.timer.start()
+
+    def detach(self):
+        self.timer.stop()
+        if self._pending is not None:
+            IOLoop.current().remove_timeout(self._pending)
+            self._pending = None
+        self._resync_request.cancel()
+        self._resync_answer.cancel()
+        self._news_digest.cancel()
+
+    #-- Our own leaves ----------------------------------------#
+
+    def leaf_up(self, leaf_id):
+        ''' The first connection with `leaf_id` opened here '''
+        if leaf_id in self._removes:
+            self._removes.discard(leaf_id)
+        else:
+            self._adds.add(leaf_id)
+        self._schedule()
+
+    def leaf_down(self, leaf_id):
+        ''' The last connection with `leaf_id` here closed '''
+        if leaf_id in self._adds:
+            self._adds.discard(leaf_id)
+        else:
+            self._removes.add(leaf_id)
+        self._schedule()
+
+    def _schedule(self):
+        if self._pending is None:
+            self._pending = IOLoop.current().call_later(self.delay,self._flush)
+
+    def _flush(self):
+        self._pending = None
+        adds,removes = sorted(self._adds),sorted(self._removes)
+        self._adds.clear()
+        self._removes.clear()
+        while True:
+            add,adds = adds[:self.max_batch],adds[self.max_batch:]
+            remove,removes = removes[:self.max_batch-len(add)],removes[self.max_batch-len(add):]
+            self._announce(add,remove)
+            if not adds and not removes:
+                break
+
+    def _announce(self, add=(), remove=()):
+        self.seq += 1
+        body = dict(node=self.node.node_id,epoch=self.epoch,seq=self.seq)
+        if add:
+            body['add'] = add
+        if remove:
+            body['remove'] = remove
+        self._send(self.node.live_node_addrs,body)
+
+    def _send(self, addrs, body):
+        for addr in list(addrs):
+            self.stats['sent'] += 1
+            self.stats['sent_bytes'] += self.node.send_control(addr,PRESENCE,body)
+
+    def _snapshot(self, node_id):
+        if node_id == self.node.node_id:
+            # What the others have been told, not what is waiting to go out
+            leaves = (set(self.node.leaves.keys('name'))|self._removes)-self._adds
+            return dict(node=node_id,epoch=self.epoch,seq=self.seq,hops=0,full=sorted(leaves))
+        entry = self.nodes.get(node_id)
+        if entry is None:
+            return None
+        return dict(node=node_id,epoch=entry.epoch,seq=entry.seq,hops=self._hops(entry),
+            full=sorted(entry.leaves))
+
+    def _hops(self, entry):
+        return None if entry.hops is None else entry.hops+1
+
+    #-- Links ----------------------------------------#
+
+    def _digest(self, node_ids):
+        return { node_id: [e.epoch,e.seq,self._hops(e)] for node_id,e in
+            ( (n,self.nodes[n]) for n in node_ids if n in self.nodes ) }
+
+    def on_link_up(self, addr):
+        digest = self._digest(self.nodes)
+        digest[self.node.node_id] = [self.epoch,self.seq,0]
+        self._send([addr],dict(digest=digest))
+
+    def _send_news(self):
+        digest = self._digest(self._news)
+        self._news.clear()
+        if digest:
+            self._send(self.node.live_node_addrs,dict(digest=digest))
+
+    def on_link_down(self, addr):
+        for node_id,entry in self.nodes.items():
+            entry.alternates.discard(addr)
+            # Nodes without leaves need no route
+            if entry.via == addr and entry.leaves:
+                if entry.alternates:
+                    entry.via = entry.alternates.pop()
+                    self.stats['rerouted'] += 1
+                else:
+                    self._lost.add(node_id)
+        if self._lost:
+            # One request for the links that go down meanwhile
+            self._resync_request.touch()
+
+    def _resync(self):
+        live = self.node.live_node_addrs
+        # Some may have found another route meanwhile
+        lost = sorted( n for n in self._lost if n in self.nodes and self.nodes[n].via not in live )
+        self._lost.clear()
+        if lost:
+            self.resync_id = max(self.resync_id+1,int(1000*time.time()))
+            self.resyncs[self.node.node_id] = self.resync_id
+            self._send_resync(dict(node=self.node.node_id,id=self.resync_id,nodes=lost),None)
+
+    def _send_resync(self, resync, from_addr):
+        self._send([ a for a in self.node.live_node_addrs if a != from_addr ],dict(resync=resync))
+        if self.node.node_id in resync.get('nodes',(self.node.node_id,)):
+            self._resync_answer.touch()
+
+    def on_control(self, addr, body):
+        # All checked before any is applied: stored, a bad epoch or seq
+        # would break every later comparison with it
+        _check(body)
+        self.stats['received'] += 1
+        if 'full' in body:
+            self._on_snapshot(addr,body)
+        elif 'seq' in body:
+            self._on_change(addr,body)
+        elif 'want' in body:
+            for node_id in body['want']:
+                snapshot = self._snapshot(node_id)
+                if snapshot is not None:
+                    self._send([addr],snapshot)
+                    self.stats['snapshots_sent'] += 1
+        elif 'digest' in body:
+            want = []
+            for node_id,(epoch,seq,*hops) in body['digest'].items():
+                if self._is_newer(node_id,epoch,seq):
+                    want.append(node_id)
+                elif hops:
+                    self._alternate(addr,node_id,epoch,seq,hops[0])
+            if want:
+                self._want(addr,want)
+        elif 'resync' in body:
+            resync = body['resync']
+            if resync['id'] > self.resyncs.get(resync['node'],0):
+                self.resyncs[resync['node']] = resync['id']
+                self._send_resync(resync,addr)
+
+    def _is_newer(self, node_id, epoch, seq):
+        if node_id == self.node.node_id:
+            return False
+        entry = self.nodes.get(node_id)
+        return entry is None or (epoch,seq) > (entry.epoch,entry.seq)
+
+    def _want(self, addr, node_ids):
+        now = time.monotonic()
+        # One request in flight per node; a snapshot usually answers within a second
+        node_ids = [ n for n in node_ids if now-self._wanted.get(n,0) > 1.0 ]
+        if node_ids:
+            for node_id in node_ids:
+                self._wanted[node_id] = now
+            self._send([addr],dict(want=node_ids))
+
+    def _on_change(self, addr, body):
+        node_id = body['node']
+        entry = self.nodes.get(node_id)
+        hops = body.get('hops',0)
+        if self._alternate(addr,node_id,body['epoch'],body['seq'],hops):
+            return
+        if not self._is_newer(node_id,body['epoch'],body['seq']):
+            return
+        if body['seq'] == 1 and (entry is None or entry.epoch != body['epoch']):
+            # The first change of a node (re)started, nothing to miss
+            if entry is not None:
+                self._drop(node_id)
+            entry = self.nodes[node_id] = NodePresence(body['epoch'],0,addr,0)
+        elif entry is None or entry.epoch != body['epoch'] or entry.seq+1 != body['seq']:
+            # Missed something; the link it came from has it all
+            self.stats['gaps'] += 1
+            self._want(addr,[node_id])
+            return
+        for leaf_id in body.get('remove',()):
+            if leaf_id in entry.leaves:
+                entry.leaves.discard(leaf_id)
+                self._unown(leaf_id,node_id)
+        for leaf_id in body.get('add',()):
+            if leaf_id not in entry.leaves:
+                entry.leaves.add(leaf_id)
+                self._own(leaf_id,node_id)
+        entry.seq = body['seq']
+        entry.via = addr
+        entry.hops = hops
+        entry.alternates = set()
+        entry.expires = time.monotonic()+3*self.refresh
+        self.stats['applied'] += 1
+        self._send([ a for a in self.node.live_node_addrs if a != addr ],dict(body,hops=hops+1))
+
+    def _alternate(self, addr, node_id, epoch, seq, hops):
+        ''' Note `addr` as a way to `node_id` if it is nearer; True if that change is known '''
+        entry = self.nodes.get(node_id)
+        if entry is None or (entry.epoch,entry.seq) != (epoch,seq):
+            return False
+        # A node nearer to it than this one has no route through here, so
+        # it can take over from `via` without making a loop
+        if addr != entry.via and None not in (hops,entry.hops) and hops <= entry.hops:
+            entry.alternates.add(addr)
+        return True
+
+    def _on_snapshot(self, addr, body):
+        node_id = body['node']
+        self.stats['snapshots_received'] += 1
+        self._wanted.pop(node_id,None)
+        if not self._is_newer(node_id,body['epoch'],body['seq']):
+            return
+        entry = self.nodes.get(node_id)
+        if entry is None:
+            entry = self.nodes[node_id] = NodePresence(body['epoch'],body['seq'],addr,0)
+        leaves = set(body['full'])
+        for leaf_id in entry.leaves-leaves:
+            self._unown(leaf_id,node_id)
+        for leaf_id in leaves-entry.leaves:
+            self._own(leaf_id,node_id)
+        entry.leaves = leaves
+        entry.epoch = body['epoch']
+        entry.seq = body['seq']
+        if entry.via not in self.node.live_node_addrs or entry.via == addr:
+            entry.via = addr
+            entry.hops = body.get('hops')
+        entry.alternates = set()
+        entry.expires = time.monotonic()+3*self.refresh
+        # The other links may not have it either
+        self._news.add(node_id)
+        self._news_digest.touch()
+
+    def _own(self, leaf_id, node_id):
+        owner = self.owners.get(leaf_id)
+        if owner is None:
+            self.owners[leaf_id] = node_id
+        elif isinstance(owner,set):
+            owner.add(node_id)
+        else:
+            self.owners[leaf_id] = {owner,node_id}
+
+    def _unown(self, leaf_id, node_id):
+        owner = self.owners.get(leaf_id)
+        if owner == node_id:
+            del self.owners[leaf_id]
+        elif isinstance(owner,set):
+            owner.discard(node_id)
+            if len(owner) == 1:
+                self.owners[leaf_id] = next(iter(owner))
+
+    def _drop(self, node_id):
+        for leaf_id in self.nodes.pop(node_id).leaves:
+            self._unown(leaf_id,node_id)
+
+    def _on_refresh(self):
+        now = time.monotonic()
+        for node_id in [ n for n,e in self.nodes.items() if e.expires < now ]:
+            self._drop(node_id)
+            self.stats['expired'] += 1
+        if self._pending is None:
+            self._announce()
+
+    #-- Forwarding ----------------------------------------#
+
+    def owners_of(self, leaf_id):
+        ''' The other nodes with a leaf `leaf_id` connected '''
+        owner = self.owners.get(leaf_id)
+        if owner is None:
+            return ()
+        return owner if isinstance(owner,set) else (owner,)
+
+    def targets(self, leaf_id, from_addr):
+        ''' The links to pass a message for `leaf_id` on to '''
+        live = self.node.live_node_addrs
+        addrs = set()
+        for node_id in self.owners_of(leaf_id):
+            if node_id in live:
+                # A neighbour: one hop, whatever the route its changes took
+                via = node_id
+            else:
+                via = self.nodes[node_id].via
+            if via not in live:
+                # The route went with a link; everywhere, until a resync finds another
+                self.stats['flooded'] += 1
+                return [ a for a in live if a != from_addr ]
+            if via != from_addr:
+                addrs.add(via)
+        if addrs:
+            self.stats['routed'] += 1
+        elif from_addr is None and not self.node.leaves.by('name',leaf_id):
+            self.stats['unknown'] += 1
+        return list(addrs)
+
+    def status(self):
+        return dict(epoch=self.epoch,seq=self.seq,nodes={ n: len(e.leaves) for n,e in self.nodes.items() },
+            leaves=len(self.owners),**self.stats)
@@ -0,0 +1,158 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import collections
+import secrets
+import time
+
+
+'''
+Routing of leaf messages between mesh nodes.
+
+A message is wrapped in an envelope when it enters the mesh:
+
+* origin: id of the node whose leaf sent it
+* id:     64 bit message id, unique per origin (random epoch + counter,
+          so a restarted node does not reuse recent ids)
+* ttl:    hops left before it is dropped
+* hops:   hops taken so far
+* topic:  for publications, the topic (see `wscommon.topics`); None for
+          messages to every leaf
+* to:     for messages to one leaf, its id (see `mesh.presence`)
+* payload
+
+Every node remembers the (origin, id) pairs it has seen. A copy that comes
+back around a cycle is counted as a duplicate and dropped, so flooding a
+ring or any other cyclic topology delivers to each node's leaves exactly
+once and then stops.
+
+Nodes also exchange control messages with their direct neighbours (for
+the forwarding strategies), which are never forwarded. How both are put
+on the wire is up to `mesh.codec`.
+'''
+
+DEFAULT_TTL = 32
+
+
+class Envelope:
+
+    '''
+    `payload` is a str, or bytes (or a memoryview of the received frame)
+    when `binary` is set. `raw` is the encoded envelope it was decoded
+    from, if any, so forwarding can pass it on without re-encoding.
+    '''
+
+    __slots__ = ('origin','id','ttl','hops','payload','binary','raw','topic','to')
+
+    def __init__(self, origin, id, ttl, hops, payload, binary=False, raw=None, topic=None, to=None):
+        self.origin = origin
+        self.id = id
+        self.ttl = ttl
+        self.hops = hops
+        self.payload = payload
+        self.binary = binary
+        self.raw = raw
+        self.topic = topic
+        self.to = to
+
+    @property
+    def key(self):
+        return (self.origin,self.id)
+
+    def next_hop(self):
+        return Envelope(self.origin,self.id,self.ttl-1,self.hops+1,self.payload,self.binary,self.raw,
+            self.topic,self.to)
+
+
+class Control:
+
+    __slots__ = ('kind','body')
+
+    def __init__(self, kind, body):
+        self.kind = kind
+        self.body = body
+
+
+class SeenCache:
+
+    '''
+    The message keys seen in the last `window` seconds, at most
+    `max_entries` of them. Entries are kept in arrival order, so expiring
+    is popping from the front.
+    '''
+
+    def __init__(self, window=60, max_entries=100000):
+        self.window = window
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict() # key => arrival time
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, now=None):
+        ''' Record `key`; returns False if it was already there '''
+        if key in self._entries:
+            return False
+        now = time.monotonic() if now is None else now
+        entries = self._entries
+        entries[key] = now
+        cutoff = now-self.window
+        while entries:
+            first_key,first_time = next(iter(entries.items()))
+            if first_time >= cutoff and len(entries) <= self.max_entries:
+                break
+            del entries[first_key]
+        return True
+
+
+class MeshRouter:
+
+    ''' Envelope bookkeeping for one node; the node does the sending '''
+
+    def __init__(self, node_id, ttl=DEFAULT_TTL, seen_window=60, seen_max=100000):
+        self.node_id = node_id
+        self.ttl = ttl
+        self.seen = SeenCache(seen_window,seen_max)
+        self._next_id = secrets.randbits(32)<<32
+        self.stats = dict(originated=0,received=0,delivered=0,duplicates=0,expired=0,sent=0,bytes_sent=0)
+
+    def originate(self, payload, topic=None, to=None):
+        self._next_id += 1
+        env = Envelope(self.node_id,self._next_id,self.ttl,0,payload,isinstance(payload,bytes),
+            topic=topic,to=to)
+        self.seen.add(env.key)
+        self.stats['originated'] += 1
+        return env
+
+    def accept(self, env):
+        ''' True if `env` is new here and should be delivered locally '''
+        self.stats['received'] += 1
+        if not self.seen.add(env.key):
+            self.stats['duplicates'] += 1
+            return False
+        self.stats['delivered'] += 1
+        return True
+
+    def forward(self, env):
+        ''' The envelope to pass on, or None once its ttl is spent '''
+        if env.ttl <= 1:
+            self.stats['expired'] += 1
+            return None
+        return env.next_hop()
+
+    def count_sent(self, count, nbytes):
+        self.stats['sent'] += count
+        self.stats['bytes_sent'] += nbytes
+
+    def reset_stats(self):
+        for key in self.stats:
+            self.stats[key] = 0
+
+    def status(self):
+        status = dict(self.stats)
+        status['seen'] = len(self.seen)
+        received = status['received']
+        status['duplicate_rate'] = round(status['duplicates']/received,4) if received else 0.0
+        delivered = status['delivered']+status['originated']
+        status['sent_per_delivered'] = round(status['sent']/delivered,4) if delivered else 0.0
+        return status
@@ -0,0 +1,182 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import random
+import time
+# Tornado
+from tornado.ioloop import PeriodicCallback
+
+
+'''
+How a node picks the links to pass a mesh message on to.
+
+* flood:  every link but the one it came in on. Always reaches every
+          node, but each message crosses every link about once, so the
+          cost grows with the number of links.
+* tree:   only the links of a spanning tree the nodes maintain between
+          themselves, so each message crosses about one link per node.
+* gossip: `fanout` random links. Cheap and needs no shared state, but
+          only probably reaches every node.
+
+Duplicate suppression in the router makes any of these loop free.
+A strategy is given the node with `attach`, and told about links coming
+and going and about the control messages addressed to it.
+'''
+
+
+class FloodStrategy:
+
+    name = 'flood'
+
+    def attach(self, node):
+        self.node = node
+
+    def detach(self):
+        pass
+
+    def targets(self, env, from_addr):
+        return [ addr for addr in self.node.live_node_addrs if addr != from_addr ]
+
+    def on_link_up(self, addr):
+        pass
+
+    def on_link_down(self, addr):
+        pass
+
+    def on_control(self, addr, body):
+        pass
+
+    def status(self):
+        return dict(name=self.name)
+
+
+class GossipStrategy(FloodStrategy):
+
+    name = 'gossip'
+
+    def __init__(self, fanout=3, seed=None):
+        self.fanout = fanout
+        self.random = random.Random(seed)
+
+    def targets(self, env, from_addr):
+        candidates = super().targets(env,from_addr)
+        if len(candidates) <= self.fanout:
+            return candidates
+        return self.random.sample(candidates,self.fanout)
+
+    def status(self):
+        return dict(name=self.name,fanout=self.fanout)
+
+
+class SpanningTreeStrategy(FloodStrategy):
+
+    '''
+    A distance vector spanning tree: the node with the lowest id is the
+    root, and every other node's parent is the neighbour with the shortest
+    path to it. Nodes advertise (root, distance, parent) to their
+    neighbours whenever that changes and every `interval` seconds, so the
+    tree heals when links drop. A neighbour's advert expires after three
+    missed intervals, and distances are capped to end count-to-infinity
+    when the root goes away.
+
+    Until a node has heard from its neighbours it floods.
+    '''
+
+    name = 'tree'
+    MAX_DISTANCE = 64
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+
+    def attach(self, node):
+        super().attach(node)
+        self.adverts = {} # addr => (root, distance, parent, node_id, when)
+        self.root = node.node_id
+        self.distance = 0
+        self.parent = None
+        self.changed_at = time.monotonic()
+        self.timer = PeriodicCallback(self._on_interval,1000*self.interval)
+        self.timer.start()
+        self._advertise()
+
+    def detach(self):
+        self.timer.stop()
+
+    def tree_addrs(self):
+        me = self.node.node_id
+        addrs = { addr for addr,advert in self.adverts.items() if advert[2] == me }
+        if self.parent is not None:
+            addrs.add(self.parent)
+        return addrs
+
+    def targets(self, env, from_addr):
+        if not self.adverts:
+            return super().targets(env,from_addr)
+        live = self.node.live_node_addrs
+        return [ addr for addr in self.tree_addrs() if addr != from_addr and addr in live ]
+
+    def on_link_up(self, addr):
+        self.node.send_control(addr,'tree',self._advert())
+
+    def on_link_down(self, addr):
+        if self.adverts.pop(addr,None) is not None:
+            self._recompute()
+
+    def on_control(self, addr, body):
+        root,distance,parent,node_id = body['root'],body['distance'],body['parent'],body['node']
+        # Checked before it is kept, as every later recompute would trip on it
+        if not (isinstance(root,str) and isinstance(node_id,str)
+                and (parent is None or isinstance(parent,str))
+                and type(distance) is int and distance >= 0):
+            raise ValueError(f'Malformed tree advert: {body!r}')
+        self.adverts[addr] = (root,distance,parent,node_id,time.monotonic())
+        self._recompute()
+
+    def _on_interval(self):
+        cutoff = time.monotonic()-3*self.interval
+        for addr in [ a for a,advert in self.adverts.items() if advert[4] < cutoff ]:
+            del self.adverts[addr]
+        self._recompute()
+        self._advertise()
+
+    def _recompute(self):
+        best = (self.node.node_id,0,None)
+        best_key = (self.node.node_id,0,'')
+        for addr,(root,distance,_,node_id,_) in self.adverts.items():
+            if distance+1 >= self.MAX_DISTANCE:
+                continue
+            # Ties go to the lower neighbour id, so the tree is deterministic
+            key = (root,distance+1,node_id)
+            if key < best_key:
+                best,best_key = (root,distance+1,addr),key
+        if best != (self.root,self.distance,self.parent):
+            self.root,self.distance,self.parent = best
+            self.changed_at = time.monotonic()
+            self._advertise()
+
+    def _advert(self):
+        parent = None if self.parent is None else self.adverts[self.parent][3]
+        return dict(root=self.root,distance=self.distance,parent=parent,node=self.node.node_id)
+
+    def _advertise(self):
+        advert = self._advert()
+        for addr in list(self.node.live_node_addrs):
+            self.node.send_control(addr,'tree',advert)
+
+    def status(self):
+        return dict(name=self.name,root=self.root,distance=self.distance,
+            parent=self.parent,tree_links=sorted(self.tree_addrs()))
+
+
+STRATEGIES = {
+    'flood': FloodStrategy,
+    'gossip': GossipStrategy,
+    'tree': SpanningTreeStrategy
+}
+
+def make_strategy(name, **options):
+    try:
+        cls = STRATEGIES[name]
+    except KeyError:
+        raise ValueError(f'Unknown forwarding strategy: {name}')
+    return cls(**options)
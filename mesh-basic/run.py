@@ -43,7 +43,7 @@ async def main():
     for i,port in enumerate(ports):
         name = f"c{i}"
         url = f"ws://localhost:{port}/api/ws/leaf/"
-        client = MeshLeafClient(name,url)
+        client = MeshLeafClient(name,url,leaf_id=name)
         asyncio.create_task(client.start(),name=name)
         clients.append(client)
 
@@ -75,6 +75,35 @@ async def main():
     clients[1].send_msg("CLIENT[1] BROADCAST AGAIN!")
     await ctx.async_sleep(5)
 
+    ctx.H2("client[2] asks its node for its status")
+    status = await clients[2].call('status',timeout=2)
+    print("routing:",status['routing'])
+
+    ctx.H2("client[1] subscribes to chat.#, client[2] to chat.room1")
+    await clients[1].subscribe('chat.#')
+    await clients[2].subscribe('chat.room1')
+    await ctx.async_sleep(1)
+
+    ctx.H2("client[0] publishes to chat.room1 and chat.room2")
+    clients[0].publish('chat.room1',"hello room1")
+    clients[0].publish('chat.room2',"hello room2")
+    await ctx.async_sleep(1)
+    print("interest:",servers[0].dump_status()['interest'])
+
+    ctx.H2("client[0] sends to c2 alone")
+    print("went to:",await clients[0].send_to('c2',"hello c2"))
+    await ctx.async_sleep(1)
+    print("presence:",servers[0].dump_status()['presence'])
+
+    ctx.H2("disconnect 8701 from 8702")
+    servers[0].disconnect_from(8702)
+    await ctx.async_sleep(2)
+
+    ctx.H2("client[0] sends to c1, now by way of 8703")
+    print("went to:",await clients[0].send_to('c1',"hello c1"))
+    await ctx.async_sleep(1)
+    dump_statuses(servers)
+
     ctx.H2("Finished Run")
 
     # Setup the shutdown systems
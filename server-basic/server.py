@@ -5,10 +5,16 @@ import datetime
 import signal
 import logging
 import tornado.web
+import sys
+from pathlib import Path
+# The shared tooling (`wscommon`) lives at the repo root
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.metrics import Metrics, MetricsHandler
 
 '''
 Basic server setup for Python 3.10+ and Tornado 6.2+.
-Includes graceful shutdown and periodic methods.
+Includes graceful shutdown and periodic methods, and counters for
+Prometheus at /metrics (see `wscommon.metrics`).
 
 See <https://www.tornadoweb.org/en/stable/guide/structure.html>
 '''
@@ -39,7 +45,8 @@ class MyApp(tornado.web.Application):
     def initialize(self):
         # Handlers
         self._handlers += [
-            (r"/", MainHandler)
+            (r"/", MainHandler),
+            (r"/metrics", MetricsHandler)
         ]
 
         # Settings
@@ -51,6 +58,17 @@ class MyApp(tornado.web.Application):
         self.heartbeat_count = 0
         self.heartbeat = asyncio.create_task(self._call_heartbeat())
 
+        # Counters, served at /metrics
+        self.metrics = Metrics('server')
+        self.request_time = self.metrics.histogram('request_seconds',
+            'Time to handle a request, by status code',labels=('code',))
+        self.metrics.gauge('heartbeat_count','Heartbeats since startup',lambda: self.heartbeat_count)
+        self.loop_lag = self.metrics.loop_lag()
+
+    def log_request(self, handler):
+        super().log_request(handler)
+        self.request_time.labels(str(handler.get_status())).observe(handler.request.request_time())
+
     async def _call_heartbeat(self):
         while True:
             logging.info(f"heartbeat: {self.heartbeat_count}")
@@ -61,6 +79,7 @@ class MyApp(tornado.web.Application):
         logging.info('app::on_shutdown >')
         await asyncio.sleep(0.5)
         self.heartbeat.cancel()
+        self.loop_lag.stop()
         logging.info('< app::on_shutdown')
 
 
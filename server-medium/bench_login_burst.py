@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Measures websocket echo latency on `EchoWebSocket` while a burst of
+logins hits `LoginHandler`.
+
+    ./bench_login_burst.py            # bcrypt on the password pool
+    ./bench_login_burst.py --inline   # bcrypt on the event loop (old behavior)
+
+Server and clients share one process and loop, so the absolute numbers
+include client overhead; compare the two modes against each other.
+'''
+
+# Python
+import asyncio
+import logging
+import statistics
+import time
+import urllib.parse
+# Tools
+import bcrypt
+# Tornado
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.websocket import websocket_connect
+# Local
+from server import MyApp
+
+
+class InlinePasswordPool:
+    ''' Stand-in for `PasswordPool` that blocks the loop, as before '''
+
+    async def hashpw(self, password):
+        return bcrypt.hashpw(password,bcrypt.gensalt())
+
+    async def checkpw(self, password, password_hash):
+        return bcrypt.checkpw(password,password_hash)
+
+    def shutdown(self):
+        pass
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(len(values)-1,int(round(pct/100*(len(values)-1))))
+    return values[idx]
+
+def cookie_header(resp, jar):
+    for header in resp.headers.get_list('Set-Cookie'):
+        name,_,rest = header.partition('=')
+        jar[name] = rest.split(';')[0]
+    return '; '.join(f'{k}={v}' for k,v in jar.items())
+
+async def login(client, base, jar):
+    # Fetch the login page for an xsrf token, then post the form
+    resp = await client.fetch(f'{base}/login')
+    cookies = cookie_header(resp,jar)
+    body = urllib.parse.urlencode(dict(username='tester',password='tester',_xsrf=jar['_xsrf']))
+    req = HTTPRequest(f'{base}/login',method='POST',body=body,
+        headers={'Cookie':cookies},follow_redirects=False)
+    resp = await client.fetch(req,raise_error=False)
+    cookie_header(resp,jar)
+    return resp.code
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inline', action='store_true', help='Run bcrypt on the loop')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--port', type=int, default=8890)
+    parser.add_argument('--hash-workers', type=int, default=4)
+    parser.add_argument('--hash-max-pending', type=int, default=64)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger('tornado.access').setLevel(logging.CRITICAL)
+
+    app = MyApp(auth_options=dict(hash_workers=args.hash_workers,hash_max_pending=args.hash_max_pending))
+    if args.inline:
+        app.password_pool = InlinePasswordPool()
+    app.listen(args.port)
+    base = f'http://localhost:{args.port}'
+
+    AsyncHTTPClient.configure(None,max_clients=args.logins,defaults=dict(connect_timeout=600,request_timeout=600))
+    client = AsyncHTTPClient()
+
+    # One authenticated websocket to measure echo latency on
+    jar = {}
+    await login(client,base,jar)
+    cookies = '; '.join(f'{k}={v}' for k,v in jar.items())
+    ws = await websocket_connect(HTTPRequest(f'ws://localhost:{args.port}/api/example/ws/echo/',
+        headers={'Cookie':cookies}))
+    await ws.read_message()
+
+    # Pings are scheduled every 5ms; latency is measured from the scheduled
+    # send time so a stalled loop shows up instead of hiding the stall
+    interval = 0.005
+    latencies = []
+    burst_done = asyncio.Event()
+    async def echo_loop():
+        next_t = time.perf_counter()
+        while not burst_done.is_set():
+            delay = next_t-time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            ws.write_message('ping')
+            await ws.read_message()
+            recv = time.perf_counter()
+            while next_t <= recv:
+                latencies.append(recv-next_t)
+                next_t += interval
+
+    echo_task = asyncio.create_task(echo_loop())
+    t0 = time.perf_counter()
+    codes = await asyncio.gather(*[login(client,base,{}) for _ in range(args.logins)])
+    elapsed = time.perf_counter()-t0
+    burst_done.set()
+    await echo_task
+
+    ws.close()
+    await app.on_shutdown()
+
+    print(f"mode:            {'inline' if args.inline else 'pool'}")
+    print(f"logins:          {args.logins} in {elapsed:.2f}s")
+    print(f"  succeeded:     {codes.count(302)}")
+    print(f"  rejected 503:  {codes.count(503)}")
+    print(f"echo samples:    {len(latencies)}")
+    if latencies:
+        print(f"  p50:           {1000*statistics.median(latencies):.1f}ms")
+        print(f"  p99:           {1000*percentile(latencies,99):.1f}ms")
+        print(f"  max:           {1000*max(latencies):.1f}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Microbenchmark of the `ExampleGetHandler` -> `write_json` path.
+
+1. Encoding only: the handler's reply and a large list, with the old
+   `json.dumps(obj)` and with `system.jsonenc.dumps`.
+2. Full requests to /api/example/get over one keep-alive connection,
+   with `write_json` using each encoder in turn.
+
+Install orjson to see the fast path; without it the stdlib is used.
+'''
+
+# Python
+import asyncio
+import json
+import logging
+import time
+import timeit
+# Tornado
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+# Local
+import system.basehandlers
+from system.jsonenc import dumps, orjson
+from server import MyApp
+from bench_login_burst import login
+
+
+def legacy_dumps(obj, indent=None):
+    return json.dumps(obj,indent=indent)
+
+def bench_encode(label, obj, number):
+    for name,fn in (('json.dumps',legacy_dumps),('jsonenc.dumps',dumps)):
+        secs = timeit.timeit(lambda: fn(obj),number=number)
+        print(f"  {label:<12} {name:<14} {1e6*secs/number:9.2f}us  {len(fn(obj))} bytes")
+
+async def bench_requests(port, count):
+    client = AsyncHTTPClient()
+    jar = {}
+    await login(client,f'http://localhost:{port}',jar)
+    cookies = '; '.join(f'{k}={v}' for k,v in jar.items())
+    url = f'http://localhost:{port}/api/example/get/?url=yaks.com&title=YAK_SHAVER&selection=hair'
+    request = HTTPRequest(url,headers={'Cookie':cookies,'Accept-Encoding':'gzip'})
+
+    for name,fn in (('json.dumps',legacy_dumps),('jsonenc.dumps',dumps)):
+        system.basehandlers.dumps = fn
+        for _ in range(100): # warm up
+            await client.fetch(request)
+        t0 = time.perf_counter()
+        for _ in range(count):
+            await client.fetch(request)
+        elapsed = time.perf_counter()-t0
+        print(f"  {name:<14} {count/elapsed:8.0f} req/s  {1e6*elapsed/count:8.1f}us/req")
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=8894)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger('tornado.access').setLevel(logging.CRITICAL)
+
+    print(f"fast encoder: {'orjson' if orjson is not None else 'not installed, stdlib'}")
+    print("encode:")
+    reply = {"success": True, "url": "yaks.com", "title": "YAK_SHAVER", "selection": "hair"}
+    bench_encode('reply',reply,100000)
+    rows = [ {"id": i, "name": f"row {i}", "score": i*0.5, "tags": ["a","b"]} for i in range(100000) ]
+    bench_encode('100k rows',rows,5)
+
+    print("requests:")
+    app = MyApp()
+    app.listen(args.port)
+    await bench_requests(args.port,args.requests)
+    await app.on_shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -3,21 +3,36 @@
 # Copyright 2022 Jeffrey LeBlanc
 
 # Python
-import secrets
 import os
+import sys
 from pathlib import Path
 import asyncio
 import signal
 import logging
 import json
+import time
 # Tornado
 import tornado.web
 import tornado.websocket
-import tornado.autoreload
+import tornado.ioloop
 # Local
 from system.basehandlers import BaseHandler, BaseWebsocketHandler
 from system.auth_server import AuthServerMixin
+from system.user_store import SQLiteUserStore
+from system.sessions import SessionManager, load_keyring, rotate_keyring
+from system.supervisor import WorkerBus, run_workers
+from system.uploads import StreamingUploadHandler, UploadManager
+from system.compression import gzip_policy
+from system.static_assets import AssetHandler, build_assets, static_version
+from system.templates import WarmTemplateLoader, FragmentCache
 from system.auth_handlers import get_account_handlers, authenticated
+# Shared websocket tooling, at the repo root
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.compression import CompressionPolicy, CompressionPolicyMixin
+from wscommon.heartbeat import Heartbeat, HeartbeatMixin, rtt_ms
+from wscommon.metrics import Metrics, MetricsHandler, MetricsMixin, connection_metrics
+from wscommon.registry import ConnectionRegistry
+from wscommon.rpc import RpcMixin, rpc_method
 
 
 #-- Application Handlers ------------------------------------------------------#
@@ -25,7 +40,7 @@ from system.auth_handlers import get_account_handlers, authenticated
 class MainHandler(BaseHandler):
     @authenticated(action='login')
     def get(self):
-        self.render("index.html",user=self.current_user,rh=secrets.token_urlsafe(6))
+        self.render("index.html",user=self.current_user)
 
 
 class ExampleGetHandler(BaseHandler):
@@ -51,21 +66,20 @@ class ExamplePostHandler(BaseHandler):
         self.write_json({'success':True})
 
 
-class ExampleUploadFile(BaseHandler):
-    @authenticated()
-    def post(self):
-        # see https://www.tornadoweb.org/en/stable/httputil.html#tornado.httputil.HTTPFile
-        fileinfo = self.request.files['myFile'][0]
-        filename = fileinfo['filename']
-        filedata = fileinfo['body']
+class ExampleUploadFile(StreamingUploadHandler):
+    ''' Streams uploads to `uploads/<user>/`, see `system/uploads.py` '''
+    pass
 
-        with open(filename,'w+b') as f:
-            f.write(filedata)
 
+class ExampleBroadcastHandler(BaseHandler):
+    @authenticated()
+    def post(self):
+        data = tornado.escape.json_decode(self.request.body)
+        self.application.broadcast(data['message'])
         self.write_json({'success':True})
 
 
-class EchoWebSocket(BaseWebsocketHandler):
+class EchoWebSocket(MetricsMixin, RpcMixin, HeartbeatMixin, CompressionPolicyMixin, BaseWebsocketHandler):
 
     '''
     The sequence of calls on a new connection is:
@@ -95,16 +109,43 @@ class EchoWebSocket(BaseWebsocketHandler):
             return proto_list[0]
         return None
 
+    def get_compression_policy(self):
+        return self.application.ws_compression
+
     def open(self):
         logging.info("ws:open =>")
         self.idx = self.application.register_ws_client(self)
+        self.start_heartbeat()
         print(f'WebSocket {self.idx} on_open')
         self.write_message("HELLO FROM THE SERVER!")
         logging.info("<= ws:open")
 
     def on_message(self, message):
+        # JSON-RPC calls are answered by the `rpc_*` methods, see `wscommon.rpc`
+        message = self.rpc_receive(self.count_received(message))
+        if message is None:
+            return
         self.write_message(u"You said: " + message)
 
+    @rpc_method('echo')
+    def rpc_echo(self, params):
+        return params
+
+    @rpc_method('whoami')
+    def rpc_whoami(self, params):
+        return tornado.escape.to_unicode(self.current_user)
+
+    @rpc_method('ping')
+    def rpc_ping(self, params):
+        ''' This connection's round trip time, as the server measures it '''
+        return dict(rtt_ms=rtt_ms(self))
+
+    @rpc_method('sessions')
+    def rpc_sessions(self, params):
+        ''' This user's open echo sockets, in this worker '''
+        user = tornado.escape.to_unicode(self.current_user)
+        return [ c.describe() for c in self.application.ws_clients.by('user',user) ]
+
     def on_close(self):
         self.application.unregister_ws_client(self.idx)
         print(f'WebSocket {self.idx} closed {self}')
@@ -114,18 +155,38 @@ class EchoWebSocket(BaseWebsocketHandler):
 
 class MyApp(tornado.web.Application, AuthServerMixin):
 
-    def __init__(self, autoreload=False):
+    def __init__(self, autoreload=False, auth_options=None, session_options=None,
+            upload_options=None, ws_compression=None, ws_heartbeat=None, metrics_token=None):
         self._handlers = []
         self._settings = {}
-        self.initialize(autoreload=autoreload)
+        self._transforms = []
+        self.initialize(autoreload=autoreload,auth_options=auth_options,
+            session_options=session_options,upload_options=upload_options,
+            ws_compression=ws_compression,ws_heartbeat=ws_heartbeat,metrics_token=metrics_token)
 
-        super().__init__(self._handlers,**self._settings)
+        super().__init__(self._handlers,transforms=self._transforms,**self._settings)
 
-    def initialize(self, autoreload=False):
+    def initialize(self, autoreload=False, auth_options=None, session_options=None,
+            upload_options=None, ws_compression=None, ws_heartbeat=None, metrics_token=None):
 
         # Websocket tracking
-        self.ws_client_idx = -1
-        self.ws_clients = {}
+        self.ws_clients = ConnectionRegistry()
+        # A `wscommon.compression.CompressionPolicy` for the echo socket, None for off
+        self.ws_compression = ws_compression
+        # A `wscommon.heartbeat.Heartbeat` that drops echo sockets gone quiet, None for off
+        self.ws_heartbeat = ws_heartbeat
+
+        # Link to the other workers, when running with --workers
+        self.bus = None
+
+        # Counters, served at /metrics; each worker serves its own. Series
+        # per connection name their user, so only behind a token
+        self.metrics = Metrics('server')
+        self.metrics_token = metrics_token
+        self.metrics.collect(connection_metrics(self.ws_clients,'ws',per_connection=metrics_token is not None))
+        self.loop_lag = self.metrics.loop_lag()
+        self.ws_fanout = self.metrics.histogram('ws_fanout_seconds',
+            'Time to write a broadcast to the local websocket clients').labels()
 
         # Handlers
         self._handlers += [
@@ -133,89 +194,232 @@ class MyApp(tornado.web.Application, AuthServerMixin):
             (r"^/api/example/get/?$",ExampleGetHandler),
             (r"^/api/example/post/?$",ExamplePostHandler),
             (r"^/api/example/upload-file/?$",ExampleUploadFile),
-            (r"^/api/example/ws/echo/?$",EchoWebSocket)
+            (r"^/api/example/broadcast/?$",ExampleBroadcastHandler),
+            (r"^/api/example/ws/echo/?$",EchoWebSocket),
+            (r"^/metrics/?$",MetricsHandler)
         ]
         self._handlers += get_account_handlers()
 
         # Get our paths
         _here = Path(__file__).parent
         static_dir = _here/'webresources/static'
+        static_build_dir = _here/'webresources/build/static'
         template_dir = _here/'webresources/templates'
 
+        # Fingerprint and precompress static files once, serve from memory
+        self.static_dirs = (static_dir,static_build_dir)
+        self.static_version = static_version(static_dir) if autoreload else None
+        self.assets = build_assets(static_dir,static_build_dir)
+
+        # Compile every template now rather than on first request
+        self.templates = WarmTemplateLoader(template_dir)
+        self.templates.warm()
+        self.fragments = FragmentCache(self.templates)
+
+        # Uploads are streamed to disk
+        upload_options = dict(upload_options or {})
+        upload_options.setdefault('upload_dir',_here/'uploads')
+        self.uploads = UploadManager(**upload_options)
+
+        # Sessions, signed with a keyring other processes can share
+        self.sessions = SessionManager(**(session_options or {}))
+
         # Settings
         self._settings = dict(
-            cookie_secret= secrets.token_urlsafe(24),
             login_url= "/login",
             static_path= static_dir,
+            static_handler_class= AssetHandler,
+            static_handler_args= dict(bundle=self.assets),
             template_path= template_dir,
+            template_loader= self.templates,
             autoreload= autoreload,
-            gzip= True,
-            xsrf_cookies= True
+            xsrf_cookies= True,
+            **self.sessions.settings()
         )
 
+        # Only gzip what is worth it, in place of `gzip=True`
+        self._transforms = [ gzip_policy(min_length=1024) ]
+
+        # Python changes restart the process; template changes only
+        # recompile what they touch, static changes rebuild the assets
+        self.template_watcher = None
         if autoreload:
-            logging.info('Running autoreload on python source and template directory')
-            for directory, _, files in os.walk(template_dir):
-                [tornado.autoreload.watch(f'{directory}/{f}') for f in files if not f.startswith('.')]
+            logging.info('Running autoreload on python source, template and static directories')
+            self.template_watcher = tornado.ioloop.PeriodicCallback(self._check_for_changes,1000)
+            self.template_watcher.start()
 
         # Example value and heartbeat
         self.heartbeat_count = 0
         self.heartbeat = asyncio.create_task(self._call_heartbeat())
 
         # Setup Auth
-        self.setup_auth()
-
+        self.setup_auth(auth_timing=self.metrics.histogram('auth_seconds',
+            'Time to check a login, by result',labels=('result',)),**(auth_options or {}))
+        self.metrics.gauge('password_pool_pending','Password hashing jobs running or queued',
+            lambda: self.password_pool.pending)
+        if self.ws_heartbeat is not None:
+            self.metrics.collect(lambda: [
+                ('ws_heartbeat_watched','gauge','Websocket clients pinged for liveness',
+                    [({},self.ws_heartbeat.watched)]),
+                ('ws_heartbeat_dead_total','counter','Websocket clients dropped for going quiet',
+                    [({},self.ws_heartbeat.dead)]),
+            ])
+
+
+    def _check_for_changes(self):
+        stale = self.templates.check_for_changes()
+        if stale:
+            self.fragments.invalidate(stale)
+        version = static_version(self.static_dirs[0])
+        if version != self.static_version:
+            logging.info('static files changed, rebuilding assets')
+            self.static_version = version
+            self.assets.replace(build_assets(*self.static_dirs))
+            # Rendered fragments may hold the old fingerprinted urls
+            self.fragments.clear()
 
     async def _call_heartbeat(self):
         while True:
             logging.info(f"heartbeat: {self.heartbeat_count}")
+            logging.info(f"ws clients: {self.ws_clients.status()}")
+            if self.ws_heartbeat is not None:
+                logging.info(f"ws liveness: {self.ws_heartbeat.status()}")
             self.heartbeat_count += 1
+            self.sessions.check_keyring(self.settings)
             await asyncio.sleep(10)
 
     async def on_shutdown(self):
         logging.info('app::on_shutdown >')
         self.heartbeat.cancel()
-        for handler in self.ws_clients.values():
+        self.loop_lag.stop()
+        if self.ws_heartbeat is not None:
+            self.ws_heartbeat.wheel.stop()
+        if self.template_watcher is not None:
+            self.template_watcher.stop()
+        for handler in self.ws_clients.handlers():
             handler.close()
+        if self.bus is not None:
+            self.bus.close()
+        self.uploads.shutdown()
+        self.shutdown_auth()
         logging.info('< app::on_shutdown')
 
     #-- Websocket Tracking ------------------------------------------------#
 
-    def new_ws_client_key(self):
-        ''' Could update to be anything '''
-        self.ws_client_idx += 1
-        return self.ws_client_idx
-
     def register_ws_client(self, handler):
-        idx = self.new_ws_client_key()
-        self.ws_clients[idx] = handler
+        idx = self.ws_clients.add(handler,user=tornado.escape.to_unicode(handler.current_user),
+            remote=handler.request.remote_ip).id
         logging.info('register %s wsclient', idx)
         return idx
 
     def unregister_ws_client(self, idx):
         logging.info('unregister %s wsclient', idx)
-        self.ws_clients.pop(idx)
+        self.ws_clients.remove(idx)
+
+    #-- Cross Worker Broadcast ------------------------------------------------#
+
+    def attach_bus(self, bus):
+        self.bus = bus
+        asyncio.create_task(bus.run(self._on_bus_message),name="worker bus")
+
+    def broadcast(self, message):
+        ''' Send to every websocket client, in every worker '''
+        self._deliver_local(message)
+        if self.bus is not None:
+            self.bus.publish(message)
+
+    def _on_bus_message(self, payload):
+        self._deliver_local(payload.decode('utf-8'))
+
+    def _deliver_local(self, message):
+        t0 = time.perf_counter()
+        for handler in self.ws_clients.handlers():
+            handler.write_message(message)
+        self.ws_fanout.observe(time.perf_counter()-t0)
 
 
 #-- Main -------------------------------------------------------------------------#
 
-async def main():
-    # Command line arguments
+def parse_args():
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=1,
+        help='Pre-fork this many server processes sharing the port')
     parser.add_argument('--autoreload', action='store_true', help='Autoreload server code')
+    parser.add_argument('--hash-workers', type=int, default=4, help='Threads for bcrypt work')
+    parser.add_argument('--hash-max-pending', type=int, default=64,
+        help='Password jobs allowed in flight before answering 503')
+    parser.add_argument('--bcrypt-target-ms', type=float, default=None,
+        help='Calibrate the bcrypt cost to about this many ms per hash')
+    parser.add_argument('--cred-cache-ttl', type=float, default=0,
+        help='Seconds to remember successful logins (0 disables)')
+    parser.add_argument('--user-db', default=None,
+        help='SQLite file for users and invites (default keeps them in memory)')
+    parser.add_argument('--session-keyring', default=None,
+        help='Json keyring for signing sessions (default is a per-process secret)')
+    parser.add_argument('--session-max-age-days', type=float, default=7)
+    parser.add_argument('--rotate-session-key', action='store_true',
+        help='Add a new signing key to --session-keyring and exit')
+    parser.add_argument('--upload-dir', default=None, help='Where uploads are written')
+    parser.add_argument('--upload-quota-mb', type=float, default=1024,
+        help='Storage each user may use for uploads')
+    parser.add_argument('--upload-max-concurrent', type=int, default=2,
+        help='Uploads each user may run at once')
+    parser.add_argument('--ws-compression', type=int, default=None, metavar='THRESHOLD',
+        help='Negotiate permessage-deflate on the echo socket, for messages of THRESHOLD bytes or more')
+    parser.add_argument('--ws-ping-interval', type=float, default=20,
+        help='Seconds between websocket pings (0 disables)')
+    parser.add_argument('--ws-ping-timeout', type=float, default=10,
+        help='Seconds a ping may go unanswered before the socket is dropped')
+    parser.add_argument('--metrics-token', default=None,
+        help='Bearer token /metrics requires, which then also has per-connection series')
     args = parser.parse_args()
 
-    # Setup logging
-    logging.basicConfig(level=logging.INFO)
-    # Suppress 200 and 30* HTTP logging
-    access_log = logging.getLogger("tornado.access")
-    access_log.setLevel(logging.WARNING)
+    if args.rotate_session_key and args.session_keyring is None:
+        parser.error('--rotate-session-key needs --session-keyring')
+    if args.workers > 1:
+        if args.autoreload:
+            parser.error('--autoreload only works with a single worker')
+        if args.session_keyring is None:
+            logging.warning('--workers without --session-keyring: sessions only work on one worker')
+    return args
 
+async def serve(args, bus_sock=None):
     # Setup the server
-    tornado_app = MyApp(autoreload=args.autoreload)
-    tornado_app.listen(8888)
-    logging.info('running at localhost:8888')
+    auth_options = dict(
+        hash_workers= args.hash_workers,
+        hash_max_pending= args.hash_max_pending,
+        bcrypt_target_ms= args.bcrypt_target_ms,
+        cred_cache_ttl= args.cred_cache_ttl,
+        user_store= SQLiteUserStore(args.user_db) if args.user_db else None
+    )
+    session_options = dict(
+        keyring_path= args.session_keyring,
+        max_age_days= args.session_max_age_days
+    )
+    upload_options = dict(
+        quota_bytes= int(args.upload_quota_mb*1024*1024),
+        max_concurrent= args.upload_max_concurrent
+    )
+    if args.upload_dir:
+        upload_options['upload_dir'] = args.upload_dir
+    ws_compression = None
+    if args.ws_compression is not None:
+        ws_compression = CompressionPolicy(threshold=args.ws_compression)
+    ws_heartbeat = None
+    if args.ws_ping_interval > 0:
+        ws_heartbeat = Heartbeat(interval=args.ws_ping_interval,timeout=args.ws_ping_timeout)
+    tornado_app = MyApp(autoreload=args.autoreload,auth_options=auth_options,
+        session_options=session_options,upload_options=upload_options,
+        ws_compression=ws_compression,ws_heartbeat=ws_heartbeat,metrics_token=args.metrics_token)
+    if bus_sock is None:
+        http_server = tornado_app.listen(args.port)
+    else:
+        # Each worker binds its own socket and the kernel spreads connections
+        tornado_app.attach_bus(WorkerBus(bus_sock))
+        http_server = tornado_app.listen(args.port,reuse_port=True)
+    logging.info('running at localhost:%s (pid %s)', args.port, os.getpid())
 
     # Setup the shutdown systems
     shutdown_trigger = asyncio.Event()
@@ -228,6 +432,7 @@ async def main():
             is_shutdown_triggered = True
             logging.info("shutdown start...")
             try:
+                http_server.stop()
                 await tornado_app.on_shutdown()
             except Exception as e:
                 logging.error(f"Error on shutdown: {e}")
@@ -246,5 +451,27 @@ async def main():
     await shutdown_trigger.wait()
 
 
+def main():
+    # Setup logging
+    logging.basicConfig(level=logging.INFO)
+    # Suppress 200 and 30* HTTP logging
+    access_log = logging.getLogger("tornado.access")
+    access_log.setLevel(logging.WARNING)
+
+    # Command line arguments
+    args = parse_args()
+
+    if args.rotate_session_key:
+        rotate_keyring(args.session_keyring)
+    elif args.workers > 1:
+        if args.session_keyring is not None:
+            # Made here if need be, so the workers all load the same keys
+            # rather than each writing its own
+            load_keyring(args.session_keyring)
+        run_workers(args.workers,lambda idx,bus_sock: asyncio.run(serve(args,bus_sock)))
+    else:
+        asyncio.run(serve(args))
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 # Python
 import functools
+import logging
 import urllib.parse
 from urllib.parse import urlencode
 # Tornado
@@ -47,7 +48,7 @@ class SignupHandler(BaseHandler):
 
     def get(self):
         if self.current_user is not None:
-            self.render('accounts/loggedin.html',user=self.current_user)
+            self.render_cached('accounts/loggedin.html',self.current_user,user=self.current_user)
         else:
             error = self.get_query_argument('error', '')
             self.render('accounts/signup.html',error=error)
@@ -59,13 +60,13 @@ class SignupHandler(BaseHandler):
         password2 = self.get_argument("password2",None)
 
         resp = { 'success': False }
-        if not self.application.has_invite(invite):
-            self.set_status(40)
+        if not await self.application.has_invite(invite):
+            self.set_status(400)
             resp['error'] = 'Invalid invite'
         elif username == '':
             self.set_status(400)
             resp['error'] = 'Empty username'
-        elif self.application.has_username(username):
+        elif await self.application.has_username(username):
             self.set_status(403)
             resp['error'] = 'Already that user'
         elif password1 == '':
@@ -75,24 +76,34 @@ class SignupHandler(BaseHandler):
             self.set_status(400)
             resp['error'] = 'Passwords do not match'
         else:
-            await self.application.create_user(username,password1)
-            self.set_secure_cookie("user",username)
-            self.application.remove_invite(invite)
-            resp['success'] = True
-            resp['next'] = '/welcome'
+            try:
+                created = await self.application.create_user(username,password1,invite=invite)
+            except KeyError:
+                # Another request (maybe another process) used it meanwhile
+                created = None
+            if created is None:
+                self.set_status(400)
+                resp['error'] = 'Invalid invite'
+            elif not created:
+                self.set_status(403)
+                resp['error'] = 'Already that user'
+            else:
+                self.application.sessions.set_user(self,username)
+                resp['success'] = True
+                resp['next'] = '/welcome'
 
         self.write_json(resp)
 
 class WelcomeHandler(BaseHandler):
     @authenticated(action='login')
     def get(self):
-        self.render('accounts/welcome.html',user=self.current_user)
+        self.render_cached('accounts/welcome.html',self.current_user,user=self.current_user)
 
 
 class LoginHandler(BaseHandler):
     def get(self):
         if self.current_user is not None:
-            self.render('accounts/loggedin.html',user=self.current_user)
+            self.render_cached('accounts/loggedin.html',self.current_user,user=self.current_user)
         else:
             next_url = self.get_query_argument('next', '/')
             error = self.get_query_argument('error', '')
@@ -106,13 +117,13 @@ class LoginHandler(BaseHandler):
             self.set_status(403)
             self.redirect(f"/login?next={self.get_argument('next', '/')}&error=Error")
         else:
-            self.set_secure_cookie("user",username)
+            self.application.sessions.set_user(self,username)
             self.redirect(self.get_argument('next', '/'))
 
 class AccountHandler(BaseHandler):
     @authenticated(action='login')
     def get(self):
-        self.render('accounts/account.html',user=self.current_user, error='')
+        self.render_cached('accounts/account.html',self.current_user,user=self.current_user, error='')
 
 class ChangePasswordHandler(BaseHandler):
     @authenticated()
@@ -144,8 +155,8 @@ class ChangePasswordHandler(BaseHandler):
 
 class LogoutHandler(BaseHandler):
     def get(self):
-        self.clear_cookie("user")
-        self.render('accounts/logout.html')
+        self.application.sessions.clear_user(self)
+        self.render_cached('accounts/logout.html')
 
 def get_account_handlers():
     return [
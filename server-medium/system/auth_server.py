@@ -2,74 +2,142 @@
 
 # Python
 import logging
+import time
 # Tools
 import bcrypt
 # Local
 from .utils import as_string, as_bytes
+from .hashing import PasswordPool, PasswordPoolSaturated, calibrate_rounds
+from .credcache import VerifiedCredentialCache
+from .user_store import MemoryUserStore
 
 
 class AuthServerMixin:
 
-    def setup_auth(self):
+    def setup_auth(self, hash_workers=4, hash_max_pending=64, bcrypt_target_ms=None,
+            cred_cache_ttl=0, cred_cache_size=1024, user_store=None, auth_timing=None):
 
-        # Example simple user map, don't do in real life!
-        self.user_map = {
+        # All bcrypt work goes through this pool, never on the loop.
+        # With a target time the cost is fit to this machine, and older
+        # hashes are upgraded on their next successful login.
+        rounds = 12
+        if bcrypt_target_ms:
+            rounds = calibrate_rounds(bcrypt_target_ms/1000)
+        self.password_pool = PasswordPool(workers=hash_workers,max_pending=hash_max_pending,
+            rounds=rounds)
+
+        # Opt-in cache of recent successful checks
+        self.cred_cache = None
+        if cred_cache_ttl > 0:
+            self.cred_cache = VerifiedCredentialCache(ttl=cred_cache_ttl,max_entries=cred_cache_size)
+
+        # A histogram family labelled by result (see `wscommon.metrics`)
+        # that login checks are timed into, if given
+        self.auth_timing = auth_timing
+
+        # Users and invites live in a store, in memory unless one is given
+        self.user_store = user_store if user_store is not None else MemoryUserStore()
+
+        # Example seed users, don't do in real life!
+        users = {
             'tester': b'tester',
             'admin': b'admin'
         }
-        for k in self.user_map.keys():
-            self.user_map[k] = bcrypt.hashpw(self.user_map[k],bcrypt.gensalt())
+        for k in users.keys():
+            users[k] = bcrypt.hashpw(users[k],bcrypt.gensalt(rounds=rounds))
+        self.user_store.seed(users,[ 'apple', 'pancake'])
 
-        # invites
-        self.invites = [ 'apple', 'pancake']
+    def shutdown_auth(self):
+        self.password_pool.shutdown()
+        self.user_store.close()
 
     #-- New Users ------------------------------------------------#
 
-    def has_invite(self, invite):
-        return invite in self.invites
+    async def has_invite(self, invite):
+        return await self.user_store.has_invite(invite)
 
-    def remove_invite(self, invite):
-        self.invites.remove(invite)
+    async def remove_invite(self, invite):
+        return await self.user_store.remove_invite(invite)
 
-    def has_username(self, username):
-        return username in self.user_map
+    async def has_username(self, username):
+        return await self.user_store.has_username(username)
 
-    async def create_user(self, username, password):
+    async def create_user(self, username, password, invite=None):
+        '''
+        Returns False if another request took the username first. An
+        `invite` is used up only along with creating the user, and raises
+        KeyError if another request used it first.
+        '''
         username = as_string(username)
         password = as_bytes(password)
-        hpw = bcrypt.hashpw(password,bcrypt.gensalt()) # could run in executor
-        self.user_map[username] = hpw
+        # First, so a saturated pool (503) leaves the invite alone
+        hpw = await self.password_pool.hashpw(password)
+        if invite is not None and not await self.user_store.remove_invite(invite):
+            raise KeyError(invite)
+        if not await self.user_store.add_user(username,hpw):
+            if invite is not None:
+                await self.user_store.restore_invite(invite)
+            return False
         logging.info('created user: %s', username)
+        return True
 
     #-- Current Users ------------------------------------------------#
 
-    def get_user_password_hash(self, username):
-        # raise Exception('Implement')
-        return self.user_map[username]
+    async def get_user_password_hash(self, username):
+        pwh = await self.user_store.get_password_hash(username)
+        if pwh is None:
+            raise KeyError(username)
+        return pwh
 
-    def set_user_password_hash(self, username, password_hash):
-        # raise Exception('Implement')
-        self.user_map[username] = password_hash
+    async def set_user_password_hash(self, username, password_hash):
+        await self.user_store.set_password_hash(username,password_hash)
 
     async def _validate_user_creds(self, username, password):
         ''' Obviously update this to something better '''
+        t0 = time.perf_counter()
+        result = 'error' # the pool was saturated, say
+        try:
+            result = await self._check_user_creds(username,password)
+        finally:
+            if self.auth_timing is not None:
+                self.auth_timing.labels(result).observe(time.perf_counter()-t0)
+        return result in ('ok','cached')
+
+    async def _check_user_creds(self, username, password):
+        ''' One of "ok", "cached", "fail" or "no_user" '''
         username = as_string(username)
         password = as_bytes(password)
         try:
-            pwh = self.get_user_password_hash(username)
-            success = bcrypt.checkpw(password,pwh)
-            if not success:
-                logging.warning(f'Failed validation attempt for user: %s', username)
-            return success
+            pwh = await self.get_user_password_hash(username)
         except KeyError:
             logging.warning(f'No user: %s', username)
-            return False
+            return 'no_user'
+
+        if self.cred_cache is not None and self.cred_cache.check(username,password,pwh):
+            return 'cached'
+
+        success = await self.password_pool.checkpw(password,pwh)
+        if not success:
+            logging.warning(f'Failed validation attempt for user: %s', username)
+            return 'fail'
+
+        if self.password_pool.needs_rehash(pwh):
+            try:
+                pwh = await self.password_pool.hashpw(password)
+                await self.set_user_password_hash(username,pwh)
+                logging.info('rehashed password for user: %s', username)
+            except PasswordPoolSaturated:
+                pass # Try again next login
+        if self.cred_cache is not None:
+            self.cred_cache.add(username,password,pwh)
+        return 'ok'
 
     async def _update_user_creds(self, username, password):
         if isinstance(username,bytes):
             username = username.decode('utf-8')
         if isinstance(password,str):
             password = password.encode('utf-8')
-        hpw = bcrypt.hashpw(password,bcrypt.gensalt())
-        print(username,password,hpw)
-        self.set_user_password_hash(username,hpw)
+        hpw = await self.password_pool.hashpw(password)
+        await self.set_user_password_hash(username,hpw)
+        if self.cred_cache is not None:
+            self.cred_cache.invalidate_user(username)
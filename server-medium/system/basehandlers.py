@@ -1,21 +1,58 @@
 # Copyright 2022 Jeffrey LeBlanc
 
-# Python
-import json
 # Tornado
 import tornado.web
+import tornado.websocket
+# Local
+from .jsonenc import dumps, dumps_in_executor
 
 
 class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self):
-        return self.get_secure_cookie("user")
+        return self.application.sessions.get_user(self)
 
     def write_json(self, obj, indent=None):
+        ''' Compact JSON (no spaces after `,` or `:`) unless indented, see `jsonenc` '''
         self.set_header("Content-Type", "application/json")
-        s = json.dumps(obj,indent=indent)
-        self.write(s)
+        self.write(dumps(obj,indent=indent))
+
+    async def write_json_large(self, obj, indent=None):
+        ''' Like `write_json`, but encodes off the loop; for very large payloads '''
+        self.set_header("Content-Type", "application/json")
+        self.write(await dumps_in_executor(obj,indent=indent))
+
+    async def write_json_stream(self, items, batch=500):
+        '''
+        Write any iterable (a generator, a db cursor...) as a json list,
+        flushing every `batch` items so the whole list is never in memory.
+        '''
+        self.set_header("Content-Type", "application/json")
+        self.write(b'[')
+        sep = b''
+        buf = []
+        for item in items:
+            buf.append(dumps(item))
+            if len(buf) >= batch:
+                self.write(sep+b','.join(buf))
+                sep = b','
+                buf = []
+                await self.flush()
+        if buf:
+            self.write(sep+b','.join(buf))
+        self.write(b']')
+
+    def render_fragment(self, template_name, cache_key=(), **kwargs):
+        '''
+        `render_string`, cached by template and `cache_key`. The output must
+        depend only on those, so nothing per-request like xsrf tokens.
+        '''
+        return self.application.fragments.get_or_render(template_name,cache_key,
+            lambda: self.render_string(template_name,**kwargs))
+
+    def render_cached(self, template_name, cache_key=(), **kwargs):
+        ''' `render` for whole pages that qualify for `render_fragment` '''
+        self.finish(self.render_fragment(template_name,cache_key,**kwargs))
 
 class BaseWebsocketHandler(tornado.websocket.WebSocketHandler):
     def get_current_user(self):
-        return self.get_secure_cookie("user")
-
+        return self.application.sessions.get_user(self)
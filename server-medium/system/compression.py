@@ -0,0 +1,34 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Tornado
+from tornado.web import GZipContentEncoding
+
+
+class _GZipPolicy(GZipContentEncoding):
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        # Handlers serving their own encodings already set Vary
+        vary = headers.get('Vary')
+        status_code, headers, chunk = super().transform_first_chunk(
+            status_code,headers,chunk,finishing)
+        if vary is not None and 'Accept-Encoding' in vary:
+            headers['Vary'] = vary
+        return status_code, headers, chunk
+
+
+def gzip_policy(min_length=1024, level=6, extra_types=()):
+    '''
+    A response compression transform, to pass as the application's
+    `transforms` instead of `gzip=True`.
+
+    Only compressible content types of at least `min_length` bytes are
+    gzipped, so small JSON replies are sent as-is. Streamed (multi-chunk)
+    responses are always gzipped since their size is not known up front.
+    Responses that already carry a Content-Encoding, such as precompressed
+    static files, are passed through untouched.
+    '''
+    return type('GZipPolicy',(_GZipPolicy,),dict(
+        MIN_LENGTH= min_length,
+        GZIP_LEVEL= level,
+        CONTENT_TYPES= GZipContentEncoding.CONTENT_TYPES | set(extra_types)
+    ))
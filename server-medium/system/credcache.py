@@ -0,0 +1,64 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import collections
+import hashlib
+import hmac
+import secrets
+import time
+
+
+class VerifiedCredentialCache:
+
+    '''
+    Remembers recent successful password checks so a user logging in again
+    (second tab, reconnect storm) skips bcrypt.
+
+    Entries are keyed by an HMAC, under a per-process random key, of the
+    username, the password and the stored hash. Plain passwords are never
+    kept, and a changed hash can never match an old entry. Entries expire
+    after `ttl` seconds and the least recently used are evicted past
+    `max_entries`.
+    '''
+
+    def __init__(self, ttl=300, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._key = secrets.token_bytes(32)
+        self._entries = collections.OrderedDict() # digest => (username, expires)
+        self._digests_by_user = collections.defaultdict(set)
+
+    def _digest(self, username, password, password_hash):
+        msg = b'\0'.join((username.encode('utf-8'),password,password_hash))
+        return hmac.new(self._key,msg,hashlib.sha256).digest()
+
+    def check(self, username, password, password_hash):
+        digest = self._digest(username,password,password_hash)
+        entry = self._entries.get(digest)
+        if entry is None:
+            return False
+        if entry[1] < time.monotonic():
+            self._drop(digest)
+            return False
+        self._entries.move_to_end(digest)
+        return True
+
+    def add(self, username, password, password_hash):
+        digest = self._digest(username,password,password_hash)
+        self._entries[digest] = (username,time.monotonic()+self.ttl)
+        self._entries.move_to_end(digest)
+        self._digests_by_user[username].add(digest)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate_user(self, username):
+        for digest in self._digests_by_user.pop(username,()):
+            self._entries.pop(digest,None)
+
+    def _drop(self, digest):
+        username,_ = self._entries.pop(digest)
+        digests = self._digests_by_user.get(username)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._digests_by_user[username]
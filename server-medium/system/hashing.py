@@ -0,0 +1,87 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+# Tools
+import bcrypt
+# Tornado
+import tornado.web
+
+
+class PasswordPoolSaturated(tornado.web.HTTPError):
+    '''
+    Raised when the password pool already has `max_pending` jobs.
+    Being an `HTTPError`, handlers that let it propagate answer with a 503.
+    '''
+    def __init__(self):
+        super().__init__(503,reason='Password service busy')
+
+
+class PasswordPool:
+
+    '''
+    Runs bcrypt hashing and checking off of the event loop.
+
+    bcrypt releases the GIL while it works, so a thread pool is enough to
+    keep the loop (and every websocket on it) responsive during a burst of
+    logins. Jobs beyond `max_pending` (running + queued) are rejected
+    immediately instead of piling up behind each other.
+    '''
+
+    def __init__(self, workers=4, max_pending=64, rounds=12):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers,thread_name_prefix='pwpool')
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            logging.warning('password pool saturated (%s pending)', self.pending)
+            raise PasswordPoolSaturated()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor,fn,*args)
+        finally:
+            self.pending -= 1
+
+    async def hashpw(self, password):
+        return await self._run(_hashpw,password,self.rounds)
+
+    async def checkpw(self, password, password_hash):
+        return await self._run(bcrypt.checkpw,password,password_hash)
+
+    def needs_rehash(self, password_hash):
+        return hash_rounds(password_hash) != self.rounds
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False,cancel_futures=True)
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password,bcrypt.gensalt(rounds=rounds))
+
+def hash_rounds(password_hash):
+    ''' The cost factor of a hash like b'$2b$12$...' '''
+    return int(password_hash.split(b'$')[2])
+
+def calibrate_rounds(target_seconds, min_rounds=10, max_rounds=16):
+    '''
+    Pick the bcrypt cost whose hash time is closest to, without exceeding,
+    `target_seconds` on this machine. Each extra round doubles the work, so
+    one timing at `min_rounds` is enough to extrapolate from.
+    '''
+    t0 = time.perf_counter()
+    bcrypt.hashpw(b'calibration',bcrypt.gensalt(rounds=min_rounds))
+    elapsed = time.perf_counter()-t0
+
+    rounds = min_rounds
+    while rounds < max_rounds and elapsed*2 <= target_seconds:
+        rounds += 1
+        elapsed *= 2
+    logging.info('bcrypt calibrated to %s rounds (~%.0fms)', rounds, 1000*elapsed)
+    return rounds
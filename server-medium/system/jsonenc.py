@@ -0,0 +1,53 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+# Optional fast encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+JSON encoding for responses.
+
+Uses orjson when it is installed and the stdlib otherwise. orjson can
+only indent by 2, so other indents fall back to the stdlib, as does
+anything orjson will not encode (ints over 64 bits, say).
+
+The stdlib is set up to come close to orjson: compact separators (no
+space after `,` or `:`), non-ascii written as raw utf-8 rather than
+`\\uXXXX` escapes, and non-str keys turned into strings. The output is
+still not byte for byte the same:
+* NaN and Infinity become null with orjson, and raise ValueError with
+  the stdlib rather than writing the invalid `NaN`.
+* Floats may be spelled differently, e.g. `1e16` against `1e+16`.
+Past those, the two parse back to the same values.
+
+`dumps_in_executor` is for very large payloads. Neither encoder releases
+the GIL, but running on a thread lets the interpreter switch back to the
+loop every few ms instead of stalling it for the whole encode.
+'''
+
+_executor = None
+
+def dumps(obj, indent=None):
+    if orjson is not None and indent in (None,2):
+        option = orjson.OPT_NON_STR_KEYS|(orjson.OPT_INDENT_2 if indent == 2 else 0)
+        try:
+            return orjson.dumps(obj,option=option)
+        except TypeError:
+            pass
+    separators = (',',':') if indent is None else None
+    return json.dumps(obj,indent=indent,separators=separators,
+        ensure_ascii=False,allow_nan=False).encode('utf-8')
+
+async def dumps_in_executor(obj, indent=None):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2,thread_name_prefix='json')
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor,dumps,obj,indent)
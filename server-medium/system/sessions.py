@@ -0,0 +1,142 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import collections
+import json
+import logging
+import os
+import secrets
+import time
+from pathlib import Path
+
+
+'''
+Sessions are stateless signed cookies (tornado's secure cookies), so any
+process holding the same keyring can read them.
+
+The keyring is a json file:
+
+    {"current": 2, "keys": {"1": "...", "2": "..."}}
+
+New cookies are signed with `current`, and any key still in the file
+verifies old ones. Rotation adds a key and drops the oldest past `keep`.
+Running servers pick up a changed file on their next `check_keyring`.
+
+See <https://www.tornadoweb.org/en/stable/web.html#tornado.web.RequestHandler.get_signed_cookie>
+'''
+
+
+def load_keyring(path):
+    ''' Read the keyring at `path`, making one if it does not exist '''
+    path = Path(path)
+    if not path.exists():
+        _write_keyring(path,{'current':1,'keys':{'1':secrets.token_urlsafe(32)}})
+        logging.info('created session keyring at %s', path)
+    data = json.loads(path.read_text())
+    keys = { int(v):k for v,k in data['keys'].items() }
+    return keys, int(data['current'])
+
+def rotate_keyring(path, keep=3):
+    path = Path(path)
+    keys, current = load_keyring(path)
+    current = max(keys)+1
+    keys[current] = secrets.token_urlsafe(32)
+    for version in sorted(keys)[:-keep]:
+        del keys[version]
+    _write_keyring(path,{'current':current,'keys':{str(v):k for v,k in keys.items()}})
+    logging.info('rotated session keyring %s to version %s', path, current)
+
+def _write_keyring(path, data):
+    # Write then rename, so readers never see a partial file
+    tmp = path.with_suffix('.tmp')
+    fd = os.open(tmp,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600)
+    with os.fdopen(fd,'w') as f:
+        json.dump(data,f)
+    os.replace(tmp,path)
+
+
+class SessionManager:
+
+    '''
+    Reads and writes the "user" cookie for handlers.
+
+    Checking a cookie costs an HMAC and some parsing, so raw cookie values
+    that already verified are kept in a small LRU for `cache_ttl` seconds.
+    A cached session can therefore outlive `max_age_days` by at most
+    `cache_ttl`.
+    '''
+
+    COOKIE = 'user'
+
+    def __init__(self, keyring_path=None, max_age_days=7, cache_size=4096, cache_ttl=60):
+        self.keyring_path = keyring_path
+        self.max_age_days = max_age_days
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache = collections.OrderedDict() # raw value => (user, expires)
+        self._keyring_mtime = None
+
+        if keyring_path is None:
+            # Sessions only live as long as this process
+            self.cookie_secret = secrets.token_urlsafe(24)
+            self.key_version = None
+        else:
+            self._load()
+
+    def _load(self):
+        keys, version = load_keyring(self.keyring_path)
+        mtime = os.stat(self.keyring_path).st_mtime
+        self.cookie_secret, self.key_version, self._keyring_mtime = keys, version, mtime
+
+    def settings(self):
+        ''' Application settings for signing cookies '''
+        return dict(cookie_secret=self.cookie_secret,key_version=self.key_version)
+
+    def check_keyring(self, app_settings):
+        ''' Reload the keyring if its file changed, keeping the current keys if it cannot be read '''
+        if self.keyring_path is None:
+            return
+        try:
+            mtime = os.stat(self.keyring_path).st_mtime
+            if mtime == self._keyring_mtime:
+                return
+            self._load()
+        except (OSError,ValueError,KeyError) as e:
+            # Removed, or caught mid-rotation; try again next time
+            logging.warning('keeping session keyring version %s, cannot read %s: %s',
+                self.key_version, self.keyring_path, e)
+            return
+        app_settings.update(self.settings())
+        self._cache.clear()
+        logging.info('reloaded session keyring at version %s', self.key_version)
+
+    #-- Handler API ------------------------------------------------#
+
+    def get_user(self, handler):
+        raw = handler.get_cookie(self.COOKIE)
+        if not raw:
+            return None
+
+        now = time.monotonic()
+        entry = self._cache.get(raw)
+        if entry is not None:
+            if entry[1] > now:
+                self._cache.move_to_end(raw)
+                return entry[0]
+            del self._cache[raw]
+
+        user = handler.get_secure_cookie(self.COOKIE,value=raw,max_age_days=self.max_age_days)
+        if user is not None:
+            self._cache[raw] = (user,now+self.cache_ttl)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return user
+
+    def set_user(self, handler, username):
+        handler.set_secure_cookie(self.COOKIE,username,expires_days=self.max_age_days)
+
+    def clear_user(self, handler):
+        raw = handler.get_cookie(self.COOKIE)
+        if raw:
+            self._cache.pop(raw,None)
+        handler.clear_cookie(self.COOKIE)
@@ -0,0 +1,237 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+from pathlib import Path
+# Tornado
+import tornado.web
+# Optional brotli
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+'''
+Static assets built once and then served from memory.
+
+`build_assets` copies every file in the static directory to
+`<name>.<hash>.<ext>` in a build directory, next to `.gz` (and `.br` when
+the brotli package is installed) versions, and writes a manifest. Builds
+are incremental, so files whose hash already exists are not recompressed.
+It runs at startup, or offline with:
+
+    python -m system.static_assets webresources/static webresources/build/static
+
+`AssetHandler` is used as the `static_handler_class`, so templates keep
+calling `static_url('main.css')` and get the fingerprinted url. Since a
+fingerprinted url never changes content, it is served with an immutable
+one year cache. The variant that matches Accept-Encoding (q values
+respected) is picked and sent straight from memory, with no hashing or
+compressing per request. Each variant has its own ETag, `"<hash>"`,
+`"<hash>-gz"` or `"<hash>-br"`, since caches must not swap one for another.
+
+`static_version` lets a dev server (--autoreload) spot changes and build
+again, with `AssetBundle.replace` swapping the result in under the
+handlers.
+'''
+
+ENCODINGS = ('br','gzip') # preferred first
+VARIANTS = (('gzip','.gz'),('br','.br')) # encoding, file suffix
+FINGERPRINT_LENGTH = 12
+
+
+class Asset:
+
+    __slots__ = ('url_path','content_type','etags','bodies')
+
+    def __init__(self, url_path, content_type, etags, bodies):
+        self.url_path = url_path
+        self.content_type = content_type
+        self.etags = etags    # encoding => ETag of that body
+        self.bodies = bodies  # encoding ('identity','gzip','br') => bytes
+
+
+class AssetBundle:
+
+    def __init__(self, manifest, assets):
+        self.manifest = manifest  # logical path => fingerprinted path
+        self.assets = assets      # fingerprinted path => Asset
+
+    @classmethod
+    def load(cls, build_dir):
+        build_dir = Path(build_dir)
+        manifest = json.loads((build_dir/'manifest.json').read_text())
+        assets = {}
+        for logical,url_path in manifest.items():
+            content_type,_ = mimetypes.guess_type(logical)
+            bodies = { 'identity': (build_dir/url_path).read_bytes() }
+            digest = hashlib.sha256(bodies['identity']).hexdigest()[:FINGERPRINT_LENGTH]
+            etags = { 'identity': f'"{digest}"' }
+            for encoding,suffix in VARIANTS:
+                path = build_dir/(url_path+suffix)
+                if path.exists():
+                    bodies[encoding] = path.read_bytes()
+                    etags[encoding] = f'"{digest}-{suffix[1:]}"'
+            assets[url_path] = Asset(url_path,content_type or 'application/octet-stream',etags,bodies)
+        return cls(manifest,assets)
+
+    def replace(self, other):
+        ''' Take over `other`'s assets, for handlers already holding this bundle '''
+        self.manifest = other.manifest
+        self.assets = other.assets
+
+
+def fingerprinted_name(rel_path, digest):
+    stem,dot,ext = rel_path.rpartition('.')
+    if not dot:
+        return f'{rel_path}.{digest}'
+    return f'{stem}.{digest}.{ext}'
+
+def build_assets(static_dir, build_dir):
+    static_dir = Path(static_dir)
+    build_dir = Path(build_dir)
+    manifest = {}
+    for directory,_,files in os.walk(static_dir):
+        for name in files:
+            if name.startswith('.'):
+                continue
+            src = Path(directory)/name
+            rel_path = src.relative_to(static_dir).as_posix()
+            data = src.read_bytes()
+            digest = hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]
+            url_path = fingerprinted_name(rel_path,digest)
+            manifest[rel_path] = url_path
+
+            out = build_dir/url_path
+            if out.exists():
+                continue
+            out.parent.mkdir(parents=True,exist_ok=True)
+            _write(out,data)
+            _write(out.with_name(out.name+'.gz'),gzip.compress(data,compresslevel=9,mtime=0))
+            if brotli is not None:
+                _write(out.with_name(out.name+'.br'),brotli.compress(data))
+            logging.info('built static asset %s', url_path)
+
+    build_dir.mkdir(parents=True,exist_ok=True)
+    _write(build_dir/'manifest.json',json.dumps(manifest,indent=2).encode('utf-8'))
+    return AssetBundle.load(build_dir)
+
+def _write(path, data):
+    # Workers may build at the same time, so each writes its own temp file
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp,path)
+
+def static_version(static_dir):
+    ''' Changes whenever a file `build_assets` would copy is added, removed or modified '''
+    version = []
+    for directory,_,files in os.walk(static_dir):
+        for name in files:
+            if name.startswith('.'):
+                continue
+            stat = os.stat(os.path.join(directory,name))
+            version.append((directory,name,stat.st_mtime_ns,stat.st_size))
+    return sorted(version)
+
+
+def accepted_encodings(header):
+    ''' Parse Accept-Encoding into {coding: q}, keeping codings refused with q=0 '''
+    accepted = {}
+    for item in header.split(','):
+        coding,_,params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key,_,value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+def pick_encoding(header, available):
+    '''
+    The acceptable encoding in `available` with the highest q, ties going
+    to the order of ENCODINGS, or 'identity' if none is acceptable.
+    '''
+    accepted = accepted_encodings(header)
+    best,best_q = 'identity',0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding,accepted.get('*',0))
+        if encoding in available and q > best_q:
+            best,best_q = encoding,q
+    return best
+
+
+class AssetHandler(tornado.web.RequestHandler):
+
+    '''
+    Serves an `AssetBundle`, passed as `static_handler_args=dict(bundle=...)`.
+    Unfingerprinted paths are still served, but revalidated on every use.
+    '''
+
+    CACHE_FOREVER = 'public, max-age=31536000, immutable'
+    CACHE_REVALIDATE = 'no-cache'
+
+    def initialize(self, path=None, default_filename=None, bundle=None):
+        self.bundle = bundle
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        bundle = settings['static_handler_args']['bundle']
+        prefix = settings.get('static_url_prefix','/static/')
+        return prefix+bundle.manifest.get(path,path)
+
+    def head(self, path):
+        return self.get(path,include_body=False)
+
+    def get(self, path, include_body=True):
+        asset = self.bundle.assets.get(path)
+        cache_control = self.CACHE_FOREVER
+        if asset is None:
+            url_path = self.bundle.manifest.get(path)
+            if url_path is None:
+                raise tornado.web.HTTPError(404)
+            asset = self.bundle.assets[url_path]
+            cache_control = self.CACHE_REVALIDATE
+
+        encoding = pick_encoding(self.request.headers.get('Accept-Encoding',''),asset.bodies)
+        self.set_header('Cache-Control',cache_control)
+        self.set_header('Vary','Accept-Encoding')
+        self.set_header('Etag',asset.etags[encoding])
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        body = asset.bodies[encoding]
+        self.set_header('Content-Type',asset.content_type)
+        if encoding != 'identity':
+            self.set_header('Content-Encoding',encoding)
+        if include_body:
+            self.write(body)
+        else:
+            self.set_header('Content-Length',len(body))
+
+    def compute_etag(self):
+        # Already set from the content hash
+        return None
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        sys.exit('usage: python -m system.static_assets STATIC_DIR BUILD_DIR')
+    build_assets(sys.argv[1],sys.argv[2])
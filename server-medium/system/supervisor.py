@@ -0,0 +1,263 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import collections
+import logging
+import os
+import selectors
+import signal
+import socket
+import struct
+import time
+# Tornado
+from tornado.iostream import IOStream, StreamClosedError
+
+
+'''
+Pre-forked workers for running one server on several cores.
+
+The supervisor process forks `num_workers` children and then only:
+* restarts any child that exits on its own (a crash), up to
+  `max_restarts` in any `restart_window` seconds,
+* forwards SIGINT/SIGTERM so each child runs its own graceful shutdown,
+* relays bus frames from each child to all the others.
+
+Each child gets one end of a socketpair as its `WorkerBus`. Frames are a
+4 byte big-endian length followed by the payload.
+
+The supervisor's ends are non-blocking, and each child has an output
+buffer of whole frames, so a slow child never holds up the others. Past
+`max_buffered` bytes a child misses frames (whole ones, so its stream
+stays in step) until it has caught up. A child whose bus is cut is stopped
+and restarted, rather than left serving without it.
+
+The supervisor never starts an event loop, so forking a replacement child
+from it is safe. Children create their loop, app and listening sockets
+after the fork.
+'''
+
+_HEADER = struct.Struct('!I')
+
+
+class WorkerBus:
+
+    ''' A child's link to the supervisor, for messages to the other workers '''
+
+    def __init__(self, sock):
+        self.stream = IOStream(sock)
+
+    def publish(self, payload):
+        if self.stream.closed():
+            # Cut off; the supervisor restarts this worker
+            return
+        if isinstance(payload,str):
+            payload = payload.encode('utf-8')
+        self.stream.write(_HEADER.pack(len(payload))+payload)
+
+    async def run(self, on_message):
+        ''' Call `on_message(bytes)` for every frame from the other workers '''
+        try:
+            while True:
+                header = await self.stream.read_bytes(_HEADER.size)
+                (size,) = _HEADER.unpack(header)
+                on_message(await self.stream.read_bytes(size))
+        except StreamClosedError:
+            logging.info('worker bus closed')
+
+    def close(self):
+        self.stream.close()
+
+
+class _Worker:
+
+    def __init__(self, idx):
+        self.idx = idx
+        self.pid = None
+        self.sock = None
+        self.events = 0
+        self.buffer = bytearray() # read from the child, up to a whole frame
+        self.out = bytearray()    # whole frames for the child, not yet sent
+        self.dropped = 0
+
+
+def run_workers(num_workers, worker_main, max_restarts=10, restart_window=60, restart_delay=1, max_buffered=8<<20):
+    '''
+    Fork `num_workers` children, each running `worker_main(idx, bus_sock)`,
+    and supervise them until SIGINT/SIGTERM. Only returns in the parent.
+
+    A crashed child is not restarted once `max_restarts` restarts have
+    happened in the last `restart_window` seconds, so a crash loop gives up
+    while the odd crash over a long uptime never does.
+    '''
+    selector = selectors.DefaultSelector()
+    workers = [ _Worker(idx) for idx in range(num_workers) ]
+    workers_by_pid = {}
+    restarts = collections.deque() # monotonic times of recent restarts
+    stopping = False
+
+    def spawn(worker):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # Child: drop the supervisor's state and run the server
+            signal.signal(signal.SIGINT,signal.SIG_DFL)
+            signal.signal(signal.SIGTERM,signal.SIG_DFL)
+            selector.close()
+            parent_sock.close()
+            for other in workers:
+                if other.sock is not None:
+                    other.sock.close()
+            code = 1
+            try:
+                code = worker_main(worker.idx,child_sock) or 0
+            except BaseException:
+                logging.exception('worker %s failed', worker.idx)
+            finally:
+                os._exit(code)
+        child_sock.close()
+        parent_sock.setblocking(False)
+        worker.pid = pid
+        worker.sock = parent_sock
+        worker.events = selectors.EVENT_READ
+        worker.buffer.clear()
+        worker.out.clear()
+        workers_by_pid[pid] = worker
+        selector.register(parent_sock,worker.events,worker)
+        logging.info('started worker %s (pid %s)', worker.idx, pid)
+
+    def drop_socket(worker):
+        if worker.sock is not None:
+            selector.unregister(worker.sock)
+            worker.sock.close()
+            worker.sock = None
+        worker.out.clear()
+
+    def cut(worker, reason):
+        ''' Lose the worker's bus, and stop it so it is restarted with a new one '''
+        drop_socket(worker)
+        if stopping or worker.pid is None:
+            return
+        logging.error('bus to worker %s cut (%s), restarting it', worker.idx, reason)
+        try:
+            os.kill(worker.pid,signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def flush(worker):
+        try:
+            sent = worker.sock.send(worker.out)
+        except (BlockingIOError,InterruptedError):
+            sent = 0
+        except OSError as err:
+            cut(worker,err)
+            return
+        del worker.out[:sent]
+        if not worker.out and worker.dropped:
+            logging.warning('worker %s caught up, %s bus frames dropped', worker.idx, worker.dropped)
+            worker.dropped = 0
+        events = selectors.EVENT_READ|(selectors.EVENT_WRITE if worker.out else 0)
+        if events != worker.events:
+            worker.events = events
+            selector.modify(worker.sock,events,worker)
+
+    def send(worker, frame):
+        # Once behind, dropped from until it has sent everything buffered
+        if worker.dropped or len(worker.out)+len(frame) > max_buffered:
+            if worker.dropped == 0:
+                logging.warning('worker %s is %s bytes behind on the bus, dropping frames',
+                    worker.idx, len(worker.out))
+            worker.dropped += 1
+            return
+        worker.out += frame
+        if len(worker.out) == len(frame):
+            flush(worker)
+
+    def relay(worker):
+        try:
+            data = worker.sock.recv(65536)
+        except (BlockingIOError,InterruptedError):
+            return
+        except OSError as err:
+            cut(worker,err)
+            return
+        if not data:
+            cut(worker,'closed')
+            return
+        buffer = worker.buffer
+        buffer += data
+        start = 0
+        while len(buffer)-start >= _HEADER.size:
+            (size,) = _HEADER.unpack_from(buffer,start)
+            end = start+_HEADER.size+size
+            if len(buffer) < end:
+                break
+            frame = bytes(buffer[start:end])
+            start = end
+            for other in workers:
+                if other is not worker and other.sock is not None:
+                    send(other,frame)
+        del buffer[:start]
+
+    def on_stop_signal(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logging.info('supervisor stopping workers')
+        stopping = True
+        for pid in list(workers_by_pid):
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT,on_stop_signal)
+    signal.signal(signal.SIGTERM,on_stop_signal)
+
+    for worker in workers:
+        spawn(worker)
+
+    pending_restarts = [] # (when, worker)
+    while workers_by_pid or (pending_restarts and not stopping):
+        for key,events in selector.select(timeout=0.5):
+            worker = key.data
+            if events & selectors.EVENT_WRITE and worker.sock is not None:
+                flush(worker)
+            if events & selectors.EVENT_READ and worker.sock is not None:
+                relay(worker)
+
+        # Reap exited children
+        while workers_by_pid:
+            try:
+                pid, status = os.waitpid(-1,os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            worker = workers_by_pid.pop(pid,None)
+            if worker is None:
+                continue
+            drop_socket(worker)
+            worker.pid = None
+            code = os.waitstatus_to_exitcode(status)
+            if stopping:
+                logging.info('worker %s exited (%s)', worker.idx, code)
+                continue
+            now = time.monotonic()
+            while restarts and restarts[0] <= now-restart_window:
+                restarts.popleft()
+            if len(restarts) >= max_restarts:
+                logging.error('worker %s exited (%s), %s restarts in %ss, not restarting',
+                    worker.idx, code, len(restarts), restart_window)
+            else:
+                logging.warning('worker %s exited (%s), restarting', worker.idx, code)
+                restarts.append(now)
+                pending_restarts.append((now+restart_delay,worker))
+
+        # Restart crashed children after a short delay
+        now = time.monotonic()
+        for entry in [ e for e in pending_restarts if e[0] <= now ]:
+            pending_restarts.remove(entry)
+            if not stopping:
+                spawn(entry[1])
+
+    selector.close()
+    logging.info('supervisor done')
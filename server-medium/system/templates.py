@@ -0,0 +1,138 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import collections
+import logging
+import os
+import re
+import time
+# Tornado
+import tornado.template
+
+
+'''
+Template loading with warm-up, precise reloads and an output cache.
+
+`WarmTemplateLoader` compiles every template at startup (`warm`), so the
+first request after a deploy does not pay for it. It remembers each
+template's mtime and what it extends/includes. `check_for_changes` then
+recompiles only the templates that changed and those that depend on
+them, instead of restarting the process.
+
+`FragmentCache` keeps rendered output keyed by template, caller key and
+the template's version (the newest mtime among it and its ancestors), so
+an edit to `base.html` retires every page built on it.
+
+See <https://www.tornadoweb.org/en/stable/template.html>
+'''
+
+_DEPENDENCY_RE = re.compile(r'{%\s*(?:extends|include)\s+["\']([^"\']+)["\']')
+
+
+class WarmTemplateLoader(tornado.template.Loader):
+
+    def __init__(self, root_directory, **kwargs):
+        super().__init__(str(root_directory),**kwargs)
+        self.mtimes = {}      # name => mtime when compiled
+        self.depends_on = {}  # name => names it extends or includes
+        self._versions = {}
+
+    def template_names(self):
+        for directory,_,files in os.walk(self.root):
+            for f in files:
+                if f.endswith('.html') and not f.startswith('.'):
+                    yield os.path.relpath(os.path.join(directory,f),self.root).replace(os.sep,'/')
+
+    def warm(self):
+        t0 = time.perf_counter()
+        names = list(self.template_names())
+        for name in names:
+            self.load(name)
+        logging.info('compiled %s templates in %.1fms', len(names), 1000*(time.perf_counter()-t0))
+
+    def _create_template(self, name):
+        path = os.path.join(self.root,name)
+        self.mtimes[name] = os.stat(path).st_mtime
+        with open(path,'rb') as f:
+            source = f.read()
+        self.depends_on[name] = { self.resolve_path(dep,parent_path=name)
+            for dep in _DEPENDENCY_RE.findall(source.decode('utf-8')) }
+        return tornado.template.Template(source,name=name,loader=self)
+
+    def version(self, name):
+        ''' The newest mtime of `name` and everything it is built from '''
+        version = self._versions.get(name)
+        if version is None:
+            version = self.mtimes.get(name,0)
+            for dep in self.depends_on.get(name,()):
+                version = max(version,self.version(dep))
+            self._versions[name] = version
+        return version
+
+    def check_for_changes(self):
+        ''' Recompile what changed; returns the names that were invalidated '''
+        changed = set()
+        for name,mtime in list(self.mtimes.items()):
+            try:
+                if os.stat(os.path.join(self.root,name)).st_mtime != mtime:
+                    changed.add(name)
+            except FileNotFoundError:
+                changed.add(name)
+        new = set(self.template_names())-set(self.mtimes)
+        if not changed and not new:
+            return set()
+
+        # Everything extending or including a changed template goes too
+        stale = set(changed)
+        grew = True
+        while grew:
+            dependents = { n for n,deps in self.depends_on.items() if deps & stale }
+            grew = not dependents <= stale
+            stale |= dependents
+
+        with self.lock:
+            for name in stale:
+                self.templates.pop(name,None)
+                self.mtimes.pop(name,None)
+                self.depends_on.pop(name,None)
+            self._versions.clear()
+
+        for name in (stale|new):
+            if not os.path.exists(os.path.join(self.root,name)):
+                continue
+            try:
+                self.load(name)
+            except Exception as err:
+                # Leave it to fail on render, like an uncached template would
+                logging.error('template %s failed to compile: %s', name, err)
+        logging.info('reloaded templates: %s', ', '.join(sorted(stale|new)))
+        return stale
+
+
+class FragmentCache:
+
+    ''' LRU of rendered template output '''
+
+    def __init__(self, loader, max_entries=2048):
+        self.loader = loader
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def get_or_render(self, name, key, render):
+        cache_key = (name,key,self.loader.version(name))
+        output = self._entries.get(cache_key)
+        if output is None:
+            output = render()
+            self._entries[cache_key] = output
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(cache_key)
+        return output
+
+    def invalidate(self, names):
+        for cache_key in [ k for k in self._entries if k[0] in names ]:
+            del self._entries[cache_key]
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,398 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+import email.message
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+# Tornado
+import tornado.web
+from tornado.httputil import HTTPHeaders
+# Local
+from .basehandlers import BaseHandler
+from .utils import as_string
+
+
+'''
+Uploads streamed straight to disk.
+
+With `@stream_request_body` tornado hands the body over in chunks
+(64KB by default) instead of buffering it, so memory use stays flat no
+matter the file size. Every open/write/close runs on the upload thread
+pool and `data_received` awaits it, which also gives backpressure: tornado
+stops reading from the socket until the chunk is written.
+
+See <https://www.tornadoweb.org/en/stable/web.html#tornado.web.stream_request_body>
+'''
+
+
+class MultipartStreamParser:
+
+    '''
+    Incremental multipart/form-data parser.
+
+    `feed(chunk)` returns a list of events:
+    * ('begin', headers) at the start of a part
+    * ('data', bytes) for part body data, in order
+    * ('end', None) at the end of a part
+    Only a delimiter's worth of bytes is ever held back between chunks.
+    '''
+
+    MAX_HEADER_SIZE = 16*1024
+
+    PREAMBLE, AFTER_BOUNDARY, HEADERS, BODY, DONE = range(5)
+
+    def __init__(self, boundary):
+        self.delimiter = b'--'+boundary
+        self.body_delimiter = b'\r\n'+self.delimiter
+        self.buffer = bytearray()
+        self.state = self.PREAMBLE
+
+    @property
+    def done(self):
+        return self.state == self.DONE
+
+    def feed(self, data):
+        self.buffer += data
+        buf = self.buffer
+        events = []
+        while True:
+            if self.state == self.PREAMBLE:
+                idx = buf.find(self.delimiter)
+                if idx < 0:
+                    del buf[:max(0,len(buf)-len(self.delimiter)+1)]
+                    break
+                del buf[:idx+len(self.delimiter)]
+                self.state = self.AFTER_BOUNDARY
+
+            elif self.state == self.AFTER_BOUNDARY:
+                if len(buf) < 2:
+                    break
+                if buf[:2] == b'--':
+                    self.state = self.DONE
+                elif buf[:2] == b'\r\n':
+                    del buf[:2]
+                    self.state = self.HEADERS
+                else:
+                    raise ValueError('Malformed multipart boundary')
+
+            elif self.state == self.HEADERS:
+                idx = buf.find(b'\r\n\r\n')
+                if idx < 0:
+                    if len(buf) > self.MAX_HEADER_SIZE:
+                        raise ValueError('Multipart headers too large')
+                    break
+                headers = HTTPHeaders.parse(buf[:idx].decode('utf-8'))
+                del buf[:idx+4]
+                events.append(('begin',headers))
+                self.state = self.BODY
+
+            elif self.state == self.BODY:
+                idx = buf.find(self.body_delimiter)
+                if idx < 0:
+                    # Keep just enough to catch a delimiter split across chunks
+                    safe = len(buf)-len(self.body_delimiter)+1
+                    if safe > 0:
+                        events.append(('data',bytes(buf[:safe])))
+                        del buf[:safe]
+                    break
+                if idx > 0:
+                    events.append(('data',bytes(buf[:idx])))
+                del buf[:idx+len(self.body_delimiter)]
+                events.append(('end',None))
+                self.state = self.AFTER_BOUNDARY
+
+            else: # DONE, ignore the epilogue
+                buf.clear()
+                break
+        return events
+
+
+def header_params(value, header='content-type'):
+    ''' Parse a header value like `form-data; name="a"; filename="b"` '''
+    msg = email.message.Message()
+    msg[header] = value
+    return msg
+
+def safe_filename(name):
+    name = Path(name or '').name
+    if name in ('','.','..') or name.startswith('.') or name.endswith('.part'):
+        raise tornado.web.HTTPError(400,reason='Bad filename')
+    return name
+
+
+class UploadManager:
+
+    '''
+    Upload limits and the thread pool all upload disk work runs on.
+
+    Files go to `upload_dir/<user>/`. A file being written is kept as
+    `<name>.part` and renamed when complete. A user's quota counts
+    everything in their directory, partial files included, plus what
+    uploads in flight have claimed with `reserve`.
+    '''
+
+    def __init__(self, upload_dir, quota_bytes=1<<30, max_concurrent=2,
+            max_body_size=16<<30, workers=4):
+        self.upload_dir = Path(upload_dir)
+        self.quota_bytes = quota_bytes
+        self.max_concurrent = max_concurrent
+        self.max_body_size = max_body_size
+        self.active = {} # user => count
+        self.reserved = {} # user => bytes claimed by uploads in flight
+        self.releases = 0 # claims released so far, to spot one during a scan
+        self.executor = ThreadPoolExecutor(max_workers=workers,thread_name_prefix='upload')
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,fn,*args)
+
+    def user_dir(self, user):
+        return self.upload_dir/safe_filename(as_string(user))
+
+    def begin(self, user):
+        if self.active.get(user,0) >= self.max_concurrent:
+            raise tornado.web.HTTPError(429,reason='Too many concurrent uploads')
+        self.active[user] = self.active.get(user,0)+1
+
+    def end(self, user):
+        count = self.active.get(user,0)-1
+        if count > 0:
+            self.active[user] = count
+        else:
+            self.active.pop(user,None)
+
+    async def usage(self, user):
+        return await self.run(_dir_size,self.user_dir(user))
+
+    async def reserve(self, user, length=None):
+        '''
+        Claim `length` bytes of the user's quota, or all that is left when
+        the length is not known, and return the claim. Raises 413 if it
+        does not fit. A claim holds until `release`, so two uploads cannot
+        both be let into the same space; its bytes already on disk count
+        twice until then.
+        '''
+        while True:
+            releases = self.releases
+            used = await self.usage(user)
+            # A claim released mid-scan may have been missed on disk too
+            if releases == self.releases:
+                break
+        free = self.quota_bytes-used-self.reserved.get(user,0)
+        if length is None:
+            length = max(free,0)
+        if length > free:
+            raise tornado.web.HTTPError(413,reason='Upload quota exceeded')
+        self.reserved[user] = self.reserved.get(user,0)+length
+        return length
+
+    def release(self, user, length):
+        count = self.reserved.get(user,0)-length
+        if count > 0:
+            self.reserved[user] = count
+        else:
+            self.reserved.pop(user,None)
+        self.releases += 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def _dir_size(path):
+    if not path.exists():
+        return 0
+    return sum( e.stat().st_size for e in os.scandir(path) if e.is_file() )
+
+def _open_part(path, offset):
+    path.parent.mkdir(parents=True,exist_ok=True)
+    f = open(path,'r+b' if offset else 'wb')
+    f.seek(offset)
+    return f
+
+def _write_chunk(f, hasher, data):
+    hasher.update(data)
+    f.write(data)
+
+def _finish_part(f, part_path, final_path):
+    f.close()
+    if final_path is not None:
+        os.replace(part_path,final_path)
+
+def _discard_part(f, part_path):
+    f.close()
+    part_path.unlink(missing_ok=True)
+
+def _part_size(part_path):
+    try:
+        return part_path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+@tornado.web.stream_request_body
+class StreamingUploadHandler(BaseHandler):
+
+    '''
+    * POST multipart/form-data: every part with a filename is stored,
+      the response lists each with its size and sha256.
+    * PUT ?filename=..&offset=N[&complete=1]: raw bytes written at `offset`
+      of a resumable upload. `offset` must equal what the server has, and
+      `complete=1` marks the last piece. The response's size and sha256
+      cover that piece only, its offset is the length of the file so far.
+    * GET ?filename=..: how many bytes of a resumable upload the server has.
+    '''
+
+    async def prepare(self):
+        self.uploads = self.application.uploads
+        self.user = None
+        self.accepting = False # True once prepare accepted the body
+        self.error = None
+        self.received = 0
+        self.claimed = 0     # bytes of quota reserved for this body
+        self.part = None     # (file, hasher, part_path, final_path, start) being written
+        self.saved = []
+
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        if self.request.method not in ('POST','PUT'):
+            return
+
+        self.uploads.begin(self.current_user)
+        self.user = self.current_user
+        self.request.connection.set_max_body_size(self.uploads.max_body_size)
+
+        # Refuse up front when the declared size cannot fit. A body of
+        # unknown length (chunked) claims all the quota that is left.
+        length = self.request.headers.get('Content-Length')
+        length = int(length) if length is not None else None
+        self.claimed = await self.uploads.reserve(self.user,length)
+
+        if self.request.method == 'POST':
+            ctype = header_params(self.request.headers.get('Content-Type',''))
+            boundary = ctype.get_param('boundary')
+            if ctype.get_content_type() != 'multipart/form-data' or not boundary:
+                raise tornado.web.HTTPError(400,reason='Expected multipart/form-data')
+            self.parser = MultipartStreamParser(boundary.encode('latin-1'))
+        else:
+            filename = safe_filename(self.get_query_argument('filename',''))
+            try:
+                offset = int(self.get_query_argument('offset','0'))
+            except ValueError:
+                raise tornado.web.HTTPError(400,reason='Bad offset')
+            part_path = self.uploads.user_dir(self.user)/f'{filename}.part'
+            have = await self.uploads.run(_part_size,part_path)
+            if offset != have:
+                self.set_status(409)
+                self.write_json({'success':False,'error':'bad_offset','offset':have})
+                self.finish()
+                return
+            final_path = None
+            if self.get_query_argument('complete','') == '1':
+                final_path = part_path.with_name(filename)
+            await self._open_part(part_path,final_path,offset)
+        self.accepting = True
+
+    async def _open_part(self, part_path, final_path, offset=0):
+        f = await self.uploads.run(_open_part,part_path,offset)
+        self.part = (f,hashlib.sha256(),part_path,final_path,offset)
+
+    async def data_received(self, chunk):
+        if not self.accepting or self.error is not None:
+            return
+        self.received += len(chunk)
+        if self.received > self.claimed:
+            # Stop writing; the error is sent once the body has been read
+            self.error = tornado.web.HTTPError(413,reason='Upload quota exceeded')
+            await self._discard()
+            return
+
+        if self.request.method == 'PUT':
+            await self.uploads.run(_write_chunk,self.part[0],self.part[1],chunk)
+            return
+
+        try:
+            events = self.parser.feed(chunk)
+        except ValueError as err:
+            self.error = tornado.web.HTTPError(400,reason=str(err))
+            await self._discard()
+            return
+        for kind,value in events:
+            if kind == 'begin':
+                disposition = header_params(value.get('Content-Disposition',''),'content-disposition')
+                filename = disposition.get_filename()
+                if filename:
+                    try:
+                        filename = safe_filename(filename)
+                    except tornado.web.HTTPError as err:
+                        # Sent once the body has been read, as above
+                        self.error = err
+                        await self._discard()
+                        return
+                    user_dir = self.uploads.user_dir(self.user)
+                    await self._open_part(user_dir/f'{filename}.part',user_dir/filename)
+            elif kind == 'data' and self.part is not None:
+                await self.uploads.run(_write_chunk,self.part[0],self.part[1],value)
+            elif kind == 'end' and self.part is not None:
+                await self._finish_part()
+
+    async def _finish_part(self):
+        f,hasher,part_path,final_path,start = self.part
+        self.part = None
+        size = f.tell()-start
+        await self.uploads.run(_finish_part,f,part_path,final_path)
+        self.saved.append({
+            'filename': part_path.stem,
+            'size': size,
+            'sha256': hasher.hexdigest()
+        })
+
+    async def _discard(self):
+        if self.part is not None:
+            f,_,part_path,*_ = self.part
+            self.part = None
+            if self.request.method == 'PUT':
+                # Keep what a resumable upload already has
+                await self.uploads.run(_finish_part,f,part_path,None)
+            else:
+                await self.uploads.run(_discard_part,f,part_path)
+
+    async def post(self):
+        if self.error is not None:
+            raise self.error
+        if not self.parser.done:
+            await self._discard()
+            raise tornado.web.HTTPError(400,reason='Incomplete multipart body')
+        self.write_json({'success':True,'files':self.saved})
+
+    async def put(self):
+        if self.error is not None:
+            raise self.error
+        await self._finish_part()
+        resp = {'success':True,'offset':self.received+int(self.get_query_argument('offset'))}
+        resp.update(self.saved[-1])
+        self.write_json(resp)
+
+    async def get(self):
+        filename = safe_filename(self.get_query_argument('filename',''))
+        part_path = self.uploads.user_dir(self.current_user)/f'{filename}.part'
+        offset = await self.uploads.run(_part_size,part_path)
+        self.write_json({'filename':filename,'offset':offset})
+
+    def on_connection_close(self):
+        if self.part is not None:
+            logging.info('upload interrupted for %s', self.user)
+            asyncio.create_task(self._discard())
+        self._release()
+
+    def on_finish(self):
+        self._release()
+
+    def _release(self):
+        if self.user is not None:
+            self.uploads.release(self.user,self.claimed)
+            self.uploads.end(self.user)
+            self.user = None
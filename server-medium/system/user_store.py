@@ -0,0 +1,196 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class UserStore:
+
+    '''
+    Where `AuthServerMixin` keeps password hashes and invites.
+    All calls are async so a backend may do I/O without blocking the loop,
+    except `seed` which is only called at startup.
+    '''
+
+    def seed(self, users, invites):
+        ''' Add `users` (name => hash) and `invites` that do not exist yet '''
+        raise NotImplementedError()
+
+    async def get_password_hash(self, username):
+        ''' The hash for `username`, or None '''
+        raise NotImplementedError()
+
+    async def set_password_hash(self, username, password_hash):
+        raise NotImplementedError()
+
+    async def add_user(self, username, password_hash):
+        ''' Returns False if the username is already taken '''
+        raise NotImplementedError()
+
+    async def has_username(self, username):
+        raise NotImplementedError()
+
+    async def has_invite(self, invite):
+        raise NotImplementedError()
+
+    async def remove_invite(self, invite):
+        ''' Returns False if the invite was not available '''
+        raise NotImplementedError()
+
+    async def restore_invite(self, invite):
+        ''' Undo `remove_invite`, for a signup that failed after it '''
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MemoryUserStore(UserStore):
+
+    ''' Per-process store, lost on restart '''
+
+    def __init__(self):
+        self.users = {}
+        self.invites = set()
+        self.used_invites = set()
+
+    def seed(self, users, invites):
+        for username,password_hash in users.items():
+            self.users.setdefault(username,password_hash)
+        self.invites.update(set(invites)-self.used_invites)
+
+    async def get_password_hash(self, username):
+        return self.users.get(username)
+
+    async def set_password_hash(self, username, password_hash):
+        self.users[username] = password_hash
+
+    async def add_user(self, username, password_hash):
+        if username in self.users:
+            return False
+        self.users[username] = password_hash
+        return True
+
+    async def has_username(self, username):
+        return username in self.users
+
+    async def has_invite(self, invite):
+        return invite in self.invites
+
+    async def remove_invite(self, invite):
+        if invite not in self.invites:
+            return False
+        self.invites.remove(invite)
+        self.used_invites.add(invite)
+        return True
+
+    async def restore_invite(self, invite):
+        if invite in self.used_invites:
+            self.used_invites.remove(invite)
+            self.invites.add(invite)
+
+
+class SQLiteUserStore(UserStore):
+
+    '''
+    Store in an SQLite file, which several server processes can share.
+
+    Every query runs on a single dedicated thread that owns one reused
+    connection, so the loop never waits on disk and the connection needs no
+    locking. The database runs in WAL mode so readers in other processes do
+    not block on a writer. Queries are fixed strings, which lets sqlite3's
+    statement cache keep them prepared.
+
+    Used invites are kept with `used = 1` so a restart does not re-seed them.
+    '''
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password_hash BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS invites (invite TEXT PRIMARY KEY, used INTEGER NOT NULL DEFAULT 0)"
+    )
+    SQL_GET_HASH = "SELECT password_hash FROM users WHERE username = ?"
+    SQL_SET_HASH = "UPDATE users SET password_hash = ? WHERE username = ?"
+    SQL_ADD_USER = "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)"
+    SQL_HAS_USER = "SELECT 1 FROM users WHERE username = ?"
+    SQL_ADD_INVITE = "INSERT OR IGNORE INTO invites (invite) VALUES (?)"
+    SQL_HAS_INVITE = "SELECT 1 FROM invites WHERE invite = ? AND used = 0"
+    SQL_USE_INVITE = "UPDATE invites SET used = 1 WHERE invite = ? AND used = 0"
+    SQL_RESTORE_INVITE = "UPDATE invites SET used = 0 WHERE invite = ? AND used = 1"
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='userstore')
+        self._local = threading.local()
+        self.executor.submit(self._init_db).result()
+        logging.info('user store at %s', self.path)
+
+    def _conn(self):
+        conn = getattr(self._local,'conn',None)
+        if conn is None:
+            conn = sqlite3.connect(self.path,isolation_level=None,cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        for stmt in self.SCHEMA:
+            conn.execute(stmt)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,fn,*args)
+
+    def _fetch_one(self, sql, params):
+        return self._conn().execute(sql,params).fetchone()
+
+    def _change(self, sql, params):
+        return self._conn().execute(sql,params).rowcount
+
+    def _seed(self, users, invites):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(self.SQL_ADD_USER,users.items())
+            conn.executemany(self.SQL_ADD_INVITE,[(i,) for i in invites])
+
+    def seed(self, users, invites):
+        self.executor.submit(self._seed,users,invites).result()
+
+    async def get_password_hash(self, username):
+        row = await self._run(self._fetch_one,self.SQL_GET_HASH,(username,))
+        return None if row is None else bytes(row[0])
+
+    async def set_password_hash(self, username, password_hash):
+        await self._run(self._change,self.SQL_SET_HASH,(password_hash,username))
+
+    async def add_user(self, username, password_hash):
+        return 1 == await self._run(self._change,self.SQL_ADD_USER,(username,password_hash))
+
+    async def has_username(self, username):
+        return None is not await self._run(self._fetch_one,self.SQL_HAS_USER,(username,))
+
+    async def has_invite(self, invite):
+        return None is not await self._run(self._fetch_one,self.SQL_HAS_INVITE,(invite,))
+
+    async def remove_invite(self, invite):
+        return 1 == await self._run(self._change,self.SQL_USE_INVITE,(invite,))
+
+    async def restore_invite(self, invite):
+        await self._run(self._change,self.SQL_RESTORE_INVITE,(invite,))
+
+    def _close(self):
+        conn = getattr(self._local,'conn',None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def close(self):
+        self.executor.submit(self._close)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,6 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Websocket tooling shared by the client-server examples and the mesh.
+Scripts put the repo root on `sys.path` to import it.
+'''
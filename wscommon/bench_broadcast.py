@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Fan one message out to many local websocket clients.
+
+The server runs in this process, the clients in `--procs` forked
+processes. Each round broadcasts one message stamped with its send time,
+and every client records when it arrived. Two ways of sending are compared:
+
+* write_message: the old loop, `write_message` per client
+* broadcaster:   `wscommon.broadcast.Broadcaster`, frame encoded once
+
+For each, the CPU time spent in the fan-out call (the event loop is
+blocked for at least that long) and the delivery latency to the clients are reported.
+`--slow` clients that never read are added to show the buffered bytes
+the server holds for them (capped at 64KB per client for the broadcaster).
+
+    python wscommon/bench_broadcast.py --clients 10000
+    python wscommon/bench_broadcast.py --clients 1000 --slow 10 --size 65536
+'''
+
+# Python
+import asyncio
+import logging
+import multiprocessing
+import resource
+import socket
+import sys
+import time
+from pathlib import Path
+# Tornado
+import tornado.web
+import tornado.websocket
+from tornado.websocket import websocket_connect
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.broadcast import Broadcaster
+
+
+class BenchHandler(tornado.websocket.WebSocketHandler):
+
+    def open(self):
+        self.application.clients.append(self)
+
+    def on_close(self):
+        if self in self.application.clients:
+            self.application.clients.remove(self)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1,int(len(values)*pct/100))]
+
+def buffered_bytes(handlers):
+    total = 0
+    for h in handlers:
+        if h.ws_connection is not None and h.ws_connection.stream is not None:
+            total += len(h.ws_connection.stream._write_buffer)
+    return total
+
+
+#-- Client processes ----------------------------------------#
+
+async def connect_slow(port):
+    ''' Upgrade a plain socket and then never read from it '''
+    reader,writer = await asyncio.open_connection('localhost',port)
+    writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,4096)
+    writer.write(f'GET /ws HTTP/1.1\r\nHost: localhost:{port}\r\nUpgrade: websocket\r\n'
+        'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+        'Sec-WebSocket-Version: 13\r\n\r\n'.encode())
+    await reader.readuntil(b'\r\n\r\n')
+    writer.transport.pause_reading()
+    return writer
+
+def client_proc(port, count, slow, pipe):
+    async def run():
+        latencies = {} # mode => [(seq, latency)]
+        done = asyncio.Event()
+        def on_message(msg):
+            if msg is None:
+                return
+            if msg == 'DONE':
+                done.set()
+                return
+            now = time.time()
+            mode,seq,sent,_ = msg.split(' ',3)
+            latencies.setdefault(mode,[]).append((int(seq),now-float(sent)))
+
+        url = f'ws://localhost:{port}/ws'
+        conns = []
+        slow_writers = []
+        sem = asyncio.Semaphore(100)
+        async def connect(idx):
+            async with sem:
+                if idx < slow:
+                    slow_writers.append(await connect_slow(port))
+                else:
+                    conns.append(await websocket_connect(url,on_message_callback=on_message))
+        await asyncio.gather(*[ connect(i) for i in range(count) ])
+        pipe.send('ready')
+        await done.wait()
+        pipe.send(latencies)
+        for conn in conns:
+            conn.close()
+        for writer in slow_writers:
+            writer.close()
+    asyncio.run(run())
+
+
+#-- Server side ----------------------------------------#
+
+async def send_round(app, mode, seq, size, broadcaster):
+    header = f'{mode} {seq} {time.time():.6f} '
+    message = header+'x'*max(0,size-len(header))
+    # CPU time, since on a small box the client processes share the cores
+    t0 = time.process_time()
+    if mode == 'write_message':
+        for h in list(app.clients):
+            try:
+                h.write_message(message)
+            except tornado.websocket.WebSocketClosedError:
+                pass
+    else:
+        broadcaster.broadcast(app.clients,message)
+    return time.process_time()-t0
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--procs', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--slow', type=int, default=0, help='clients per process that never read')
+    parser.add_argument('--policy', default='drop')
+    parser.add_argument('--port', type=int, default=8897)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    # The old loop drops its write futures, which fail once slow clients go away
+    logging.getLogger('asyncio').setLevel(logging.CRITICAL)
+    soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = min(hard,2*args.clients+1000)
+    if soft < want:
+        resource.setrlimit(resource.RLIMIT_NOFILE,(want,hard))
+
+    app = tornado.web.Application([(r'/ws',BenchHandler)])
+    app.clients = []
+    app.listen(args.port,backlog=4096)
+
+    ctx = multiprocessing.get_context('fork')
+    pipes = []
+    per_proc = args.clients//args.procs
+    for i in range(args.procs):
+        ours,theirs = ctx.Pipe()
+        ctx.Process(target=client_proc,args=(args.port,per_proc,args.slow,theirs),daemon=True).start()
+        pipes.append(ours)
+
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    for pipe in pipes:
+        await loop.run_in_executor(None,pipe.recv)
+    print(f"{len(app.clients)} clients connected in {time.perf_counter()-t0:.1f}s ({args.slow*args.procs} slow)")
+
+    expected = args.rounds*(len(app.clients)-args.slow*args.procs)
+    broadcaster = Broadcaster(max_outstanding=64*1024,policy=args.policy)
+    calls = {}
+    for mode in ('write_message','broadcaster'):
+        calls[mode] = []
+        before = buffered_bytes(app.clients)
+        for seq in range(args.rounds):
+            calls[mode].append(await send_round(app,mode,seq,args.size,broadcaster))
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(1)
+        if args.slow:
+            grew = buffered_bytes(app.clients)-before
+            print(f"  {mode:<14} write buffers grew {grew/1e6:.1f}MB for the slow clients")
+
+    for h in list(app.clients):
+        h.write_message('DONE')
+    latencies = {}
+    for pipe in pipes:
+        result = await loop.run_in_executor(None,pipe.recv)
+        for mode,values in result.items():
+            latencies.setdefault(mode,[]).extend(values)
+
+    print(f"{args.rounds} rounds of {args.size} byte messages:")
+    for mode in calls:
+        values = [ lat for _,lat in latencies.get(mode,[]) ]
+        call_ms = [ 1000*c for c in calls[mode] ]
+        print(f"  {mode:<14} fan-out cpu p50 {percentile(call_ms,50):7.1f}ms max {max(call_ms):7.1f}ms"
+              f" | delivery p50 {1000*percentile(values,50):7.1f}ms p99 {1000*percentile(values,99):7.1f}ms"
+              f" | {len(values)}/{expected} delivered")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
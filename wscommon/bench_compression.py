@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+CPU against bandwidth for websocket compression policies.
+
+A server in this process pushes messages to one client, for each policy
+and message kind. Reported per message:
+
+* wire:  bytes the server wrote to the socket, frame headers included
+* send:  server CPU in `write_message` (the compression happens there)
+* total: process CPU, so including the client's decompression
+* ratio: wire bytes over payload bytes
+
+    python wscommon/bench_compression.py
+'''
+
+# Python
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from pathlib import Path
+# Tornado
+import tornado.web
+import tornado.websocket
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.compression import CompressionPolicy, CompressionPolicyMixin, LINK_POLICY, websocket_connect
+
+
+POLICIES = [
+    ('off',None),
+    ('always lvl6',CompressionPolicy(level=6,threshold=0)),
+    ('link (>=1KB)',LINK_POLICY),
+    ('lvl1 wbits10',CompressionPolicy(level=1,mem_level=4,window_bits=10,threshold=1024)),
+]
+
+def make_messages(rng):
+    def record(i):
+        return {"id": i, "user": f"user{rng.randrange(1000)}", "status": rng.choice(["ok","busy","away"]),
+            "score": round(rng.random()*100,2), "tags": rng.sample(["a","b","c","d","e","f"],3)}
+    return [
+        ('chatty ~50B',[ json.dumps({"t":"ping","seq":i,"ts":time.time()}) for i in range(2000) ]),
+        ('json ~2KB',[ json.dumps([ record(i*20+j) for j in range(20) ]) for i in range(1000) ]),
+        ('json ~64KB',[ json.dumps([ record(i*650+j) for j in range(650) ]) for i in range(100) ]),
+    ]
+
+
+class PushHandler(CompressionPolicyMixin, tornado.websocket.WebSocketHandler):
+
+    def get_compression_policy(self):
+        return self.application.policy
+
+    def open(self):
+        self.application.handler = self
+        self.application.opened.set()
+
+
+async def run(port, policy, messages):
+    app = tornado.web.Application([(r'/ws',PushHandler)])
+    app.policy = policy
+    app.opened = asyncio.Event()
+    server = app.listen(port)
+
+    received = 0
+    done = asyncio.Event()
+    def on_message(msg):
+        nonlocal received
+        if msg is not None:
+            received += 1
+            if received == len(messages):
+                done.set()
+    conn = await websocket_connect(f'ws://localhost:{port}/ws',compression=policy,on_message_callback=on_message)
+    await app.opened.wait()
+    handler = app.handler
+    protocol = handler.ws_connection
+
+    send_cpu = 0.0
+    cpu0 = time.process_time()
+    wire0 = protocol._wire_bytes_out
+    for i,msg in enumerate(messages):
+        t0 = time.process_time()
+        handler.write_message(msg)
+        send_cpu += time.process_time()-t0
+        if i%50 == 49:
+            await asyncio.sleep(0)
+    await done.wait()
+    total_cpu = time.process_time()-cpu0
+    wire = protocol._wire_bytes_out-wire0
+
+    conn.close()
+    server.stop()
+    await asyncio.sleep(0.1)
+    count = len(messages)
+    payload = sum( len(m) for m in messages )
+    return dict(wire=wire/count,send=1e6*send_cpu/count,total=1e6*total_cpu/count,ratio=wire/payload)
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8899)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    rng = random.Random(1)
+    port = args.port
+    print(f"{'messages':<12} {'policy':<14} {'wire':>10} {'send':>10} {'total':>10} {'ratio':>7}")
+    for kind,messages in make_messages(rng):
+        for name,policy in POLICIES:
+            r = await run(port,policy,messages)
+            port += 1
+            print(f"{kind:<12} {name:<14} {r['wire']:9.0f}B {r['send']:8.1f}us {r['total']:8.1f}us {r['ratio']:7.2f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
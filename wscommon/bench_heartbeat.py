@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Liveness checks for many connections, and dead peers being dropped.
+
+First `--peers` fake connections, answering every ping at once, are
+pinged every `--interval` seconds for `--seconds`:
+
+* periodic:  a `PeriodicCallback` per connection, as tornado's own
+             `websocket_ping_interval` does
+* wheel:     one `wscommon.heartbeat.Heartbeat` on a shared `TimerWheel`
+
+reporting the loop timers alive, the memory the scheduling took and the
+CPU spent. Then a real server with a 1s interval and 1s timeout gets one
+healthy client and one that completes the handshake and then never
+answers (a peer gone without a FIN); the second must be dropped within
+interval+timeout.
+
+    python wscommon/bench_heartbeat.py
+'''
+
+# Python
+import asyncio
+import base64
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+# Tornado
+import tornado.web
+import tornado.websocket
+from tornado.ioloop import PeriodicCallback
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.heartbeat import Heartbeat, HeartbeatMixin, TimerWheel, rtt_ms
+from wscommon.reconnect import ReconnectingClient
+
+
+class FakePeer:
+
+    liveness = None
+
+    def __init__(self, heartbeat=None):
+        self.heartbeat = heartbeat
+        self.pings = 0
+
+    def heartbeat_ping(self, data):
+        self.pings += 1
+        if self.heartbeat is not None:
+            self.heartbeat.pong(self,data)
+
+    def heartbeat_dead(self):
+        pass
+
+
+def loop_timers():
+    return sum( not h.cancelled() for h in asyncio.get_running_loop()._scheduled )
+
+async def run(mode, args):
+    gc.collect()
+    tracemalloc.start()
+    peers = []
+    callbacks = []
+    if mode == 'periodic':
+        for _ in range(args.peers):
+            peer = FakePeer()
+            callback = PeriodicCallback(lambda peer=peer: peer.heartbeat_ping(b'hb'),
+                1000*args.interval,jitter=0.5)
+            callback.start()
+            callbacks.append(callback)
+            peers.append(peer)
+    else:
+        heartbeat = Heartbeat(interval=args.interval,timeout=args.interval/2,wheel=TimerWheel(tick=0.05))
+        for _ in range(args.peers):
+            peer = FakePeer(heartbeat)
+            heartbeat.watch(peer)
+            peers.append(peer)
+    timers = loop_timers()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    t0,cpu0 = time.monotonic(),time.process_time()
+    await asyncio.sleep(args.seconds)
+    elapsed,cpu = time.monotonic()-t0,time.process_time()-cpu0
+    pings = sum( p.pings for p in peers )
+
+    for callback in callbacks:
+        callback.stop()
+    if mode == 'wheel':
+        heartbeat.wheel.stop()
+    return (f"  {mode:<9} loop timers {timers:7d} | memory {memory/args.peers:6.0f} B/peer"
+        f" | {pings} pings, cpu {1e6*cpu/max(pings,1):5.1f}us/ping ({100*cpu/elapsed:3.0f}% of a core)")
+
+
+#-- Dead peer detection ----------------------------------------#
+
+class WatchedHandler(HeartbeatMixin, tornado.websocket.WebSocketHandler):
+
+    def open(self):
+        self.opened = time.monotonic()
+        self.application.handlers[self] = None
+        self.start_heartbeat()
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.application.handlers.pop(self,None)
+        self.application.closed.append(time.monotonic()-self.opened)
+
+
+async def silent_client(port):
+    ''' Completes the handshake, then reads nothing and answers nothing '''
+    reader,writer = await asyncio.open_connection('localhost',port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((f'GET /ws HTTP/1.1\r\nHost: localhost:{port}\r\nUpgrade: websocket\r\n'
+        f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+    await reader.readuntil(b'\r\n\r\n')
+    return writer
+
+async def detect(args):
+    interval,timeout = 1.0,1.0
+    app = tornado.web.Application([(r'/ws',WatchedHandler)])
+    app.ws_heartbeat = Heartbeat(interval=interval,timeout=timeout,wheel=TimerWheel(tick=0.05))
+    app.handlers = {}
+    app.closed = []
+    server = app.listen(args.port)
+
+    client = ReconnectingClient(f'ws://localhost:{args.port}/ws',
+        heartbeat=Heartbeat(interval=interval,timeout=timeout,wheel=app.ws_heartbeat.wheel))
+    task = asyncio.create_task(client.start())
+    writer = await silent_client(args.port)
+    await asyncio.sleep(2*(interval+timeout))
+
+    healthy = [ h for h in app.handlers ]
+    print(f"dead peer detection, ping every {interval}s, {timeout}s to answer:")
+    print(f"  silent client dropped after {', '.join( f'{t:.2f}s' for t in app.closed ) or 'never'}"
+        f" (interval+timeout is {interval+timeout:.1f}s) | dead {app.ws_heartbeat.dead}")
+    print(f"  healthy client still open: {'yes' if healthy else 'no'}"
+        f" | rtt server side {rtt_ms(healthy[0]) if healthy else None}ms, client side {rtt_ms(client)}ms")
+
+    writer.close()
+    client.close()
+    await task
+    app.ws_heartbeat.wheel.stop()
+    server.stop()
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--peers', type=int, default=100000)
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--port', type=int, default=8896)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    print(f"{args.peers} connections pinged every {args.interval}s for {args.seconds:.0f}s:")
+    for mode in ('periodic','wheel'):
+        print(await run(mode,args))
+    await detect(args)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+What counting costs on the hot paths (`wscommon.metrics`).
+
+`--clients` websocket clients connect, in this process, to endpoints
+that differ only in `MetricsMixin` and a registry record (counted) or
+not (plain), and a third with `WriteMetricsMixin` (writes counted). For
+each path the same work is timed with and without the counting, in
+alternating rounds, and the difference is reported against the time of
+the work itself:
+
+* broadcast:      `Broadcaster.broadcast` to every client, with a fan-out
+                  histogram and per-connection counts on the shared frame
+* write_message:  one `write_message` to each client in turn, counted and
+                  with writes counted
+* receive:        `--messages` messages from one client, until the
+                  handler has them all
+* scrape:         `render()` with every client's series, per scrape
+
+    python wscommon/bench_metrics.py --clients 1000
+'''
+
+# Python
+import asyncio
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+# Tornado
+import tornado.web
+import tornado.websocket
+from tornado.websocket import websocket_connect
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.broadcast import Broadcaster
+from wscommon.metrics import Metrics, MetricsMixin, WriteMetricsMixin, connection_metrics
+from wscommon.registry import ConnectionRegistry, buffered
+
+
+class PlainHandler(tornado.websocket.WebSocketHandler):
+
+    def open(self):
+        self.received = 0
+        self.application.plain.append(self)
+
+    def on_message(self, message):
+        self.received += 1
+
+
+class CountedHandler(MetricsMixin, tornado.websocket.WebSocketHandler):
+
+    def open(self):
+        self.received = 0
+        self.application.registry.add(self,remote=self.request.remote_ip)
+
+    def on_message(self, message):
+        self.count_received(message)
+        self.received += 1
+
+
+class WriteCountedHandler(WriteMetricsMixin, tornado.websocket.WebSocketHandler):
+
+    def open(self):
+        self.application.writes.add(self,remote=self.request.remote_ip)
+
+
+class BenchApp(tornado.web.Application):
+
+    def __init__(self):
+        self.plain = []
+        self.registry = ConnectionRegistry()
+        self.writes = ConnectionRegistry()
+        self.metrics = Metrics('bench')
+        self.metrics.collect(connection_metrics(self.registry,'ws'))
+        super().__init__([(r"/plain",PlainHandler),(r"/counted",CountedHandler),
+            (r"/writes",WriteCountedHandler)])
+
+
+def overhead(plain, counted):
+    ''' Median of each, and the added share '''
+    p,c = statistics.median(plain),statistics.median(counted)
+    return p,c,100*(c-p)/p
+
+def report(name, unit, scale, plain, counted):
+    p,c,pct = overhead(plain,counted)
+    print(f"  {name:<14} plain {scale*p:9.2f}{unit}  counted {scale*c:9.2f}{unit}  overhead {pct:+6.2f}%")
+
+async def drain(handlers):
+    ''' Let the writes go out, so buffers do not grow from round to round '''
+    while any( buffered(h) for h in handlers ):
+        await asyncio.sleep(0.001)
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=9731)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    app = BenchApp()
+    app.listen(args.port)
+    clients = []
+    for path in ('plain','counted','writes'):
+        for i in range(args.clients):
+            clients.append(await websocket_connect(f"ws://localhost:{args.port}/{path}",
+                on_message_callback=lambda msg: None))
+    while len(app.plain) < args.clients or len(app.registry) < args.clients or len(app.writes) < args.clients:
+        await asyncio.sleep(0.01)
+    plain,counted,writes = tuple(app.plain),app.registry.handlers(),app.writes.handlers()
+    print(f"{args.clients} clients per endpoint:")
+
+    # Broadcast
+    plain_bc = Broadcaster()
+    counted_bc = Broadcaster(fanout=app.metrics.histogram('fanout_seconds','Fan-out').labels())
+    message = 'x'*100
+    times = { 'plain': [],'counted': [] }
+    for n in range(args.rounds):
+        for name,bc,handlers in (('plain',plain_bc,plain),('counted',counted_bc,counted))[::1 if n%2 else -1]:
+            t0 = time.perf_counter()
+            bc.broadcast(handlers,message)
+            times[name].append(time.perf_counter()-t0)
+            await drain(handlers)
+    report('broadcast','ms',1e3,times['plain'],times['counted'])
+
+    # One write_message per client
+    times = { 'plain': [],'counted': [],'writes': [] }
+    for n in range(args.rounds//4):
+        for name,handlers in (('plain',plain),('counted',counted),('writes',writes))[::1 if n%2 else -1]:
+            t0 = time.perf_counter()
+            for h in handlers:
+                h.write_message(message)
+            times[name].append((time.perf_counter()-t0)/len(handlers))
+            await drain(handlers)
+    report('write_message','us',1e6,times['plain'],times['counted'])
+    report('  writes','us',1e6,times['plain'],times['writes'])
+
+    # Receiving, on one connection of each
+    times = { 'plain': [],'counted': [] }
+    senders = dict(plain=(clients[0],plain[0]),counted=(clients[args.clients],counted[0]))
+    for n in range(40):
+        for name in ('plain','counted')[::1 if n%2 else -1]:
+            client,handler = senders[name]
+            target = handler.received+args.messages
+            t0 = time.perf_counter()
+            for i in range(args.messages):
+                client.write_message(message)
+            while handler.received < target:
+                await asyncio.sleep(0)
+            times[name].append((time.perf_counter()-t0)/args.messages)
+    report('receive','us',1e6,times['plain'],times['counted'])
+
+    times = []
+    for n in range(5):
+        t0 = time.perf_counter()
+        text = app.metrics.render()
+        times.append(time.perf_counter()-t0)
+    print(f"  scrape         {1000*statistics.median(times):.1f}ms for {len(text)/1e3:.0f}KB,"
+        f" {text.count(chr(10))} lines")
+
+    for client in clients:
+        client.close()
+    await asyncio.sleep(0.5)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Messages lost and duplicated across short disconnects.
+
+A client sends numbered messages at `--rate` a second for `--seconds`
+while the server drops its connection every `--drop-every` seconds
+(closing the socket, as if the network went). The client reconnects
+after 50-200ms. Compared:
+
+* none:         `write_message` only while connected, the old behaviour
+* outbox:       `wscommon.outbox.Outbox`, flushed on reconnect
+* outbox+acks:  kept until acked, resumed with `wscommon.resume`
+
+    python wscommon/bench_outbox.py
+'''
+
+# Python
+import asyncio
+import logging
+import sys
+import time
+from pathlib import Path
+# Tornado
+import tornado.web
+import tornado.websocket
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.outbox import Outbox
+from wscommon.reconnect import Backoff, ReconnectingClient
+from wscommon.resume import ResumableMixin, ResumeSessions
+
+MODES = ('none','outbox','outbox+acks')
+
+
+class SinkHandler(ResumableMixin, tornado.websocket.WebSocketHandler):
+
+    def open(self):
+        self.application.handler = self
+
+    def on_message(self, message):
+        message = self.resume_receive(message)
+        if message is not None:
+            self.application.received.append(int(message))
+
+
+async def run(mode, args, port):
+    app = tornado.web.Application([(r'/ws',SinkHandler)])
+    app.resume_sessions = ResumeSessions()
+    app.received = []
+    app.handler = None
+    server = app.listen(port)
+
+    outbox = None if mode == 'none' else Outbox(max_messages=100000,max_bytes=16<<20)
+    client = ReconnectingClient(f'ws://localhost:{port}/ws',backoff=Backoff(base=0.05,cap=0.2),
+        outbox=outbox,acks=mode == 'outbox+acks')
+    task = asyncio.create_task(client.start())
+    while client.conn is None:
+        await asyncio.sleep(0.01)
+
+    async def dropper():
+        while True:
+            await asyncio.sleep(args.drop_every)
+            if app.handler is not None and app.handler.ws_connection is not None:
+                app.handler.ws_connection.stream.close()
+    drops = asyncio.create_task(dropper())
+
+    count = int(args.rate*args.seconds)
+    t0 = time.monotonic()
+    for n in range(count):
+        client.write_message(str(n))
+        delay = t0+(n+1)/args.rate-time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    drops.cancel()
+    # Let the last reconnect and acks go through
+    await asyncio.sleep(1.0)
+
+    received = app.received
+    unique = len(set(received))
+    in_order = all( a < b for a,b in zip(received,received[1:]) )
+    client.close()
+    await task
+    server.stop()
+    return (f"  {mode:<12} sent {count} | received {unique} ({100*(count-unique)/count:5.2f}% lost)"
+        f" | duplicates {len(received)-unique} | in order {'yes' if in_order else 'no'}")
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=2000)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--drop-every', type=float, default=0.5)
+    parser.add_argument('--port', type=int, default=8895)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    print(f"{args.rate:.0f} messages/s for {args.seconds:.0f}s, connection dropped every {args.drop_every}s:")
+    for idx,mode in enumerate(MODES):
+        print(await run(mode,args,args.port+idx))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
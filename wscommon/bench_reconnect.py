@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Reconnect storm: many clients lose their server at once and come back.
+
+The server runs in this process and the `ReconnectingClient`s in
+`--procs` forked processes. Once all are connected the server drops
+every connection, stays down `--down` seconds and listens again. It
+admits `--capacity` handshakes a second and answers the rest with 503,
+like a server that is still warming up, and can also turn away a share
+`--reject` at random with 403, like `ChannelWebSocket.prepare`.
+
+Each retry policy reports the time from the restart until every client
+is back, the attempts the clients made (refused ones while down
+included), the handshakes the server had to turn away, and the busiest
+second it saw:
+
+* fixed:        retry every second, the old loop
+* jitter:       `wscommon.reconnect.Backoff`
+* jitter+limit: the same with a `ConnectLimiter` per client process, at
+                the server's capacity
+
+Keep the server's capacity well under what the machine can do, or
+clients time out waiting on a busy CPU rather than on the server's policy.
+
+    python wscommon/bench_reconnect.py --clients 5000
+    python wscommon/bench_reconnect.py --clients 5000 --reject 0.1
+'''
+
+# Python
+import asyncio
+import collections
+import logging
+import multiprocessing
+import random
+import resource
+import sys
+import time
+from pathlib import Path
+# Tornado
+import tornado.web
+import tornado.websocket
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.reconnect import Backoff, ConnectLimiter, ReconnectingClient
+
+POLICIES = ('fixed','jitter','jitter+limit')
+
+
+class StormHandler(tornado.websocket.WebSocketHandler):
+
+    def prepare(self):
+        app = self.application
+        app.attempts.append(time.monotonic())
+        if random.random() < app.reject:
+            app.turned_away += 1
+            raise tornado.web.HTTPError(403)
+        if not app.admit():
+            app.turned_away += 1
+            raise tornado.web.HTTPError(503)
+
+    def open(self):
+        self.application.clients.add(self)
+
+    def on_close(self):
+        self.application.clients.discard(self)
+
+
+class StormApp(tornado.web.Application):
+
+    def __init__(self, capacity, reject):
+        super().__init__([(r'/ws',StormHandler)])
+        self.capacity = capacity
+        self.reject = reject
+        self.clients = set()
+        self.attempts = []
+        self.turned_away = 0
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def admit(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,self._tokens+(now-self._last)*self.capacity)
+        self._last = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class FixedDelay:
+
+    ''' The old loop's retry: a second, every time '''
+
+    def next(self):
+        return 1.0
+
+    def reset(self):
+        pass
+
+
+#-- Client processes ----------------------------------------#
+
+def client_proc(port, count, policy, rate, cap, seed, pipe):
+    async def run():
+        limiter = ConnectLimiter(rate) if policy == 'jitter+limit' else None
+        clients = []
+        for i in range(count):
+            backoff = FixedDelay() if policy == 'fixed' else Backoff(cap=cap,rng=random.Random(seed+i))
+            # Up long enough before the restart to count as stable
+            client = ReconnectingClient(f'ws://localhost:{port}/ws',backoff=backoff,
+                limiter=limiter,stable_after=1)
+            clients.append(client)
+            asyncio.create_task(client.start())
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None,pipe.recv)
+            if command == 'stats':
+                pipe.send(sum( c.stats['attempts'] for c in clients ))
+            else:
+                break
+        for client in clients:
+            client.close()
+    asyncio.run(run())
+
+
+#-- Server side ----------------------------------------#
+
+async def until(condition, timeout):
+    t0 = time.monotonic()
+    while not condition():
+        if time.monotonic()-t0 > timeout:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+async def run_storm(args, policy, port):
+    app = StormApp(args.capacity,args.reject)
+
+    # Forked before listening, so they do not hold the listening socket open
+    ctx = multiprocessing.get_context('fork')
+    pipes = []
+    per_proc = args.clients//args.procs
+    for i in range(args.procs):
+        ours,theirs = ctx.Pipe()
+        ctx.Process(target=client_proc,daemon=True,
+            args=(port,per_proc,policy,args.capacity/args.procs,args.cap,1000000*i,theirs)).start()
+        pipes.append(ours)
+    total = per_proc*args.procs
+    loop = asyncio.get_running_loop()
+    server = app.listen(port,backlog=4096)
+
+    async def client_attempts():
+        count = 0
+        for pipe in pipes:
+            pipe.send('stats')
+            count += await loop.run_in_executor(None,pipe.recv)
+        return count
+
+    await until(lambda: len(app.clients) == total,120)
+    await asyncio.sleep(1.5)
+    attempts_before = await client_attempts()
+
+    # The crash: stop listening and drop every connection
+    server.stop()
+    for handler in list(app.clients):
+        handler.ws_connection.stream.close()
+    await asyncio.sleep(args.down)
+    app.attempts = []
+    app.turned_away = 0
+    t0 = time.monotonic()
+    server = app.listen(port,backlog=4096)
+    recovered = await until(lambda: len(app.clients) == total,args.timeout)
+    recovery = time.monotonic()-t0
+
+    attempts = await client_attempts()-attempts_before
+    per_second = collections.Counter( int(t-t0) for t in app.attempts )
+    busiest = max(per_second.values()) if per_second else 0
+    for pipe in pipes:
+        pipe.send('stop')
+    server.stop()
+    for handler in list(app.clients):
+        handler.ws_connection.stream.close()
+    await asyncio.sleep(1)
+
+    back = f"{recovery:6.1f}s" if recovered else f">{args.timeout:.0f}s ({len(app.clients)}/{total})"
+    return (f"  {policy:<12} all back in {back}"
+        f" | client attempts {attempts:6d} ({attempts/total:4.1f}/client)"
+        f" | server saw {len(app.attempts):6d}, turned away {app.turned_away:6d} | busiest second {busiest:5d} handshakes")
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--procs', type=int, default=1)
+    parser.add_argument('--capacity', type=int, default=250, help='handshakes a second the server admits')
+    parser.add_argument('--reject', type=float, default=0.0, help='share of handshakes refused at random')
+    parser.add_argument('--down', type=float, default=2.0)
+    parser.add_argument('--cap', type=float, default=10.0, help='longest backoff delay')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--policy', nargs='+', default=list(POLICIES), choices=POLICIES)
+    parser.add_argument('--port', type=int, default=8896)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = min(hard,2*args.clients+1000)
+    if soft < want:
+        resource.setrlimit(resource.RLIMIT_NOFILE,(want,hard))
+
+    print(f"{args.clients} clients, server down {args.down}s, admitting {args.capacity}/s:")
+    for idx,policy in enumerate(args.policy):
+        print(await run_storm(args,policy,args.port+idx))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
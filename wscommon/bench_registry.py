@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Connection tracking for `--connections` fake handlers, per process:
+
+* adhoc:     `clients[uuid.uuid4()] = handler` with user and address as
+             handler attributes, as the apps did
+* registry:  `wscommon.registry.ConnectionRegistry`
+
+Reported: memory for the tracking (tracemalloc, handlers excluded),
+finding one user's connections, getting the handlers for a broadcast
+while a few connect and disconnect between broadcasts, and whether a
+handler closing in the middle of a broadcast breaks it.
+
+    python wscommon/bench_registry.py --connections 100000
+'''
+
+# Python
+import gc
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.registry import ConnectionRegistry
+
+
+class FakeHandler:
+
+    ws_connection = None
+
+
+class AdHoc:
+
+    def __init__(self):
+        self.clients = {}
+
+    def add(self, handler, user, remote):
+        key = uuid.uuid4()
+        handler.user = user
+        handler.remote = remote
+        self.clients[key] = handler
+        return key
+
+    def remove(self, key):
+        self.clients.pop(key,None)
+
+    def by_user(self, user):
+        return [ h for h in self.clients.values() if h.user == user ]
+
+    def handlers(self):
+        return list(self.clients.values())
+
+
+def timed(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter()-t0)/repeat
+
+def run(mode, args, rng):
+    handlers = [ FakeHandler() for _ in range(args.connections) ]
+    users = [ f"user{rng.randrange(args.connections//4)}" for _ in handlers ]
+    gc.collect()
+    tracemalloc.start()
+    tracker = AdHoc() if mode == 'adhoc' else ConnectionRegistry()
+    keys = []
+    for handler,user in zip(handlers,users):
+        remote = f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"
+        if mode == 'adhoc':
+            keys.append(tracker.add(handler,user,remote))
+        else:
+            keys.append(tracker.add(handler,user=user,remote=remote).id)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    if mode == 'adhoc':
+        lookup = timed(lambda: tracker.by_user(rng.choice(users)),20)
+    else:
+        lookup = timed(lambda: tracker.by('user',rng.choice(users)),20)
+
+    # A broadcast per message, with a connect and a disconnect every `--churn-every` messages
+    def broadcast(n=[0]):
+        n[0] += 1
+        if n[0]%args.churn_every == 0:
+            idx = rng.randrange(len(keys))
+            tracker.remove(keys[idx])
+            if mode == 'adhoc':
+                keys[idx] = tracker.add(FakeHandler(),'user0','10.0.0.1')
+            else:
+                keys[idx] = tracker.add(FakeHandler(),user='user0',remote='10.0.0.1').id
+        return tracker.handlers()
+    fanout = timed(broadcast,200)
+
+    # A handler closing while the broadcast writes to it
+    try:
+        source = tracker.clients.values() if mode == 'adhoc' else tracker.handlers()
+        for idx,handler in enumerate(source):
+            if idx == 10:
+                tracker.remove(keys[0])
+        safe = 'yes'
+    except RuntimeError:
+        safe = 'no (RuntimeError)'
+
+    return (f"  {mode:<9} memory {memory/args.connections:6.0f} B/conn"
+        f" | by user {1e6*lookup:8.1f}us | handlers per broadcast {1e6*fanout:7.1f}us"
+        f" | close during broadcast safe: {safe}")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--churn-every', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    print(f"{args.connections} connections:")
+    for mode in ('adhoc','registry'):
+        print(run(mode,args,rng))
+    registry = ConnectionRegistry()
+    for idx in range(args.connections):
+        registry.add(FakeHandler(),user=f"user{idx//4}",remote=f"10.0.{idx//256%256}.{idx%256}")
+    print("  registry.memory():",registry.memory())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Small request/response calls: HTTP requests vs `wscommon.rpc` calls.
+
+The server runs in this process. `--calls` echo calls of `--size` bytes
+are made:
+
+* http:          a POST per call with `AsyncHTTPClient` (a new connection each)
+* rpc serial:    `await client.call` one at a time over one websocket
+* rpc pipelined: up to `--inflight` calls in flight on the same websocket
+
+Then deadlines and cancellation are checked: a call that outlives its
+timeout, and one cancelled by the caller, must both stop the method on
+the server.
+
+    python wscommon/bench_rpc.py
+'''
+
+# Python
+import asyncio
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+# Tornado
+import tornado.web
+import tornado.websocket
+from tornado.httpclient import AsyncHTTPClient
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.reconnect import ReconnectingClient
+from wscommon.rpc import RpcClientMixin, RpcMixin, RpcTimeout, remaining, rpc_method
+
+
+class EchoHttpHandler(tornado.web.RequestHandler):
+
+    def post(self):
+        self.write(self.request.body)
+
+
+class EchoRpcHandler(RpcMixin, tornado.websocket.WebSocketHandler):
+
+    def on_message(self, message):
+        self.rpc_receive(message)
+
+    @rpc_method('echo')
+    def rpc_echo(self, params):
+        return params
+
+    @rpc_method('remaining')
+    def rpc_remaining(self, params):
+        return remaining()
+
+    @rpc_method('sleep')
+    async def rpc_sleep(self, params):
+        try:
+            await asyncio.sleep(params)
+        except asyncio.CancelledError:
+            self.application.stopped += 1
+            raise
+
+
+class BenchClient(RpcClientMixin, ReconnectingClient):
+
+    def on_message(self, msg):
+        self.rpc_receive(msg)
+
+    def on_close(self):
+        self.rpc_connection_lost()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1,int(len(values)*pct/100))]
+
+def report(name, latencies, elapsed):
+    us = [ 1e6*v for v in latencies ]
+    return (f"  {name:<14} {len(latencies)/elapsed:8.0f} calls/s"
+        f" | latency p50 {percentile(us,50):7.0f}us p99 {percentile(us,99):7.0f}us")
+
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--inflight', type=int, default=64)
+    parser.add_argument('--port', type=int, default=8894)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    app = tornado.web.Application([(r'/echo',EchoHttpHandler),(r'/ws',EchoRpcHandler)])
+    app.stopped = 0
+    app.listen(args.port)
+    params = dict(data='x'*args.size)
+    print(f"{args.calls} echo calls of {args.size} bytes:")
+
+    http = AsyncHTTPClient()
+    body = json.dumps(params)
+    latencies = []
+    t0 = time.perf_counter()
+    for _ in range(args.calls):
+        t = time.perf_counter()
+        response = await http.fetch(f'http://localhost:{args.port}/echo',method='POST',body=body)
+        json.loads(response.body)
+        latencies.append(time.perf_counter()-t)
+    print(report('http',latencies,time.perf_counter()-t0))
+
+    client = BenchClient(f'ws://localhost:{args.port}/ws')
+    task = asyncio.create_task(client.start())
+    while client.conn is None:
+        await asyncio.sleep(0.01)
+
+    latencies = []
+    t0 = time.perf_counter()
+    for _ in range(args.calls):
+        t = time.perf_counter()
+        await client.call('echo',params)
+        latencies.append(time.perf_counter()-t)
+    print(report('rpc serial',latencies,time.perf_counter()-t0))
+
+    latencies = []
+    sem = asyncio.Semaphore(args.inflight)
+    async def one():
+        async with sem:
+            t = time.perf_counter()
+            await client.call('echo',params)
+            latencies.append(time.perf_counter()-t)
+    t0 = time.perf_counter()
+    await asyncio.gather(*[ one() for _ in range(args.calls) ])
+    print(report('rpc pipelined',latencies,time.perf_counter()-t0))
+
+    print("deadlines and cancellation:")
+    left = await client.call('remaining',timeout=2.0)
+    print(f"  server sees {left:.3f}s left of a 2s call")
+    try:
+        await client.call('sleep',5,timeout=0.2)
+    except RpcTimeout:
+        pass
+    pending = asyncio.create_task(client.call('sleep',5,timeout=10))
+    await asyncio.sleep(0.1)
+    pending.cancel()
+    await asyncio.sleep(0.3)
+    print(f"  timed out and cancelled calls stopped on the server: {app.stopped}/2")
+
+    client.close()
+    await task
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+# Copyright 2022 Jeffrey LeBlanc
+
+'''
+Finding the subscribers of a publication, as connections grow.
+
+Each of `--connections` connections subscribes to one of `--topics`
+topics ("room.<n>"), and one in `--wildcard-every` also to a wildcard
+pattern ("room.*" or "#"). Publications go to random rooms:
+
+* scan:   every connection checks its own patterns, the cost of sending
+          everything to everyone and filtering
+* index:  `wscommon.topics.TopicIndex.match`
+
+    python wscommon/bench_topics.py --connections 1000 10000 100000
+'''
+
+# Python
+import random
+import sys
+import time
+from pathlib import Path
+# Local
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+from wscommon.topics import TopicIndex, ONE, REST, SEPARATOR
+
+
+def matches(pattern, topic):
+    ''' The same rules as the index, one pattern at a time '''
+    parts = pattern.split(SEPARATOR)
+    segments = topic.split(SEPARATOR)
+    for idx,part in enumerate(parts):
+        if part == REST:
+            return True
+        if idx == len(segments) or (part != ONE and part != segments[idx]):
+            return False
+    return len(parts) == len(segments)
+
+def run(count, args, rng):
+    index = TopicIndex()
+    subscriptions = {}
+    for conn in range(count):
+        patterns = [f"room.{rng.randrange(args.topics)}"]
+        if conn%args.wildcard_every == 0:
+            patterns.append(rng.choice(("room.*","#")))
+        subscriptions[conn] = patterns
+        for pattern in patterns:
+            index.subscribe(pattern,conn)
+    topics = [ f"room.{rng.randrange(args.topics)}" for _ in range(args.publishes) ]
+
+    results = {}
+    for name in ('scan','index'):
+        found = 0
+        t0 = time.perf_counter()
+        for topic in topics:
+            if name == 'scan':
+                recipients = [ c for c,patterns in subscriptions.items()
+                    if any( matches(p,topic) for p in patterns ) ]
+            else:
+                recipients = index.match(topic)
+            found += len(recipients)
+        results[name] = (time.perf_counter()-t0)/len(topics),found/len(topics)
+    scan,index_ = results['scan'],results['index']
+    return (f"  {count:>7} connections | {scan[1]:6.1f} recipients/publish"
+        f" | scan {1e6*scan[0]:9.1f}us | index {1e6*index_[0]:7.1f}us | {scan[0]/index_[0]:7.1f}x")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, nargs='+', default=[1000,10000,100000])
+    parser.add_argument('--topics', type=int, default=1000)
+    parser.add_argument('--wildcard-every', type=int, default=1000)
+    parser.add_argument('--publishes', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    print(f"publishing to {args.topics} rooms, one connection in {args.wildcard_every} on a wildcard too:")
+    for count in args.connections:
+        print(run(count,args,rng))
+
+
+if __name__ == '__main__':
+    main()
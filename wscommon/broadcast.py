@@ -0,0 +1,172 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import logging
+import struct
+import time
+import weakref
+# Tornado
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+
+'''
+Fan-out of one message to many websocket handlers.
+
+`handler.write_message` builds a new frame (and compresses it, when
+permessage-deflate is on) for every recipient, and the future it returns
+is usually dropped, so a client that stops reading just grows its write
+buffer. Here the frame is built once and the same bytes are handed to
+every connection's stream. Each client's unacknowledged bytes are
+tracked, and once a client is over `max_outstanding` the `policy` applies:
+
+* 'drop':       skip messages for that client until it catches up
+* 'coalesce':   keep only the newest message, sent once it catches up
+* 'disconnect': close it with 1013 (try again later)
+
+Connections that mask or compress their frames (client-side connections,
+compression enabled) cannot share bytes and fall back to `write_message`,
+still with the same accounting. Messages under a connection's
+`CompressionPolicy` threshold are sent uncompressed, so they can.
+
+Given a `wscommon.metrics.Histogram` as `fanout`, each `broadcast`
+observes how long it took to hand the message to every connection.
+Shared frames are added to the connection's own byte counts, and to its
+handler's `ws_record` as `wscommon.metrics.WriteMetricsMixin` counts
+what goes by `write_message`.
+'''
+
+POLICIES = ('drop','coalesce','disconnect')
+
+
+def encode_frame(message, binary=False):
+    ''' An unmasked, uncompressed, final frame, as a server sends it '''
+    if isinstance(message,str):
+        message = message.encode('utf-8')
+    # bytes or a memoryview, which is joined to the header without a copy of its own
+    opcode = 0x2 if binary else 0x1
+    length = len(message)
+    if length < 126:
+        header = struct.pack('!BB',0x80|opcode,length)
+    elif length <= 0xFFFF:
+        header = struct.pack('!BBH',0x80|opcode,126,length)
+    else:
+        header = struct.pack('!BBQ',0x80|opcode,127,length)
+    return header+message
+
+def _header_len(marker):
+    ''' Header bytes of an `encode_frame` frame, from the 7 bit length in its second byte '''
+    return 2 if marker < 126 else 4 if marker == 126 else 10
+
+
+class _ClientState:
+
+    __slots__ = ('outstanding','pending','dropped','__weakref__')
+
+    def __init__(self):
+        self.outstanding = 0
+        self.pending = None  # (message, frame, binary) held back by 'coalesce'
+        self.dropped = 0
+
+
+class Broadcaster:
+
+    def __init__(self, max_outstanding=1<<20, policy='drop', fanout=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown slow consumer policy: {policy}')
+        self.max_outstanding = max_outstanding
+        self.policy = policy
+        self.fanout = fanout
+        self.dropped = 0
+        self._states = weakref.WeakKeyDictionary()
+
+    def state(self, handler):
+        state = self._states.get(handler)
+        if state is None:
+            state = self._states[handler] = _ClientState()
+        return state
+
+    def outstanding(self, handler):
+        state = self._states.get(handler)
+        return 0 if state is None else state.outstanding
+
+    def broadcast(self, handlers, message, exclude=None, binary=False):
+        '''
+        Send `message` to each of `handlers` (any iterable, copied first so
+        handlers may come and go meanwhile, unless it is a tuple such as
+        `ConnectionRegistry.handlers()`). Returns how many were written.
+        '''
+        t0 = time.perf_counter()
+        frame = encode_frame(message,binary)
+        sent = 0
+        for handler in handlers if isinstance(handlers,tuple) else list(handlers):
+            if handler is exclude:
+                continue
+            if self._offer(handler,message,frame,binary):
+                sent += 1
+        if self.fanout is not None:
+            self.fanout.observe(time.perf_counter()-t0)
+        return sent
+
+    def status(self):
+        ''' Clients tracked, the bytes they have outstanding and messages dropped '''
+        states = list(self._states.values())
+        return dict(clients=len(states),outstanding=sum( s.outstanding for s in states ),
+            pending=sum( s.pending is not None for s in states ),dropped=self.dropped)
+
+    def send(self, handler, message, binary=False):
+        ''' A single message with the same slow consumer handling '''
+        return self._offer(handler,message,encode_frame(message,binary),binary)
+
+    def _offer(self, handler, message, frame, binary):
+        conn = handler.ws_connection
+        if conn is None or conn.is_closing():
+            return False
+        state = self.state(handler)
+        if state.outstanding > self.max_outstanding:
+            state.dropped += 1
+            self.dropped += 1
+            if self.policy == 'coalesce':
+                state.pending = (message,frame,binary)
+            elif self.policy == 'disconnect':
+                logging.warning('closing slow websocket client (%s bytes behind)', state.outstanding)
+                handler.close(1013,'Slow consumer')
+            return False
+        return self._write(handler,conn,state,message,frame,binary)
+
+    def _write(self, handler, conn, state, message, frame, binary):
+        try:
+            # Relies on tornado's protocol internals; anything unusual
+            # takes the regular path
+            compressor = getattr(conn,'_compressor',None)
+            if compressor is not None and len(message) < getattr(getattr(conn,'policy',None),'threshold',0):
+                # Below a `CompressionPolicy` threshold it goes out uncompressed anyway
+                compressor = None
+            if getattr(conn,'mask_outgoing',True) or compressor is not None:
+                if isinstance(message,memoryview):
+                    message = bytes(message)
+                future = handler.write_message(message,binary=binary)
+            else:
+                future = conn.stream.write(frame)
+                # As tornado counts what it writes itself
+                conn._message_bytes_out += len(frame)-_header_len(frame[1] & 0x7F)
+                conn._wire_bytes_out += len(frame)
+                record = getattr(handler,'ws_record',None)
+                if record is not None:
+                    record.messages_out += 1
+        except (WebSocketClosedError,StreamClosedError):
+            return False
+
+        size = len(frame)
+        state.outstanding += size
+        def on_done(f):
+            state.outstanding -= size
+            if f.exception() is not None:
+                return
+            if state.pending is not None and state.outstanding <= self.max_outstanding:
+                pending, state.pending = state.pending, None
+                if conn.is_closing():
+                    return
+                self._write(handler,conn,state,*pending)
+        future.add_done_callback(on_done)
+        return True
@@ -0,0 +1,145 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Tornado
+import tornado
+import tornado.websocket
+from tornado import httpclient, httputil
+from tornado.websocket import WebSocketProtocol13, WebSocketClientConnection, _PerMessageDeflateCompressor, \
+    _WebSocketParams
+
+
+'''
+permessage-deflate, configured per endpoint.
+
+Tornado compresses every message once compression is negotiated. That
+costs CPU for nothing on small chatty messages, while big payloads on
+bandwidth bound links compress well. A `CompressionPolicy` sets:
+
+* level, mem_level: zlib settings for what this side sends
+* window_bits:      LZ77 window for what this side sends (9-15). Smaller
+                    saves memory per connection. Always allowed, since the
+                    peer's window is an upper bound.
+* threshold:        messages shorter than this go out uncompressed, which
+                    permessage-deflate allows per message
+
+Use `CompressionPolicyMixin` on a handler (before the tornado base class)
+with `compression_policy` or `get_compression_policy`, and
+`websocket_connect(url, compression=policy)` on the client side. A policy
+of None leaves compression off, as before.
+
+This reaches into tornado's private websocket internals, so the module
+checks they are all still there when it is imported: a tornado upgrade
+that moves them fails right away rather than on the first connection.
+
+See <https://www.rfc-editor.org/rfc/rfc7692>
+'''
+
+
+def _check_tornado():
+    protocol = WebSocketProtocol13(None,False,_WebSocketParams())
+    compressor = _PerMessageDeflateCompressor(True,15)
+    needed = (
+        (WebSocketProtocol13,'_create_compressors'),
+        (protocol,'_compressor'),
+        (compressor,'_max_wbits'),
+        (httpclient,'_RequestProxy'),
+        (httpclient.HTTPRequest,'_DEFAULTS'),
+    )
+    missing = [ name for owner,name in needed if not hasattr(owner,name) ]
+    if missing:
+        raise ImportError(f'wscommon.compression needs tornado internals that '
+            f'tornado {tornado.version} does not have: {", ".join(missing)}')
+
+_check_tornado()
+
+
+class CompressionPolicy:
+
+    def __init__(self, level=6, mem_level=8, window_bits=15, threshold=512):
+        self.level = level
+        self.mem_level = mem_level
+        self.window_bits = window_bits
+        self.threshold = threshold
+
+    def options(self):
+        return dict(compression_level=self.level,mem_level=self.mem_level)
+
+    def __repr__(self):
+        return (f'CompressionPolicy(level={self.level}, mem_level={self.mem_level}, '
+            f'window_bits={self.window_bits}, threshold={self.threshold})')
+
+
+# For bandwidth bound links carrying larger messages
+LINK_POLICY = CompressionPolicy(level=6,mem_level=8,window_bits=15,threshold=1024)
+
+
+class _PolicyProtocol(WebSocketProtocol13):
+
+    def __init__(self, handler, mask_outgoing, params, policy):
+        super().__init__(handler,mask_outgoing,params)
+        self.policy = policy
+
+    def _create_compressors(self, side, agreed_parameters, compression_options=None):
+        super()._create_compressors(side,agreed_parameters,compression_options)
+        if self.policy.window_bits < self._compressor._max_wbits:
+            self._compressor = _PerMessageDeflateCompressor(
+                persistent=(side+'_no_context_takeover') not in agreed_parameters,
+                max_wbits=self.policy.window_bits,
+                compression_options=compression_options)
+
+    def write_message(self, message, binary=False):
+        compressor = self._compressor
+        if compressor is None or isinstance(message,dict) or len(message) >= self.policy.threshold:
+            return super().write_message(message,binary)
+        # Sent without the RSV1 bit; the compression context is untouched
+        self._compressor = None
+        try:
+            return super().write_message(message,binary)
+        finally:
+            self._compressor = compressor
+
+
+class CompressionPolicyMixin:
+
+    compression_policy = None
+
+    def get_compression_policy(self):
+        return self.compression_policy
+
+    def get_compression_options(self):
+        policy = self.get_compression_policy()
+        return None if policy is None else policy.options()
+
+    def get_websocket_protocol(self):
+        protocol = super().get_websocket_protocol()
+        policy = self.get_compression_policy()
+        if policy is None or not isinstance(protocol,WebSocketProtocol13):
+            return protocol
+        return _PolicyProtocol(self,False,protocol.params,policy)
+
+
+class _PolicyClientConnection(WebSocketClientConnection):
+
+    def __init__(self, request, policy, **kwargs):
+        self.policy = policy
+        super().__init__(request,compression_options=policy.options(),**kwargs)
+
+    def get_websocket_protocol(self):
+        return _PolicyProtocol(self,True,self.params,self.policy)
+
+
+def websocket_connect(url, compression=None, **kwargs):
+    '''
+    `tornado.websocket.websocket_connect`, with `compression` a
+    `CompressionPolicy` (or None for no compression).
+    '''
+    if compression is None:
+        return tornado.websocket.websocket_connect(url,**kwargs)
+    if isinstance(url,httpclient.HTTPRequest):
+        request = url
+        request.headers = httputil.HTTPHeaders(request.headers)
+    else:
+        request = httpclient.HTTPRequest(url,connect_timeout=kwargs.pop('connect_timeout',None))
+    request = httpclient._RequestProxy(request,httpclient.HTTPRequest._DEFAULTS)
+    conn = _PolicyClientConnection(request,compression,**kwargs)
+    return conn.connect_future
@@ -0,0 +1,228 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import math
+import random
+import time
+# Tornado
+from tornado.ioloop import PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+
+'''
+Ping/pong liveness and round trip times for websocket connections.
+
+A connection whose peer vanished without a FIN (a laptop lid closed, a
+NAT entry expired) looks open forever: it stays registered and keeps
+being written to. A `Heartbeat` pings each connection it watches every
+`interval` seconds and closes it if the pong has not come back within
+`timeout`. The pong also gives the round trip time, kept as a moving
+average in `liveness.rtt`.
+
+Tornado's own `websocket_ping_interval` runs a `PeriodicCallback` per
+connection. Here all connections share one `TimerWheel`, a single
+callback every `tick` that fires whatever is due in that slot, so
+100k connections cost one loop timer, and adding or cancelling one is
+O(1).
+
+Use `HeartbeatMixin` on handlers (before the tornado base class, with
+`self.start_heartbeat()` in `open`) and the application's
+`ws_heartbeat`; `ReconnectingClient` takes a `heartbeat`.
+'''
+
+PING_PREFIX = b'hb'
+
+
+class Timer:
+
+    __slots__ = ('callback','args','slot','rounds')
+
+    def __init__(self, callback, args, slot, rounds):
+        self.callback = callback
+        self.args = args
+        self.slot = slot
+        self.rounds = rounds
+
+
+class TimerWheel:
+
+    '''
+    A hashed timer wheel: `slots` buckets of `tick` seconds. A timer goes
+    in the bucket it is due in, with the number of whole turns to wait.
+    Timers fire up to one tick late, never early.
+    '''
+
+    def __init__(self, tick=0.25, slots=512):
+        self.tick = tick
+        self.slots = slots
+        self._wheel = [ {} for _ in range(slots) ] # Timer => None, an ordered set
+        self._cursor = 0
+        self._ticks = 0
+        self._start = None
+        self._count = 0
+        self._callback = None
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        if self._callback is None:
+            self._start = time.monotonic()-self._ticks*self.tick
+            self._callback = PeriodicCallback(self._on_tick,1000*self.tick)
+            self._callback.start()
+        # Counted from the last tick, which is up to a tick ago
+        now_ticks = (time.monotonic()-self._start)/self.tick
+        ticks = max(1,math.ceil(now_ticks-self._ticks+delay/self.tick))
+        slot = (self._cursor+ticks)%self.slots
+        timer = Timer(callback,args,slot,(ticks-1)//self.slots)
+        self._wheel[slot][timer] = None
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        if self._wheel[timer.slot].pop(timer,0) is None:
+            self._count -= 1
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def _on_tick(self):
+        # Catch up on the ticks a busy loop made us miss
+        target = int((time.monotonic()-self._start)/self.tick)
+        while self._ticks < target:
+            self._ticks += 1
+            self._cursor = (self._cursor+1)%self.slots
+            bucket = self._wheel[self._cursor]
+            due = []
+            for timer in bucket:
+                if timer.rounds == 0:
+                    due.append(timer)
+                else:
+                    timer.rounds -= 1
+            for timer in due:
+                del bucket[timer]
+                self._count -= 1
+            for timer in due:
+                timer.callback(*timer.args)
+
+
+class Liveness:
+
+    __slots__ = ('peer','timer','sent','payload','rtt','pongs')
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.timer = None
+        self.sent = None # When the unanswered ping went out
+        self.payload = None
+        self.rtt = None
+        self.pongs = 0
+
+
+class Heartbeat:
+
+    '''
+    Watched peers provide `heartbeat_ping(data)` and `heartbeat_dead()`,
+    hand their pongs to `pong`, and get a `liveness` attribute.
+    '''
+
+    def __init__(self, interval=20.0, timeout=10.0, wheel=None):
+        self.interval = interval
+        self.timeout = min(timeout,interval)
+        self.wheel = wheel or TimerWheel()
+        self.watched = 0
+        self.dead = 0
+        self._counter = 0
+
+    def watch(self, peer):
+        state = peer.liveness = Liveness(peer)
+        # Spread out the pings of connections opened together
+        state.timer = self.wheel.call_later(random.uniform(0.5,1.0)*self.interval,self._ping,state)
+        self.watched += 1
+        return state
+
+    def unwatch(self, peer):
+        state = peer.liveness
+        if state is None or state.peer is None:
+            return
+        if state.timer is not None:
+            self.wheel.cancel(state.timer)
+            state.timer = None
+        state.peer = None
+        self.watched -= 1
+
+    def pong(self, peer, data):
+        state = peer.liveness
+        if state is None or state.sent is None or data != state.payload:
+            return # Another ping's pong
+        rtt = time.monotonic()-state.sent
+        state.rtt = rtt if state.rtt is None else 0.8*state.rtt+0.2*rtt
+        state.pongs += 1
+        state.sent = None
+
+    def _ping(self, state):
+        state.timer = None
+        self._counter += 1
+        state.payload = PING_PREFIX+str(self._counter).encode()
+        state.sent = time.monotonic()
+        peer = state.peer
+        try:
+            peer.heartbeat_ping(state.payload)
+        except (WebSocketClosedError,StreamClosedError):
+            self.unwatch(peer)
+            return
+        state.timer = self.wheel.call_later(self.timeout,self._check,state)
+
+    def _check(self, state):
+        state.timer = None
+        peer = state.peer
+        if state.sent is not None:
+            self.dead += 1
+            self.unwatch(peer)
+            peer.heartbeat_dead()
+            return
+        state.timer = self.wheel.call_later(self.interval-self.timeout,self._ping,state)
+
+    def status(self):
+        return dict(interval=self.interval,timeout=self.timeout,watched=self.watched,dead=self.dead)
+
+
+def rtt_ms(peer):
+    ''' The peer's smoothed round trip time in ms, or None '''
+    state = getattr(peer,'liveness',None)
+    if state is None or state.rtt is None:
+        return None
+    return round(1000*state.rtt,3)
+
+
+class HeartbeatMixin:
+
+    liveness = None
+
+    def get_heartbeat(self):
+        return getattr(self.application,'ws_heartbeat',None)
+
+    def start_heartbeat(self):
+        heartbeat = self.get_heartbeat()
+        if heartbeat is not None:
+            heartbeat.watch(self)
+
+    def heartbeat_ping(self, data):
+        self.ping(data)
+
+    def heartbeat_dead(self):
+        # A close handshake would wait on the peer that is gone
+        if self.ws_connection is not None and self.ws_connection.stream is not None:
+            self.ws_connection.stream.close()
+
+    def on_pong(self, data):
+        if self.liveness is not None:
+            self.get_heartbeat().pong(self,data)
+
+    def on_connection_close(self):
+        if self.liveness is not None:
+            self.get_heartbeat().unwatch(self)
+        super().on_connection_close()
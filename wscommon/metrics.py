@@ -0,0 +1,332 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import bisect
+import hmac
+import math
+import time
+# Tornado
+import tornado.web
+from tornado.ioloop import IOLoop
+
+
+'''
+Counters for a process, served in the Prometheus text format.
+
+A `Metrics` holds named families of samples:
+
+* counter:    counts up as things happen, `family.labels(...).inc()`
+* histogram:  `observe(seconds)` into fixed buckets, found with `bisect`
+* gauge:      read from a function when scraped
+
+`collect(fn)` adds a function that returns whole families when scraped,
+for what is already counted elsewhere (a registry's connections, an
+outbox's depth, a `stats` dict), so it costs nothing until asked for.
+
+Counting is a plain add to a slotted attribute, with no lock: the
+IOLoop thread does all of it. Code on another thread (a hashing pool,
+say) hands its result back to the loop and is counted there. Hot paths
+hold on to the child they bump (`family.labels()` for one without
+labels) rather than look it up each time.
+
+`MetricsHandler` serves `render()`, behind a token if the application
+has a `metrics_token`; `LoopLag` measures how late the loop runs a
+timer; `MetricsMixin` counts the messages a websocket handler receives
+on its `wscommon.registry.Connection`, which reads the bytes each way
+from tornado's own counters, and `connection_metrics` exposes them, in
+total and per connection. Counting messages sent takes an override of
+every `write_message`, so it is left to `WriteMetricsMixin`, for
+handlers that can afford it. `stats_metrics` exposes a `stats` dict.
+
+See <https://prometheus.io/docs/instrumenting/exposition_formats/>
+'''
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from 100us to 2.5s
+LATENCY_BUCKETS = (0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5)
+
+
+class Counter:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+
+    __slots__ = ('bounds','counts','sum','count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1) # the last for over the highest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Bucket i counts bounds[i-1] < value <= bounds[i], as `le` means
+        self.counts[bisect.bisect_left(self.bounds,value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Family:
+
+    def __init__(self, name, kind, help, labels=(), make=None, fn=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.fn = fn # a gauge's value, or {label values: value} with labels
+        self._make = make
+        self.children = {} # label values => Counter or Histogram
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} has labels {self.labelnames}')
+            child = self.children[values] = self._make()
+        return child
+
+    def samples(self):
+        ''' [(suffix, {label: value}, value)] '''
+        if self.fn is not None:
+            value = self.fn()
+            if not self.labelnames:
+                return [('',{},value)]
+            return [ ('',dict(zip(self.labelnames,key)),v) for key,v in value.items() ]
+        result = []
+        for key,child in self.children.items():
+            labels = dict(zip(self.labelnames,key))
+            if self.kind == 'histogram':
+                total = 0
+                for bound,count in zip(child.bounds+(math.inf,),child.counts):
+                    total += count
+                    result.append(('_bucket',dict(labels,le=bound),total))
+                result.append(('_sum',labels,child.sum))
+                result.append(('_count',labels,child.count))
+            else:
+                result.append(('',labels,child.value))
+        return result
+
+
+class Metrics:
+
+    def __init__(self, prefix=''):
+        self.prefix = f'{prefix}_' if prefix else ''
+        self._families = {}
+        self._collectors = []
+
+    def _add(self, family):
+        if family.name in self._families:
+            raise ValueError(f'Already have a metric named {family.name}')
+        self._families[family.name] = family
+        return family
+
+    def counter(self, name, help, labels=()):
+        return self._add(Family(self.prefix+name,'counter',help,labels,make=Counter))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        return self._add(Family(self.prefix+name,'histogram',help,labels,make=lambda: Histogram(buckets)))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self._add(Family(self.prefix+name,'gauge',help,labels,fn=fn))
+
+    def collect(self, fn):
+        '''
+        `fn()` returns families made when scraped, as
+        [(name, kind, help, [({label: value}, value)])], named without the prefix
+        '''
+        self._collectors.append(fn)
+
+    def loop_lag(self, interval=0.5):
+        ''' A `LoopLag` into a `loop_lag_seconds` histogram, started '''
+        lag = LoopLag(self.histogram('loop_lag_seconds',
+            'How late the IOLoop ran a timer',buckets=LATENCY_BUCKETS).labels(),interval)
+        lag.start()
+        return lag
+
+    def render(self):
+        lines = []
+        for family in self._families.values():
+            _render(lines,family.name,family.kind,family.help,family.samples())
+        for fn in self._collectors:
+            for name,kind,help,samples in fn():
+                _render(lines,self.prefix+name,kind,help,[ ('',labels,v) for labels,v in samples ])
+        return '\n'.join(lines)+'\n'
+
+def _render(lines, name, kind, help, samples):
+    lines.append(f'# HELP {name} {help}')
+    lines.append(f'# TYPE {name} {kind}')
+    for suffix,labels,value in samples:
+        if labels:
+            labels = ','.join( f'{k}="{_escape(v)}"' for k,v in labels.items() )
+            lines.append(f'{name}{suffix}{{{labels}}} {_number(value)}')
+        else:
+            lines.append(f'{name}{suffix} {_number(value)}')
+
+def _escape(value):
+    if isinstance(value,float):
+        value = _number(value)
+    return str(value).replace('\\','\\\\').replace('\n','\\n').replace('"','\\"')
+
+def _number(value):
+    if isinstance(value,float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(int(value))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    '''
+    The application's `metrics`, for a Prometheus scrape. With a
+    `metrics_token` on the application, only for an "Authorization:
+    Bearer <token>" header.
+    '''
+
+    def get(self):
+        token = getattr(self.application,'metrics_token',None)
+        if token is not None:
+            given = self.request.headers.get("Authorization","")
+            if not hmac.compare_digest(given.encode('utf-8'),f"Bearer {token}".encode('utf-8')):
+                raise tornado.web.HTTPError(403)
+        self.set_header('Content-Type',CONTENT_TYPE)
+        self.write(self.application.metrics.render())
+
+
+class LoopLag:
+
+    '''
+    Sets a timer every `interval` seconds and observes how long after its
+    time the loop got to it: the longest anything on the loop held it up
+    in that time, give or take.
+    '''
+
+    def __init__(self, histogram, interval=0.5):
+        self.histogram = histogram
+        self.interval = interval
+        self.last = 0.0
+        self._due = None
+        self._handle = None
+
+    def start(self):
+        loop = IOLoop.current()
+        self._due = loop.time()+self.interval
+        self._handle = loop.call_at(self._due,self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+
+    def _tick(self):
+        loop = IOLoop.current()
+        now = loop.time()
+        self.last = max(0.0,now-self._due)
+        self.histogram.observe(self.last)
+        self._due = now+self.interval
+        self._handle = loop.call_at(self._due,self._tick)
+
+
+#-- Websocket Connections ----------------------------------------#
+
+class MetricsMixin:
+
+    '''
+    Counts the messages a websocket handler receives on `ws_record`, its
+    `wscommon.registry.Connection` (set when the registry adds it). Use
+    before the tornado base class, and pass what `on_message` gets
+    through `count_received` first.
+    '''
+
+    ws_record = None
+
+    def count_received(self, message):
+        record = self.ws_record
+        if record is not None:
+            record.messages_in += 1
+        return message
+
+
+class WriteMetricsMixin(MetricsMixin):
+
+    '''
+    Counts messages sent as well, for `connection_metrics(...,
+    messages_out=True)`. What `wscommon.broadcast.Broadcaster` writes past
+    `write_message` it counts itself. The override costs about 0.3us a
+    write, around 1% of one.
+    '''
+
+    def write_message(self, message, binary=False):
+        record = self.ws_record
+        if record is not None:
+            record.messages_out += 1
+        return super().write_message(message,binary)
+
+
+def connection_metrics(registry, name, per_connection=True, messages_out=False):
+    '''
+    A collector for the connections of `registry`: how many, their
+    messages and bytes (closed ones included in the totals) and write
+    buffers, and with `per_connection` each one's, labelled by id and
+    `user` or `name` where set. Messages sent are only there with
+    `messages_out`, for handlers counting them (`WriteMetricsMixin`).
+    Families are named `<name>_...`.
+    '''
+    fields = [ f for f in TRAFFIC_HELP if messages_out or f[0] != 'messages_out' ]
+    def collect():
+        traffic = registry.traffic()
+        families = [
+            (f'{name}_connections','gauge','Open connections',[({},len(registry))]),
+            (f'{name}_write_buffer_bytes','gauge','Bytes written and not yet sent',
+                [({},sum( c.buffered() for c in registry ))]),
+        ]
+        for field,help in fields:
+            families.append((f'{name}_{field}_total','counter',help,[({},traffic[field])]))
+        if per_connection:
+            conns = [ (_connection_labels(c),c) for c in registry ]
+            for field,help in fields:
+                families.append((f'{name}_connection_{field}_total','counter',help,
+                    [ (labels,getattr(c,field)) for labels,c in conns ]))
+            families.append((f'{name}_connection_write_buffer_bytes','gauge','Bytes written and not yet sent',
+                [ (labels,c.buffered()) for labels,c in conns ]))
+            families.append((f'{name}_connection_age_seconds','gauge','Time since the connection opened',
+                [ (labels,time.monotonic()-c.opened) for labels,c in conns ]))
+        return families
+    return collect
+
+def stats_metrics(name, stats, help):
+    '''
+    A collector for a `stats` dict of counts (a router's, a table's), a
+    `<name>_<key>_total` counter per key, described as "<help>: <key>"
+    '''
+    def collect():
+        return [ (f'{name}_{key}_total','counter',f'{help}: {key}',[({},value)])
+            for key,value in stats.items() ]
+    return collect
+
+TRAFFIC_HELP = (
+    ('messages_in','Messages received'),
+    ('bytes_in','Message bytes received'),
+    ('messages_out','Messages sent'),
+    ('bytes_out','Message bytes sent'),
+)
+
+def _connection_labels(conn):
+    labels = dict(id=conn.id)
+    if conn.user is not None:
+        labels['user'] = conn.user
+    if conn.name is not None:
+        labels['name'] = conn.name
+    return labels
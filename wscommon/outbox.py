@@ -0,0 +1,83 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import collections
+
+
+'''
+Messages a client has yet to get through to the server.
+
+An `Outbox` holds at most `max_messages` messages and `max_bytes` bytes
+of them, in order, each with a sequence number counting up from 1 for
+the life of the client. When it is full, `overflow` decides:
+
+* 'drop-oldest': make room by dropping the oldest message
+* 'drop-newest': drop the message being added
+* 'error':       raise `OutboxFull`
+
+Without acks a message leaves the outbox once it is written, so only what
+was sent while disconnected is kept. With acks (see `wscommon.resume`) it
+stays until the server confirms it, and is sent again on reconnect.
+'''
+
+OVERFLOW_POLICIES = ('drop-oldest','drop-newest','error')
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class Outbox:
+
+    def __init__(self, max_messages=1000, max_bytes=1<<20, overflow='drop-oldest'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.nbytes = 0
+        self.dropped = 0
+        self._entries = collections.deque() # (seq, message, binary)
+        self._next_seq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def push(self, message, binary=False):
+        ''' Add a message; returns its sequence number, or None if dropped '''
+        size = len(message)
+        entries = self._entries
+        while entries and (len(entries) >= self.max_messages or self.nbytes+size > self.max_bytes):
+            if self.overflow == 'error':
+                raise OutboxFull(f'{len(entries)} messages, {self.nbytes} bytes waiting')
+            if self.overflow == 'drop-newest':
+                self.dropped += 1
+                return None
+            self._pop()
+            self.dropped += 1
+        if size > self.max_bytes:
+            if self.overflow == 'error':
+                raise OutboxFull(f'message of {size} bytes is over {self.max_bytes}')
+            self.dropped += 1
+            return None
+        self._next_seq += 1
+        entries.append((self._next_seq,message,binary))
+        self.nbytes += size
+        return self._next_seq
+
+    def ack(self, seq):
+        ''' Drop the messages up to and including `seq` '''
+        entries = self._entries
+        while entries and entries[0][0] <= seq:
+            self._pop()
+
+    def _pop(self):
+        entry = self._entries.popleft()
+        self.nbytes -= len(entry[1])
+        return entry
+
+    def status(self):
+        return dict(messages=len(self._entries),bytes=self.nbytes,dropped=self.dropped)
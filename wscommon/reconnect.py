@@ -0,0 +1,292 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+import logging
+import random
+import time
+# Tornado
+from tornado.httpclient import HTTPRequest, HTTPClientError
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+# Local
+from .compression import websocket_connect
+from .resume import RESUME_PROTOCOL, TOKEN_HEADER, LAST_HEADER, wrap
+
+
+'''
+A websocket client that reconnects, without the thundering herd.
+
+Retrying every second means that when a server restarts, all of its
+clients come back in the same second, and the ones turned away all come
+back together the second after. Instead, a client waits before each retry
+with decorrelated jitter backoff:
+
+    delay = min(cap, uniform(base, 3*previous delay))
+
+which grows about exponentially and spreads clients out over the whole
+range. The delay resets once a connection has stayed up `stable_after`
+seconds, so a flapping server still gets backed off from. A
+`ConnectLimiter` shared by many clients also caps the rate of attempts
+they make together.
+
+States: connecting -> open -> (closing ->) backoff -> connecting ...
+until `close`, then closed.
+
+With an `outbox` (a `wscommon.outbox.Outbox`), `write_message` queues
+what is sent while disconnected and sends it, in order, once connected
+again. With `acks` as well, messages are kept until the server acks them
+and a reconnect resumes the same server side session; see
+`wscommon.resume`. Without acks, `hold_outbox` keeps the queue back on
+each open until `release_outbox`, for a protocol with its own handshake
+to finish first; meanwhile `write_message` sends directly, unqueued. With a `heartbeat` (a `wscommon.heartbeat.Heartbeat`),
+a connection whose server stops answering pings is dropped and
+reconnected.
+
+A hook that raises never ends `start`: an exception in `on_message` is
+logged and the connection carries on, one in `on_open` is logged and the
+connection dropped, and the client backs off and redials as usual.
+
+See <https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/>
+'''
+
+CONNECTING = 'connecting'
+OPEN = 'open'
+CLOSING = 'closing'
+CLOSED = 'closed'
+BACKOFF = 'backoff'
+
+CONNECT_ERRORS = (HTTPClientError,OSError,StreamClosedError)
+
+
+class Backoff:
+
+    ''' Decorrelated jitter, in seconds '''
+
+    def __init__(self, base=0.5, cap=10.0, rng=None):
+        self.base = base
+        self.cap = cap
+        self.random = rng or random.Random()
+        self.delay = base
+
+    def next(self):
+        self.delay = min(self.cap,self.random.uniform(self.base,3*self.delay))
+        return self.delay
+
+    def reset(self):
+        self.delay = self.base
+
+
+class ConnectLimiter:
+
+    '''
+    A token bucket: at most `rate` attempts a second, after a first burst
+    of `burst`. Attempts over the rate are queued, not refused.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def reserve(self, now=None):
+        ''' Take a token; returns how long to wait before using it '''
+        now = time.monotonic() if now is None else now
+        self._tokens = min(self.burst,self._tokens+(now-self._last)*self.rate)
+        self._last = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens/self.rate
+
+
+class ReconnectingClient:
+
+    '''
+    Subclasses override the `on_*` hooks. `start` runs until `close`;
+    `conn` is the open connection, or None.
+    '''
+
+    def __init__(self, url, compression=None, backoff=None, limiter=None,
+            request_timeout=5, stable_after=10, outbox=None, acks=False, heartbeat=None,
+            hold_outbox=False):
+        self.url = url
+        self.compression = compression
+        self.backoff = backoff or Backoff()
+        self.limiter = limiter
+        self.request_timeout = request_timeout
+        self.stable_after = stable_after
+        self.conn = None
+        self.state = CLOSED
+        self.stats = dict(attempts=0,failures=0,opens=0)
+        self.outbox = outbox
+        self.acks = acks and outbox is not None
+        self.resume_token = None
+        self.resuming = False
+        self.hold_outbox = hold_outbox and outbox is not None and not self.acks
+        self._held = False
+        self.heartbeat = heartbeat
+        self.liveness = None
+        self._stopping = asyncio.Event()
+
+    async def start(self):
+        self._stopping.clear()
+        while not self._stopping.is_set():
+            self.state = CONNECTING
+            if self.limiter is not None and await self._wait(self.limiter.reserve()):
+                break
+            self.stats['attempts'] += 1
+            try:
+                headers = {}
+                if self.resume_token is not None:
+                    headers[TOKEN_HEADER] = self.resume_token
+                request = HTTPRequest(url=self.url,request_timeout=self.request_timeout,headers=headers)
+                conn = await websocket_connect(url=request,compression=self.compression,
+                    subprotocols=[RESUME_PROTOCOL] if self.acks else None)
+            except CONNECT_ERRORS as err:
+                self.stats['failures'] += 1
+                self.on_connect_error(err)
+            else:
+                try:
+                    await self._serve(conn)
+                except Exception:
+                    # A failing on_close, say; the client redials regardless
+                    logging.exception("websocket client for %s failed",self.url)
+            if self._stopping.is_set():
+                break
+            self.state = BACKOFF
+            await self._wait(self.backoff.next())
+        self.state = CLOSED
+
+    async def _serve(self, conn):
+        if self._stopping.is_set():
+            # `close` was called while connecting
+            conn.close()
+            return
+        self.conn = conn
+        self.state = OPEN
+        self.stats['opens'] += 1
+        opened_at = time.monotonic()
+        self._held = self.hold_outbox
+        self.resuming = conn.selected_subprotocol == RESUME_PROTOCOL
+        if self.resuming:
+            token = conn.headers.get(TOKEN_HEADER)
+            if token == self.resume_token:
+                self.outbox.ack(int(conn.headers.get(LAST_HEADER,0)))
+            self.resume_token = token
+            conn.on_ping = self._on_ping
+        if self.heartbeat is not None:
+            conn.on_pong = lambda data: self.heartbeat.pong(self,data)
+            self.heartbeat.watch(self)
+        try:
+            # The backlog first: what on_open writes is numbered after it
+            self._flush()
+            try:
+                self.on_open()
+            except Exception:
+                logging.exception("on_open failed for %s, reconnecting",self.url)
+                conn.close()
+                return
+            while True:
+                msg = await conn.read_message()
+                if msg is None:
+                    break
+                try:
+                    self.on_message(msg)
+                except Exception:
+                    logging.exception("on_message failed for %s",self.url)
+        finally:
+            if self.heartbeat is not None:
+                self.heartbeat.unwatch(self)
+            self.conn = None
+            self._held = False
+            if time.monotonic()-opened_at >= self.stable_after:
+                self.backoff.reset()
+            self.on_close()
+
+    async def _wait(self, delay):
+        ''' Sleep for `delay`; returns True if `close` was called meanwhile '''
+        if delay > 0:
+            try:
+                await asyncio.wait_for(self._stopping.wait(),delay)
+            except asyncio.TimeoutError:
+                pass
+        return self._stopping.is_set()
+
+    def close(self):
+        ''' Close for good; `start` returns once the connection is closed '''
+        self._stopping.set()
+        if self.conn is not None:
+            self.state = CLOSING
+            self.conn.close()
+
+    def write_message(self, message, binary=False):
+        ''' False if the message was not sent, nor queued to be '''
+        if self.outbox is None or self._held:
+            return self.conn is not None and self._write(None,message,binary)
+        seq = self.outbox.push(message,binary)
+        if seq is None:
+            return False
+        if self.conn is not None:
+            if self.resuming:
+                self._write(seq,message,binary)
+            else:
+                self._flush()
+        return True
+
+    def _write(self, seq, message, binary):
+        try:
+            self.conn.write_message(wrap(seq,message,binary) if self.resuming else message,binary=binary)
+        except WebSocketClosedError:
+            return False
+        return True
+
+    def release_outbox(self):
+        ''' With `hold_outbox`, send the queue once the connection is ready for it '''
+        if self._held:
+            self._held = False
+            self._flush()
+
+    def _flush(self):
+        ''' Send what is waiting: all of it kept until acked, or else taken out as sent '''
+        outbox = self.outbox
+        if outbox is None or self.conn is None or self._held:
+            return
+        if self.resuming:
+            for seq,message,binary in list(outbox):
+                if not self._write(seq,message,binary):
+                    return
+            return
+        while len(outbox):
+            seq,message,binary = next(iter(outbox))
+            if not self._write(seq,message,binary):
+                return
+            outbox.ack(seq)
+
+    def heartbeat_ping(self, data):
+        if self.conn is None:
+            raise WebSocketClosedError()
+        self.conn.ping(data)
+
+    def heartbeat_dead(self):
+        # The close handshake would wait on a server that is gone
+        if self.conn is not None and self.conn.protocol is not None:
+            self.conn.protocol.stream.close()
+
+    def _on_ping(self, data):
+        kind,_,seq = data.partition(b' ')
+        if kind == b'ack':
+            self.outbox.ack(int(seq))
+
+    #-- Hooks ------------------------------------------------#
+
+    def on_open(self):
+        pass
+
+    def on_message(self, msg):
+        pass
+
+    def on_close(self):
+        pass
+
+    def on_connect_error(self, err):
+        pass
@@ -0,0 +1,233 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import sys
+import time
+
+
+'''
+The websocket connections of a process, for lookups and fan-out.
+
+Each connection gets a small int id and a `Connection` record (slotted,
+about 130 bytes) kept in a dict by id. Records are also indexed by
+`user`, `remote` address, `node` and `name` (an id the client chose,
+like a mesh leaf id), for "everything this user has open" or "the link
+to that node" without a scan. An index entry with a
+single connection holds the record itself rather than a dict of one.
+Topics are indexed by `wscommon.topics.TopicIndex`; a registry given one
+answers `subscribers` from it too.
+
+`handlers()` is a tuple of every handler, kept until a connection comes
+or goes, so a broadcast does not build a new list per message nor break
+when a handler closes while it is being iterated. The handlers are also
+kept in a flat list (a record knows its position, and removing swaps the
+last one in), so rebuilding the tuple is a copy of that list rather than
+a walk over the records.
+
+`memory()` estimates what the registry holds per connection, and
+`Connection.buffered` what its socket still has to send. Records count
+their messages (see `wscommon.metrics`, whose mixins find the record as
+the handler's `ws_record`) and read the bytes from tornado's own
+counters, and `traffic()` adds them up, closed connections
+included.
+'''
+
+INDEXES = ('user','remote','node','name')
+TRAFFIC = ('messages_in','bytes_in','messages_out','bytes_out')
+
+
+def buffered(ws):
+    ''' Bytes written to a websocket handler or client connection and not yet sent '''
+    conn = getattr(ws,'ws_connection',None) or getattr(ws,'protocol',None)
+    pending = getattr(getattr(conn,'stream',None),'_write_buffer',None)
+    return len(pending) if pending is not None else 0
+
+
+class Connection:
+
+    __slots__ = ('id','handler','user','remote','node','name','opened','pos',
+        'protocol','messages_in','messages_out')
+
+    def __init__(self, id, handler, user=None, remote=None, node=None, name=None):
+        self.id = id
+        self.handler = handler
+        self.user = user
+        self.remote = remote
+        self.node = node
+        self.name = name
+        self.opened = time.monotonic()
+        self.pos = None # in the registry's handler list
+        # Kept, as the handler lets go of it before `on_close`
+        self.protocol = getattr(handler,'ws_connection',None)
+        self.messages_in = self.messages_out = 0
+
+    @property
+    def bytes_in(self):
+        ''' Message bytes received, after decompression '''
+        return getattr(self.protocol,'_message_bytes_in',0)
+
+    @property
+    def bytes_out(self):
+        ''' Message bytes sent, before compression '''
+        return getattr(self.protocol,'_message_bytes_out',0)
+
+    def buffered(self):
+        ''' Bytes written to the connection and not yet sent '''
+        return buffered(self.handler)
+
+    def describe(self):
+        return dict(id=self.id,user=self.user,remote=self.remote,node=self.node,name=self.name,
+            age=round(time.monotonic()-self.opened,3),buffered=self.buffered(),
+            messages_in=self.messages_in,messages_out=self.messages_out)
+
+
+class ConnectionRegistry:
+
+    def __init__(self, topics=None):
+        self.topics = topics
+        self._by_id = {} # id => Connection
+        self._indexes = { name: {} for name in INDEXES } # index => value => Connection or {id: Connection}
+        self._next_id = 0
+        self._conns = [] # by pos, alongside _handler_list
+        self._handler_list = []
+        self._handlers = None
+        self.stats = dict(added=0,removed=0,snapshots=0)
+        self._closed = dict.fromkeys(TRAFFIC,0) # what removed connections had counted
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def __iter__(self):
+        ''' The records, as of now '''
+        return iter(tuple(self._by_id.values()))
+
+    def add(self, handler, user=None, remote=None, node=None, name=None):
+        self._next_id += 1
+        conn = Connection(self._next_id,handler,user,remote,node,name)
+        self._by_id[conn.id] = conn
+        for index in INDEXES:
+            self._index(index,conn)
+        conn.pos = len(self._conns)
+        self._conns.append(conn)
+        self._handler_list.append(handler)
+        try:
+            handler.ws_record = conn
+        except AttributeError:
+            pass
+        self._handlers = None
+        self.stats['added'] += 1
+        return conn
+
+    def remove(self, id):
+        ''' The record taken out, or None if there was none '''
+        conn = self._by_id.pop(id,None)
+        if conn is None:
+            return None
+        for name in INDEXES:
+            self._unindex(name,conn)
+        last = self._conns.pop()
+        handler = self._handler_list.pop()
+        if last is not conn:
+            last.pos = conn.pos
+            self._conns[conn.pos] = last
+            self._handler_list[conn.pos] = handler
+        self._handlers = None
+        self.stats['removed'] += 1
+        for field in TRAFFIC:
+            self._closed[field] += getattr(conn,field)
+        return conn
+
+    def get(self, id):
+        return self._by_id.get(id)
+
+    def update(self, id, **fields):
+        ''' Change indexed fields of a connection, e.g. `user` once known '''
+        conn = self._by_id[id]
+        for name,value in fields.items():
+            if name not in INDEXES:
+                raise ValueError(f'Not an indexed field: {name}')
+            self._unindex(name,conn)
+            setattr(conn,name,value)
+            self._index(name,conn)
+        return conn
+
+    def _index(self, name, conn):
+        value = getattr(conn,name)
+        if value is None:
+            return
+        index = self._indexes[name]
+        entry = index.get(value)
+        if entry is None:
+            index[value] = conn
+        elif isinstance(entry,Connection):
+            index[value] = {entry.id: entry,conn.id: conn}
+        else:
+            entry[conn.id] = conn
+
+    def _unindex(self, name, conn):
+        value = getattr(conn,name)
+        if value is None:
+            return
+        index = self._indexes[name]
+        entry = index.get(value)
+        if entry is conn:
+            del index[value]
+        elif isinstance(entry,dict):
+            entry.pop(conn.id,None)
+            if len(entry) == 1:
+                index[value] = next(iter(entry.values()))
+
+    def by(self, index, value):
+        ''' The records with `index` (user, remote, node or name) equal to `value` '''
+        entry = self._indexes[index].get(value)
+        if entry is None:
+            return ()
+        if isinstance(entry,Connection):
+            return (entry,)
+        return tuple(entry.values())
+
+    def keys(self, index):
+        ''' The values of `index` with a connection '''
+        return list(self._indexes[index])
+
+    def handlers(self):
+        ''' Every handler, as a tuple that stays as it is while connections change '''
+        if self._handlers is None:
+            self._handlers = tuple(self._handler_list)
+            self.stats['snapshots'] += 1
+        return self._handlers
+
+    def subscribers(self, topic):
+        return self.topics.match(topic) if self.topics is not None else set()
+
+    def traffic(self):
+        ''' Messages and bytes each way, over every connection there has been '''
+        totals = dict(self._closed)
+        for conn in self._conns:
+            for field in TRAFFIC:
+                totals[field] += getattr(conn,field)
+        return totals
+
+    def memory(self):
+        ''' Bytes held for the connections, an estimate from `sys.getsizeof` '''
+        records = sum( sys.getsizeof(c) for c in self._by_id.values() )
+        tables = sys.getsizeof(self._by_id)+sys.getsizeof(self._conns)+sys.getsizeof(self._handler_list)
+        for index in self._indexes.values():
+            tables += sys.getsizeof(index)+sum( sys.getsizeof(v) for v in index.values()
+                if isinstance(v,dict) )
+        if self._handlers is not None:
+            tables += sys.getsizeof(self._handlers)
+        buffered = sum( c.buffered() for c in self._by_id.values() )
+        count = len(self._by_id)
+        return dict(connections=count,records=records,tables=tables,buffered=buffered,
+            per_connection=round((records+tables)/count,1) if count else 0.0)
+
+    def status(self):
+        status = dict(self.stats)
+        status['connections'] = len(self._by_id)
+        for name in INDEXES:
+            status[f'{name}s'] = len(self._indexes[name])
+        return status
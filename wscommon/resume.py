@@ -0,0 +1,141 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import secrets
+import struct
+import time
+# Tornado
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+
+
+'''
+Acks and resumable sessions, for at-least-once delivery from clients.
+
+A `ReconnectingClient` with `acks=True` offers the `wscommon.resume.1`
+subprotocol. A handler with `ResumableMixin` (before the tornado base
+class) accepts it if its application has `resume_sessions`; anything
+else leaves it unselected and the client sends plain messages.
+
+Once selected:
+
+* the server answers the handshake with a resume token and the last
+  sequence number it received under that token. The client sends the
+  token back when it reconnects, drops what the server already has and
+  sends the rest again.
+* each client message is prefixed with its sequence number: "<seq> " for
+  text, 8 bytes big endian for binary. Handlers pass what they receive
+  through `resume_receive`, which strips it and returns None for a
+  message the session already had.
+* the server acks the highest sequence number received with a ping
+  "ack <seq>", at most every `resume_ack_delay` seconds. Pings leave the
+  server's own messages (and `wscommon.broadcast` frames) untouched.
+
+A session outlives its connection by `ttl` seconds.
+'''
+
+RESUME_PROTOCOL = 'wscommon.resume.1'
+TOKEN_HEADER = 'X-Resume-Token'
+LAST_HEADER = 'X-Resume-Last'
+
+_SEQ = struct.Struct('!Q')
+
+
+def wrap(seq, message, binary=False):
+    if binary:
+        return _SEQ.pack(seq)+bytes(message)
+    return f'{seq} {message}'
+
+def unwrap(message):
+    ''' (seq, message) from a wrapped message '''
+    if isinstance(message,bytes):
+        return _SEQ.unpack_from(message)[0],message[_SEQ.size:]
+    seq,_,message = message.partition(' ')
+    return int(seq),message
+
+
+class ResumeSession:
+
+    __slots__ = ('token','last_seq','handler','expires')
+
+    def __init__(self, token):
+        self.token = token
+        self.last_seq = 0
+        self.handler = None
+        self.expires = None
+
+
+class ResumeSessions:
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._sessions = {} # token => ResumeSession
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def claim(self, token, handler):
+        ''' The live session for `token`, or a new one '''
+        now = time.monotonic()
+        for key in [ k for k,s in self._sessions.items() if s.expires is not None and s.expires < now ]:
+            del self._sessions[key]
+        session = self._sessions.get(token) if token else None
+        if session is None:
+            session = ResumeSession(secrets.token_urlsafe(16))
+            self._sessions[session.token] = session
+        # A reconnect can arrive before the old connection is seen closing
+        session.handler = handler
+        session.expires = None
+        return session
+
+    def release(self, session, handler):
+        if session.handler is handler:
+            session.handler = None
+            session.expires = time.monotonic()+self.ttl
+
+
+class ResumableMixin:
+
+    resume_ack_delay = 0.05
+    resume_session = None
+    _resume_ack = None
+
+    def get_resume_sessions(self):
+        return getattr(self.application,'resume_sessions',None)
+
+    def select_subprotocol(self, subprotocols):
+        sessions = self.get_resume_sessions()
+        if sessions is None or RESUME_PROTOCOL not in subprotocols:
+            return super().select_subprotocol(subprotocols)
+        self.resume_session = sessions.claim(self.request.headers.get(TOKEN_HEADER),self)
+        self.set_header(TOKEN_HEADER,self.resume_session.token)
+        self.set_header(LAST_HEADER,str(self.resume_session.last_seq))
+        return RESUME_PROTOCOL
+
+    def resume_receive(self, message):
+        ''' The message without its sequence number; None if already received '''
+        session = self.resume_session
+        if session is None:
+            return message
+        seq,message = unwrap(message)
+        if self._resume_ack is None:
+            self._resume_ack = IOLoop.current().call_later(self.resume_ack_delay,self._send_resume_ack)
+        if seq <= session.last_seq:
+            return None
+        session.last_seq = seq
+        return message
+
+    def _send_resume_ack(self):
+        self._resume_ack = None
+        try:
+            self.ping(f'ack {self.resume_session.last_seq}')
+        except WebSocketClosedError:
+            pass
+
+    def on_connection_close(self):
+        if self._resume_ack is not None:
+            IOLoop.current().remove_timeout(self._resume_ack)
+            self._resume_ack = None
+        if self.resume_session is not None:
+            self.get_resume_sessions().release(self.resume_session,self)
+        super().on_connection_close()
@@ -0,0 +1,279 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import time
+# Tornado
+from tornado.websocket import WebSocketClosedError
+
+
+'''
+Request/response calls over a websocket, next to its other messages.
+
+Calls are JSON-RPC 2.0 text frames, each with an id the response is
+matched on, so any number can be in flight on one connection:
+
+    {"jsonrpc":"2.0","id":7,"method":"echo","params":{...},"timeout":2.5}
+    {"jsonrpc":"2.0","id":7,"result":...}
+    {"jsonrpc":"2.0","id":7,"error":{"code":-32601,"message":"..."}}
+
+`timeout` is the seconds the caller will wait, sent as a duration so the
+two clocks need not agree. The server stops the method once it is over.
+A method making calls of its own gets the rest of the deadline for them,
+through `remaining`. A caller that gives up or is cancelled sends
+`$/cancelRequest` (as LSP does), which cancels the method.
+
+Handlers use `RpcMixin` and mark methods with `@rpc_method('name')`;
+clients use `RpcClientMixin` and `await client.call(method, params)`;
+calls the server makes of them arrive at `on_rpc_notification`.
+Both pass what they receive through `rpc_receive`, which handles the call
+traffic and returns None for it, or returns any other message as is.
+
+Wire requirement: a call message must start with exactly `{"jsonrpc":`,
+the jsonrpc member first and no whitespace, as `encode` writes it. That
+prefix is how call traffic is told apart from the connection's other
+messages without parsing those. A JSON-RPC message written any other way
+is not seen as a call and is returned by `rpc_receive` as is.
+'''
+
+CANCEL = '$/cancelRequest'
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+DEADLINE_EXCEEDED = -32001
+TOO_MANY_REQUESTS = -32002
+CONNECTION_LOST = -32003
+REQUEST_CANCELLED = -32800
+
+_PREFIX = '{"jsonrpc":' # see the wire requirement above
+_deadline = contextvars.ContextVar('rpc_deadline',default=None)
+
+
+class RpcError(Exception):
+
+    def __init__(self, code, message, data=None):
+        super().__init__(f'{message} ({code})')
+        self.code = code
+        self.message = message
+        self.data = data
+
+
+class RpcTimeout(RpcError):
+
+    def __init__(self, message='deadline exceeded'):
+        super().__init__(DEADLINE_EXCEEDED,message)
+
+
+def rpc_method(name):
+    ''' Mark a handler method as callable as `name` '''
+    def decorate(fn):
+        fn.rpc_name = name
+        return fn
+    return decorate
+
+def remaining():
+    ''' Seconds left of the call being served, None outside of one '''
+    deadline = _deadline.get()
+    return None if deadline is None else deadline-time.monotonic()
+
+def encode(**fields):
+    return json.dumps(dict(jsonrpc='2.0',**fields),separators=(',',':'))
+
+def decode(message):
+    ''' The call message as a dict, or None for any other message '''
+    if not isinstance(message,str) or not message.startswith(_PREFIX):
+        return None
+    return json.loads(message)
+
+def _valid_id(call_id):
+    # JSON-RPC ids are strings, numbers or null
+    return call_id is None or (isinstance(call_id,(str,int,float)) and not isinstance(call_id,bool))
+
+
+#-- Server side ----------------------------------------#
+
+class RpcMixin:
+
+    rpc_methods = {}
+    rpc_max_inflight = 256
+    _rpc_tasks = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        methods = {}
+        for klass in reversed(cls.__mro__):
+            methods.update(getattr(klass,'rpc_methods',None) or {})
+            for attr in vars(klass).values():
+                name = getattr(attr,'rpc_name',None)
+                if name is not None:
+                    methods[name] = attr
+        cls.rpc_methods = methods
+
+    @classmethod
+    def register_rpc(cls, name, fn):
+        ''' Add `fn(handler, params)` as `name`, for this class and its subclasses to come '''
+        cls.rpc_methods = dict(cls.rpc_methods,**{name: fn})
+
+    def rpc_receive(self, message):
+        try:
+            msg = decode(message)
+        except ValueError:
+            self._rpc_error(None,PARSE_ERROR,'parse error')
+            return None
+        if msg is None:
+            return message
+        if msg.get('method') == CANCEL:
+            params = msg.get('params')
+            if not isinstance(params,dict) or not _valid_id(params.get('id')):
+                self._rpc_error(None,INVALID_REQUEST,'invalid cancel request')
+                return None
+            task = (self._rpc_tasks or {}).get(params.get('id'))
+            if task is not None:
+                task.cancel()
+            return None
+        if 'method' not in msg:
+            return None
+        call_id = msg.get('id')
+        if not _valid_id(call_id) or not isinstance(msg['method'],str):
+            self._rpc_error(call_id if _valid_id(call_id) else None,INVALID_REQUEST,'invalid request')
+            return None
+        if self._rpc_tasks is None:
+            self._rpc_tasks = {}
+        # Notifications run as tasks too, so they count toward the limit
+        if len(self._rpc_tasks) >= self.rpc_max_inflight:
+            self._rpc_reply(call_id,error=dict(code=TOO_MANY_REQUESTS,message='too many requests'))
+            return None
+        key = call_id if call_id is not None else object()
+        self._rpc_tasks[key] = asyncio.ensure_future(
+            self._rpc_run(call_id,msg['method'],msg.get('params'),msg.get('timeout'),key))
+        return None
+
+    async def _rpc_run(self, call_id, method, params, timeout, key):
+        fn = self.rpc_methods.get(method)
+        try:
+            if fn is None:
+                raise RpcError(METHOD_NOT_FOUND,f'method not found: {method}')
+            if timeout is not None:
+                _deadline.set(time.monotonic()+timeout)
+            result = fn(self,params)
+            if inspect.isawaitable(result):
+                result = await asyncio.wait_for(result,timeout)
+            self._rpc_reply(call_id,result=result)
+        except RpcError as err:
+            self._rpc_reply(call_id,error=dict(code=err.code,message=err.message,data=err.data))
+        except asyncio.TimeoutError:
+            self._rpc_reply(call_id,error=dict(code=DEADLINE_EXCEEDED,message='deadline exceeded'))
+        except asyncio.CancelledError:
+            self._rpc_reply(call_id,error=dict(code=REQUEST_CANCELLED,message='request cancelled'))
+        except Exception as err:
+            logging.exception("rpc %s failed",method)
+            self._rpc_reply(call_id,error=dict(code=INTERNAL_ERROR,message=str(err)))
+        finally:
+            if self._rpc_tasks is not None:
+                self._rpc_tasks.pop(key,None)
+
+    def _rpc_reply(self, call_id, **fields):
+        if call_id is None:
+            return # A notification
+        try:
+            data = encode(id=call_id,**fields)
+        except (TypeError,ValueError) as err:
+            data = encode(id=call_id,error=dict(code=INTERNAL_ERROR,message=f'bad result: {err}'))
+        try:
+            self.write_message(data)
+        except WebSocketClosedError:
+            pass
+
+    def _rpc_error(self, call_id, code, message):
+        ''' An error reply even without an id, for a call that could not be read '''
+        try:
+            self.write_message(encode(id=call_id,error=dict(code=code,message=message)))
+        except WebSocketClosedError:
+            pass
+
+    def on_connection_close(self):
+        for task in list((self._rpc_tasks or {}).values()):
+            task.cancel()
+        super().on_connection_close()
+
+
+#-- Client side ----------------------------------------#
+
+class RpcClientMixin:
+
+    '''
+    For a `wscommon.reconnect.ReconnectingClient`. Calls made while it is
+    disconnected wait in its outbox, if it has one. Subclasses call
+    `rpc_connection_lost` from `on_close`: a call whose response was lost
+    with the connection fails rather than waiting out its timeout.
+    '''
+
+    _rpc_next_id = 0
+    _rpc_pending = None
+
+    async def call(self, method, params=None, timeout=10.0):
+        ''' The result of `method`; raises `RpcError`, or `RpcTimeout` past `timeout` '''
+        left = remaining()
+        if left is not None:
+            timeout = min(timeout,left)
+        if timeout <= 0:
+            raise RpcTimeout()
+        if self._rpc_pending is None:
+            self._rpc_pending = {}
+        self._rpc_next_id += 1
+        call_id = self._rpc_next_id
+        future = asyncio.get_running_loop().create_future()
+        self._rpc_pending[call_id] = future
+        try:
+            if not self.write_message(encode(id=call_id,method=method,params=params,timeout=timeout)):
+                raise RpcError(CONNECTION_LOST,'not connected')
+            return await asyncio.wait_for(future,timeout)
+        except asyncio.TimeoutError:
+            self.notify(CANCEL,dict(id=call_id))
+            raise RpcTimeout()
+        except asyncio.CancelledError:
+            self.notify(CANCEL,dict(id=call_id))
+            raise
+        finally:
+            self._rpc_pending.pop(call_id,None)
+
+    def notify(self, method, params=None):
+        ''' A call without a response '''
+        return self.write_message(encode(method=method,params=params))
+
+    def rpc_receive(self, message):
+        try:
+            msg = decode(message)
+        except ValueError:
+            return message
+        if msg is None:
+            return message
+        if 'method' in msg:
+            self.on_rpc_notification(msg['method'],msg.get('params'))
+            return None
+        if not _valid_id(msg.get('id')):
+            return None
+        future = (self._rpc_pending or {}).get(msg.get('id'))
+        if future is not None and not future.done():
+            error = msg.get('error')
+            if isinstance(error,dict):
+                future.set_exception(RpcError(error.get('code'),error.get('message'),error.get('data')))
+            else:
+                future.set_result(msg.get('result'))
+        return None
+
+    def on_rpc_notification(self, method, params):
+        ''' A call from the server that wants no response '''
+        pass
+
+    def rpc_connection_lost(self):
+        for future in list((self._rpc_pending or {}).values()):
+            if not future.done():
+                future.set_exception(RpcError(CONNECTION_LOST,'connection lost'))
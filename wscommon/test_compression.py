@@ -0,0 +1,59 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+# Tornado
+import tornado.httpserver
+import tornado.web
+import tornado.websocket
+from tornado.testing import bind_unused_port
+# Local
+from wscommon.compression import CompressionPolicy, CompressionPolicyMixin, _check_tornado, websocket_connect
+
+
+'''
+Run with `python -m pytest wscommon`. These lean on tornado internals on
+purpose: a tornado upgrade that moves them should fail here, loudly.
+'''
+
+POLICY = CompressionPolicy(level=6,mem_level=8,window_bits=10,threshold=512)
+
+
+class EchoHandler(CompressionPolicyMixin, tornado.websocket.WebSocketHandler):
+
+    compression_policy = POLICY
+
+    def on_message(self, message):
+        self.write_message(message)
+
+
+def test_tornado_internals_present():
+    _check_tornado()
+
+def test_policy_applied_on_both_sides():
+    async def run():
+        sock,port = bind_unused_port()
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/ws',EchoHandler)]))
+        server.add_sockets([sock])
+        conn = await websocket_connect(f'ws://127.0.0.1:{port}/ws',compression=POLICY)
+        try:
+            protocol = conn.protocol
+            assert protocol._compressor is not None
+            assert protocol._compressor._max_wbits == POLICY.window_bits
+
+            small = 'x'*100
+            before = protocol._wire_bytes_out
+            conn.write_message(small)
+            assert await conn.read_message() == small
+            # Under the threshold: sent as is, 2 header bytes and a 4 byte mask
+            assert protocol._wire_bytes_out-before == len(small)+6
+
+            big = 'y'*10000
+            before = protocol._wire_bytes_out
+            conn.write_message(big)
+            assert await conn.read_message() == big
+            assert protocol._wire_bytes_out-before < len(big)//10
+        finally:
+            conn.close()
+            server.stop()
+    asyncio.run(run())
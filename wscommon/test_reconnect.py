@@ -0,0 +1,77 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Python
+import asyncio
+# Tornado
+import tornado.httpserver
+import tornado.web
+import tornado.websocket
+from tornado.testing import bind_unused_port
+# Local
+from wscommon.reconnect import Backoff, OPEN, ReconnectingClient
+
+
+'''
+Run with `python -m pytest wscommon`.
+'''
+
+
+class EchoHandler(tornado.websocket.WebSocketHandler):
+
+    def on_message(self, message):
+        self.write_message(message)
+
+
+class RaisingClient(ReconnectingClient):
+
+    ''' Fails its first `on_open`, and on every message 'boom' '''
+
+    def __init__(self, url):
+        super().__init__(url,backoff=Backoff(base=0.01,cap=0.02))
+        self.open_calls = 0
+        self.received = []
+        self.got = asyncio.Event()
+
+    def on_open(self):
+        self.open_calls += 1
+        if self.open_calls == 1:
+            raise RuntimeError('on_open failed')
+
+    def on_message(self, msg):
+        if msg == 'boom':
+            raise RuntimeError('on_message failed')
+        self.received.append(msg)
+        self.got.set()
+
+
+async def _until(predicate, timeout=5):
+    async def poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(),timeout)
+
+
+def test_raising_hooks_do_not_end_the_client():
+    async def run():
+        sock,port = bind_unused_port()
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/ws',EchoHandler)]))
+        server.add_sockets([sock])
+        client = RaisingClient(f'ws://127.0.0.1:{port}/ws')
+        task = asyncio.create_task(client.start())
+        try:
+            # The first open raised, so the client dropped it and redialed
+            await _until(lambda: client.stats['opens'] == 2 and client.state == OPEN)
+            assert client.open_calls == 2
+            assert not task.done()
+
+            # A message whose hook raised costs only that message
+            client.write_message('boom')
+            client.write_message('after')
+            await asyncio.wait_for(client.got.wait(),5)
+            assert client.received == ['after']
+            assert client.stats['opens'] == 2
+        finally:
+            client.close()
+            await asyncio.wait_for(task,5)
+            server.stop()
+    asyncio.run(run())
@@ -0,0 +1,295 @@
+# Copyright 2022 Jeffrey LeBlanc
+
+# Local
+from .rpc import RpcError, INVALID_PARAMS, encode, rpc_method
+
+
+'''
+Named topics that websocket clients subscribe to.
+
+Topics are dot separated names, like "chat.room1". A subscription is to
+a pattern, where as in AMQP topic exchanges `*` stands for exactly one
+segment and a final `#` for any number of them, none included:
+
+    chat.room1    only chat.room1
+    chat.*        chat.room1, not chat or chat.room1.typing
+    chat.#        chat, chat.room1, chat.room1.typing
+
+A `TopicIndex` maps patterns to their subscribers. Plain names are a
+dict lookup; wildcard patterns sit in a trie by segment, so matching a
+topic walks its segments rather than every subscription, and publishing
+costs about the number of subscribers, not of connections.
+
+Clients manage subscriptions and publish with RPC calls (see
+`wscommon.rpc`): `subscribe` and `unsubscribe` take a pattern or a list
+of them, `publish` takes {"topic": ..., "data": ...}. Subscribers receive
+a `message` notification:
+
+    {"jsonrpc":"2.0","method":"message","params":{"topic":"chat.room1","data":...}}
+
+Handlers use `TopicsMixin` with `RpcMixin` (the mixin only adds methods
+for it to find), and the application has `topics` (a `TopicIndex`) and
+`publish(topic, data)`. Clients use `TopicClientMixin` with
+`RpcClientMixin`.
+'''
+
+PUBLICATION = 'message'
+
+SEPARATOR = '.'
+ONE = '*'
+REST = '#'
+MAX_BYTES = 255
+
+
+def check_pattern(pattern):
+    ''' Raises ValueError for a pattern that is not well formed '''
+    if not isinstance(pattern,str) or not pattern:
+        raise ValueError('a topic pattern is a non empty string')
+    if len(pattern.encode('utf-8')) > MAX_BYTES:
+        raise ValueError(f'a topic pattern is at most {MAX_BYTES} bytes')
+    segments = pattern.split(SEPARATOR)
+    for idx,segment in enumerate(segments):
+        if not segment:
+            raise ValueError(f'empty segment in {pattern!r}')
+        if REST in segment and (segment != REST or idx != len(segments)-1):
+            raise ValueError(f'{REST!r} can only be the last segment, in {pattern!r}')
+        if ONE in segment and segment != ONE:
+            raise ValueError(f'{ONE!r} can only be a whole segment, in {pattern!r}')
+
+def check_topic(topic):
+    check_pattern(topic)
+    if ONE in topic or REST in topic:
+        raise ValueError(f'a topic cannot have wildcards, {topic!r}')
+
+def is_wildcard(pattern):
+    return ONE in pattern or REST in pattern
+
+def encode_publication(topic, data):
+    ''' The notification subscribers receive, encoded once per publish '''
+    return encode(method=PUBLICATION,params=dict(topic=topic,data=data))
+
+
+class _TrieNode:
+
+    __slots__ = ('children','subscribers')
+
+    def __init__(self):
+        self.children = {} # segment => _TrieNode
+        self.subscribers = set()
+
+
+class TopicIndex:
+
+    '''
+    Subscribers are anything hashable. `on_change`, if set, is called
+    whenever a pattern gains its first subscriber or loses its last.
+    '''
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self._exact = {} # topic => set of subscribers
+        self._root = _TrieNode() # wildcard patterns, by segment
+        self._wildcards = {} # wildcard pattern => its trie node
+        self._by_subscriber = {} # subscriber => set of patterns
+        self._count = 0
+
+    def __len__(self):
+        ''' Subscriptions, counting each pattern of each subscriber '''
+        return self._count
+
+    def subscribe(self, pattern, subscriber):
+        ''' Returns False if `subscriber` already had `pattern` '''
+        patterns = self._by_subscriber.get(subscriber)
+        if patterns is not None and pattern in patterns:
+            return False
+        check_pattern(pattern)
+        if patterns is None:
+            patterns = self._by_subscriber[subscriber] = set()
+        patterns.add(pattern)
+        self._count += 1
+        if is_wildcard(pattern):
+            node = self._wildcards.get(pattern)
+            if node is None:
+                node = self._root
+                for segment in pattern.split(SEPARATOR):
+                    node = node.children.setdefault(segment,_TrieNode())
+                self._wildcards[pattern] = node
+            subscribers = node.subscribers
+        else:
+            subscribers = self._exact.setdefault(pattern,set())
+        subscribers.add(subscriber)
+        if len(subscribers) == 1 and self.on_change is not None:
+            self.on_change()
+        return True
+
+    def unsubscribe(self, pattern, subscriber):
+        ''' Returns False if `subscriber` did not have `pattern` '''
+        patterns = self._by_subscriber.get(subscriber)
+        if patterns is None or pattern not in patterns:
+            return False
+        patterns.discard(pattern)
+        self._count -= 1
+        if not patterns:
+            del self._by_subscriber[subscriber]
+        if is_wildcard(pattern):
+            emptied = self._unsubscribe_wildcard(pattern,subscriber)
+        else:
+            subscribers = self._exact[pattern]
+            subscribers.discard(subscriber)
+            emptied = not subscribers
+            if emptied:
+                del self._exact[pattern]
+        if emptied and self.on_change is not None:
+            self.on_change()
+        return True
+
+    def _unsubscribe_wildcard(self, pattern, subscriber):
+        node = self._wildcards[pattern]
+        node.subscribers.discard(subscriber)
+        if node.subscribers:
+            return False
+        del self._wildcards[pattern]
+        # Prune the branch back to the last node still in use
+        path = [self._root]
+        segments = pattern.split(SEPARATOR)
+        for segment in segments:
+            path.append(path[-1].children[segment])
+        for segment,parent,child in zip(reversed(segments),reversed(path[:-1]),reversed(path[1:])):
+            if child.subscribers or child.children:
+                break
+            del parent.children[segment]
+        return True
+
+    def unsubscribe_all(self, subscriber):
+        for pattern in list(self._by_subscriber.get(subscriber,())):
+            self.unsubscribe(pattern,subscriber)
+
+    def subscriptions(self, subscriber):
+        return set(self._by_subscriber.get(subscriber,()))
+
+    def patterns(self):
+        ''' Every pattern with a subscriber '''
+        return set(self._exact)|set(self._wildcards)
+
+    def match(self, topic):
+        ''' The subscribers of `topic`, each once '''
+        found = set(self._exact.get(topic,()))
+        if self._wildcards:
+            self._collect(self._root,topic.split(SEPARATOR),0,found)
+        return found
+
+    def _collect(self, node, segments, idx, found):
+        rest = node.children.get(REST)
+        if rest is not None:
+            found.update(rest.subscribers)
+        if idx == len(segments):
+            found.update(node.subscribers)
+            return
+        child = node.children.get(segments[idx])
+        if child is not None:
+            self._collect(child,segments,idx+1,found)
+        child = node.children.get(ONE)
+        if child is not None:
+            self._collect(child,segments,idx+1,found)
+
+    def status(self):
+        return dict(subscribers=len(self._by_subscriber),subscriptions=len(self),
+            topics=len(self._exact),wildcards=len(self._wildcards))
+
+
+#-- Server side ----------------------------------------#
+
+def _patterns(params):
+    patterns = [params] if isinstance(params,str) else params
+    if not isinstance(patterns,list):
+        raise RpcError(INVALID_PARAMS,'expected a topic pattern or a list of them')
+    for pattern in patterns:
+        try:
+            check_pattern(pattern)
+        except ValueError as err:
+            raise RpcError(INVALID_PARAMS,str(err))
+    return patterns
+
+class TopicsMixin:
+
+    topic_max_subscriptions = 256
+
+    def get_topics(self):
+        return getattr(self.application,'topics',None)
+
+    @rpc_method('subscribe')
+    def rpc_subscribe(self, params):
+        ''' The connection's subscriptions, afterwards '''
+        topics = self.get_topics()
+        patterns = _patterns(params)
+        current = topics.subscriptions(self)
+        if len(current|set(patterns)) > self.topic_max_subscriptions:
+            raise RpcError(INVALID_PARAMS,f'at most {self.topic_max_subscriptions} subscriptions')
+        for pattern in patterns:
+            topics.subscribe(pattern,self)
+        return sorted(topics.subscriptions(self))
+
+    @rpc_method('unsubscribe')
+    def rpc_unsubscribe(self, params):
+        topics = self.get_topics()
+        for pattern in _patterns(params):
+            topics.unsubscribe(pattern,self)
+        return sorted(topics.subscriptions(self))
+
+    @rpc_method('publish')
+    def rpc_publish(self, params):
+        ''' How many local subscribers it was written to '''
+        if not isinstance(params,dict):
+            raise RpcError(INVALID_PARAMS,'expected {"topic": ..., "data": ...}')
+        topic = params.get('topic')
+        try:
+            check_topic(topic)
+        except ValueError as err:
+            raise RpcError(INVALID_PARAMS,str(err))
+        return self.application.publish(topic,params.get('data'))
+
+    def on_connection_close(self):
+        topics = self.get_topics()
+        if topics is not None:
+            topics.unsubscribe_all(self)
+        super().on_connection_close()
+
+
+#-- Client side ----------------------------------------#
+
+class TopicClientMixin:
+
+    '''
+    For a client with `RpcClientMixin`. Subscriptions are remembered and,
+    as the server forgets them with the connection, subclasses call
+    `resubscribe` from `on_open`. Publications arrive at `on_publication`.
+    '''
+
+    _subscriptions = None
+
+    async def subscribe(self, *patterns):
+        if self._subscriptions is None:
+            self._subscriptions = set()
+        self._subscriptions.update(patterns)
+        return await self.call('subscribe',list(patterns))
+
+    async def unsubscribe(self, *patterns):
+        if self._subscriptions is not None:
+            self._subscriptions.difference_update(patterns)
+        return await self.call('unsubscribe',list(patterns))
+
+    def publish(self, topic, data):
+        return self.notify('publish',dict(topic=topic,data=data))
+
+    def resubscribe(self):
+        if self._subscriptions:
+            self.notify('subscribe',sorted(self._subscriptions))
+
+    def on_rpc_notification(self, method, params):
+        if method == PUBLICATION:
+            self.on_publication(params['topic'],params['data'])
+        else:
+            super().on_rpc_notification(method,params)
+
+    def on_publication(self, topic, data):
+        pass